@@ -0,0 +1,192 @@
+"""
+checkpoint.py
+Checkpoint and resume for RUN batches, so a batch which is stopped (by the SG_MaxWallClockSecs budget, a
+SIGTERM from the scheduler, or a crash) carries on from where it got to the next time it's run, rather than
+having to find the last net_i and net_j in the impacts file and pass them in as SG_Start_i and SG_Start_j.
+
+The checkpoint file is yaml, like calibration.yaml, and it's written to a temporary file and then renamed
+over the old one, so there is always a complete checkpoint, even if the job is killed while writing it.
+It records the impacts file, the next iteration number, the scenario generator state and the length of
+the impacts file after the last complete row (the ImpactsSink position), so that anything written after
+that (e.g. half a row from a job that was killed) can be cut off when resuming. Other files which get a row
+per scenario (e.g. the trip length histograms) have their lengths saved with it too, see restoreFiles.
+A checkpoint is only resumed if the batch settings are the same, otherwise a new batch is started, and it's
+deleted when a batch finishes all its iterations.
+"""
+
+import os
+import signal
+import time
+import logging
+import yaml
+
+class RunCheckpoint:
+
+    """
+    Constructor
+    @param filename checkpoint file (yaml)
+    @param settings dictionary of the batch settings (mode, radius etc), which must match to resume
+    @param every write a checkpoint every this many scenarios (and always when stopping)
+    @param maxWallClockSecs stop cleanly before this many seconds have passed, 0 for no limit
+    @param startTime time.monotonic() when the job started, which the wall clock budget is measured from
+    """
+    def __init__(self, filename, settings, every=10, maxWallClockSecs=0, startTime=None):
+        self.filename = filename
+        self.settings = settings
+        self.every = max(every,1)
+        self.maxWallClockSecs = maxWallClockSecs
+        self.stopRequested = False #set by the SIGTERM handler
+        self.startTime = time.monotonic() if startTime is None else startTime
+        self.lastTime = time.monotonic()
+        self.count = 0 #scenarios finished in this process
+        self.slowestSecs = 0.0 #slowest scenario so far, used to stop before the budget runs out
+
+################################################################################
+
+    """
+    load
+    @returns the saved checkpoint dictionary if there is one for a batch with the same settings, otherwise None
+    """
+    def load(self):
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename,'r') as fd:
+            state = yaml.safe_load(fd)
+        if not state or state.get('settings')!=self.settings:
+            logging.info('RunCheckpoint:: ignoring checkpoint '+str(self.filename)+' as the batch settings are different')
+            return None
+        return state
+
+################################################################################
+
+    """
+    save
+    Write the checkpoint atomically
+    @param impactsFilename the impacts file for this batch
+    @param nextIteration the iteration number to carry on from
+    @param offset position of the impacts file (its length in bytes, or ImpactsSink.tell) after the last complete row
+    @param generatorState scenario generator getState() after the last complete row
+    @param fileOffsets optional dictionary of other files written by the batch, and their lengths in bytes
+    """
+    def save(self, impactsFilename, nextIteration, offset, generatorState, fileOffsets=None):
+        state = {
+            'settings': self.settings,
+            'impactsFilename': str(impactsFilename),
+            'nextIteration': nextIteration,
+            'offset': offset,
+            'generatorState': generatorState
+        }
+        if fileOffsets:
+            state['fileOffsets'] = fileOffsets
+        tmpFilename = str(self.filename)+'.tmp'
+        with open(tmpFilename,'w') as fd:
+            yaml.safe_dump(state, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmpFilename, self.filename)
+
+################################################################################
+
+    """
+    installSignalHandler
+    Make SIGTERM request a clean stop after the current scenario, instead of killing the process
+    """
+    def installSignalHandler(self):
+        def handler(signum, frame):
+            logging.info('RunCheckpoint:: SIGTERM received, stopping after the current scenario')
+            self.stopRequested = True
+        signal.signal(signal.SIGTERM, handler)
+
+################################################################################
+
+    """
+    shouldStop
+    @returns True if a SIGTERM has been received, or if there isn't enough of the wall clock budget left to
+    run another scenario (going by the slowest one so far)
+    """
+    def shouldStop(self):
+        if self.stopRequested:
+            return True
+        if self.maxWallClockSecs>0:
+            elapsed = time.monotonic()-self.startTime
+            if elapsed+self.slowestSecs>=self.maxWallClockSecs:
+                logging.info('RunCheckpoint:: stopping as the wall clock budget of '+str(self.maxWallClockSecs)+' secs is nearly used up')
+                return True
+        return False
+
+################################################################################
+
+    """
+    begin
+    Call this just before the first scenario, so the time taken by the scenarios doesn't include loading
+    and calibrating the model
+    """
+    def begin(self):
+        self.lastTime = time.monotonic()
+
+################################################################################
+
+    """
+    scenarioFinished
+    Call this after each impacts row has been written. Writes a checkpoint every "every" scenarios, or when
+    the batch has to stop.
+    @param impactsFile the open impacts file, or an ImpactsSink, which writes out its buffered records when
+    the checkpoint asks for its position (tell)
+    @param nextIteration the iteration number to carry on from
+    @param generatorState scenario generator getState() after the scenario that was just written
+    @param files optional list of other files that the scenario's rows have been written to (and closed), whose
+    lengths are saved so they can be cut back with the impacts file, see restoreFiles
+    @returns True to carry on, False to stop
+    """
+    def scenarioFinished(self, impactsFile, nextIteration, generatorState, files=None):
+        now = time.monotonic()
+        self.slowestSecs = max(self.slowestSecs, now-self.lastTime)
+        self.lastTime = now
+        self.count+=1
+        stop = self.shouldStop()
+        if stop or self.count%self.every==0:
+            self.save(impactsFile.name, nextIteration, impactsFile.tell(), generatorState, self.syncFiles(files))
+        return not stop
+
+################################################################################
+
+    """
+    syncFiles
+    Make sure the files are on disk
+    @param files list of filenames, or None
+    @returns dictionary of the filenames and their lengths in bytes, or None if there are no files
+    """
+    @staticmethod
+    def syncFiles(files):
+        if not files:
+            return None
+        fileOffsets = {}
+        for filename in files:
+            with open(filename,'ab') as fd:
+                os.fsync(fd.fileno())
+                fileOffsets[str(filename)] = fd.tell()
+        #end for
+        return fileOffsets
+
+    """
+    restoreFiles
+    Cut the other files saved with a checkpoint (see scenarioFinished) back to their lengths at the checkpoint, which
+    throws away the rows of any scenarios after it, the same as the impacts file
+    @param state checkpoint dictionary from load
+    """
+    @staticmethod
+    def restoreFiles(state):
+        for (filename, offset) in state.get('fileOffsets',{}).items():
+            os.truncate(filename, offset)
+
+################################################################################
+
+    """
+    finish
+    The batch is complete, so remove the checkpoint
+    """
+    def finish(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+################################################################################
@@ -3,28 +3,25 @@ debug.py
 various utility debugging routines
 """
 
-from scenarios.OneLink import OneLinkLimitR
+from scenarios.RadiusNeighbourIndex import RadiusNeighbourIndex
 from models.SingleOrigin import SingleOrigin
 
 """
 Count how many scenarios there are in total for every zone (i)
 Output to countscenarios.txt
+NOTE: this is just the number of neighbours of each zone in the radius index, which is the same as running
+through the OneLinkLimitR sequence and counting them. Zones with no scenarios are left out, apart from zone 0.
+@param index optional RadiusNeighbourIndex for Lij_mode and radiusKM, otherwise one is built
 """
-def debug_countScenarios(radiusKM,N,mode,Lij_mode):
+def debug_countScenarios(radiusKM,N,mode,Lij_mode,index=None):
+    if index is None:
+        index = RadiusNeighbourIndex.build(Lij_mode,radiusKM)
+    counts = index.counts()
     with open('countscenarios.csv','w') as fd:
         fd.write('zonei,count_'+str(radiusKM)+'KM\n')
-        scenarioGenerator = OneLinkLimitR(radiusKM,N,mode,Lij_mode)
-        scenarioGenerator.i=0
-        scenarioGenerator.j=-1
-        count=0
-        currenti=0
-        while scenarioGenerator.next()!=[]:
-            if (scenarioGenerator.i!=currenti):
-                fd.write(str(currenti)+','+str(count)+'\n')
-                count=0
-                currenti=scenarioGenerator.i
-            count+=1
-        fd.write(str(currenti)+','+str(count)+'\n')
+        for i in range(0,N):
+            if i==0 or counts[i]>0:
+                fd.write(str(i)+','+str(counts[i])+'\n')
 ###
 
 """
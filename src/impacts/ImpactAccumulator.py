@@ -0,0 +1,137 @@
+"""
+ImpactAccumulator.py
+Running totals of a predicted trips matrix for every mode, which are everything ImpactStatistics needs from it:
+Ck = sum_ij Tij (people), Lk = sum_ij Tij*Lij (distance travelled), the origin and destination marginals
+Cik = sum_j Tij and Cjk = sum_i Tij, and optionally a histogram of the trips by length (Lij).
+
+This lets a scenario run in "statistics only" mode (see SingleOrigin.runWithChanges), where the model pushes
+each row tile of TPred into the accumulator as soon as it's computed, then throws it away, so the scenario
+TPred matrices are never kept. Everything is accumulated in float64, whatever the precision of the tiles.
+
+The accumulator for a scenario starts as a copy of the baseline one (fromMatrices), then a full run clears it
+and adds every row, while an incremental run replaces just the rows that changed.
+"""
+
+import numpy as np
+
+class ImpactAccumulator:
+
+    """
+    Constructor
+    @param Lij list of N x N distance matrices (KM), one per mode
+    @param histogramBinsKM optional increasing bin edges (KM) for the trip length histograms, starting at 0, where
+    bin b is [edge b, edge b+1) and the last bin has everything from the last edge up
+    """
+    def __init__(self, Lij, histogramBinsKM=None):
+        self.Lij = Lij
+        self.numModes = len(Lij)
+        (M, N) = np.shape(Lij[0])
+        self.N = N
+        self.histogramBinsKM = None if histogramBinsKM is None else np.asarray(histogramBinsKM,dtype=np.float64)
+        self.clear()
+
+###############################################################################
+
+    """
+    clear
+    Set all the totals back to zero
+    """
+    def clear(self):
+        self.Ck = np.zeros(self.numModes)
+        self.Lk = np.zeros(self.numModes)
+        self.Cik = np.zeros((self.numModes,self.N))
+        self.Cjk = np.zeros((self.numModes,self.N))
+        self.histogram = None
+        if self.histogramBinsKM is not None:
+            self.histogram = np.zeros((self.numModes,len(self.histogramBinsKM)))
+
+###############################################################################
+
+    """
+    copy
+    @returns a new accumulator with copies of the totals, sharing Lij
+    """
+    def copy(self):
+        acc = ImpactAccumulator.__new__(ImpactAccumulator)
+        acc.Lij = self.Lij
+        acc.numModes = self.numModes
+        acc.N = self.N
+        acc.histogramBinsKM = self.histogramBinsKM
+        acc.Ck = np.copy(self.Ck)
+        acc.Lk = np.copy(self.Lk)
+        acc.Cik = np.copy(self.Cik)
+        acc.Cjk = np.copy(self.Cjk)
+        acc.histogram = None if self.histogram is None else np.copy(self.histogram)
+        return acc
+
+###############################################################################
+
+    """
+    addRows
+    Add a tile of rows of the trips matrix for one mode, which is the sink for GravityKernel.streamPredicted
+    @param k mode number
+    @param rows slice or int array of the row numbers of the tile
+    @param tile len(rows) x N array of trips
+    @param sign +1.0 to add the rows, -1.0 to take them away again
+    """
+    def addRows(self, k, rows, tile, sign=1.0):
+        T = np.asarray(tile,dtype=np.float64)
+        L = self.Lij[k][rows]
+        rowSums = T.sum(axis=1)
+        self.Ck[k] += sign*rowSums.sum()
+        self.Lk[k] += sign*np.sum(T*L)
+        self.Cik[k,rows] += sign*rowSums
+        self.Cjk[k] += sign*T.sum(axis=0)
+        if self.histogram is not None:
+            self.histogram[k] += sign*self.computeHistogram(T, L)
+
+###############################################################################
+
+    """
+    replaceRows
+    Replace rows of the trips matrix which have already been added, for an incremental scenario
+    @param k mode number
+    @param rows int array of the row numbers
+    @param oldValues len(rows) x N array of the rows that were added before, e.g. the baseline TPred rows
+    @param newValues len(rows) x N array of the new rows
+    """
+    def replaceRows(self, k, rows, oldValues, newValues):
+        self.addRows(k, rows, oldValues, -1.0)
+        self.addRows(k, rows, newValues, 1.0)
+        self.Cik[k,rows] = np.sum(newValues,axis=1,dtype=np.float64) #exact, rather than old+new-old
+
+###############################################################################
+
+    """
+    computeHistogram
+    @param T tile of trips
+    @param L the same tile of the distance matrix
+    @returns trips in each of the histogramBinsKM bins
+    """
+    def computeHistogram(self, T, L):
+        bins = np.searchsorted(self.histogramBinsKM, L.ravel(), side='right')-1
+        np.clip(bins, 0, len(self.histogramBinsKM)-1, out=bins)
+        return np.bincount(bins, weights=T.ravel(), minlength=len(self.histogramBinsKM))
+
+###############################################################################
+
+    """
+    fromMatrices
+    Accumulator holding the totals of a set of complete trips matrices, e.g. the baseline TPred
+    @param TPred list of N x N trips matrices, one per mode
+    @param Lij list of N x N distance matrices (KM), one per mode
+    @param histogramBinsKM optional bin edges for the trip length histograms, see the constructor
+    @param tileRows number of rows added in one block, which bounds the size of the float64 temporaries
+    @returns ImpactAccumulator
+    """
+    @staticmethod
+    def fromMatrices(TPred, Lij, histogramBinsKM=None, tileRows=256):
+        acc = ImpactAccumulator(Lij, histogramBinsKM)
+        (M, N) = np.shape(TPred[0])
+        for k in range(0,acc.numModes):
+            for r0 in range(0,M,tileRows):
+                r1 = min(r0+tileRows,M)
+                acc.addRows(k, slice(r0,r1), TPred[k][r0:r1])
+        return acc
+
+###############################################################################
@@ -0,0 +1,117 @@
+"""
+ImpactKernel.py
+Fused kernels for the aggregate impact statistics of one mode (see ImpactStatistics.compute).
+
+One pass over the rows of the baseline and scenario TPred, Cij and Lij gives everything at once:
+Ck1, Ck2 = sum_ij T1[i,j], T2[i,j] (people)
+Lk1, Lk2 = sum_ij T1[i,j]*Lij[i,j], T2[i,j]*Lij[i,j] (distance travelled)
+nMinus = number of cells with C2[i,j] < C1[i,j] (quicker trips)
+savedSecs = sum_ij max(C1[i,j]-C2[i,j],0) (time saved)
+The rows are split over threads with prange (set NUMBA_NUM_THREADS to limit them) and the GIL is released.
+Every row is accumulated in float64 into its own partial sum, then the partials are added up in row order,
+so the results don't depend on the number of threads, and nothing N x N is ever allocated. The matrices
+can be float32 or float64, including read only memory maps.
+"""
+
+import numpy as np
+from numba import jit, prange
+
+class ImpactKernel:
+
+    """
+    computeModeStatistics
+    The fused kernel. Either part of the pass can be switched off, then those matrices aren't read at all
+    and their results are zero, but they still need to be arrays, so just pass any of the others.
+    @param T1 baseline TPred (N x N)
+    @param T2 scenario TPred (N x N)
+    @param C1 baseline Cij (N x N)
+    @param C2 scenario Cij (N x N)
+    @param L distance matrix Lij (N x N)
+    @param withScenario compute Ck2 and Lk2 from T2
+    @param withCosts compute nMinus and savedSecs from C1 and C2
+    @returns (Ck1, Ck2, Lk1, Lk2, nMinus, savedSecs)
+    """
+    @staticmethod
+    @jit(nopython=True, parallel=True, nogil=True)
+    def computeModeStatistics(T1, T2, C1, C2, L, withScenario, withCosts):
+        (M, N) = np.shape(T1)
+        rowCk1 = np.zeros(M)
+        rowCk2 = np.zeros(M)
+        rowLk1 = np.zeros(M)
+        rowLk2 = np.zeros(M)
+        rowMinus = np.zeros(M,dtype=np.int64)
+        rowSaved = np.zeros(M)
+        for i in prange(M):
+            ck1 = 0.0
+            ck2 = 0.0
+            lk1 = 0.0
+            lk2 = 0.0
+            minus = 0
+            saved = 0.0
+            for j in range(N):
+                t1 = np.float64(T1[i,j])
+                l = np.float64(L[i,j])
+                ck1 += t1
+                lk1 += t1*l
+                if withScenario:
+                    t2 = np.float64(T2[i,j])
+                    ck2 += t2
+                    lk2 += t2*l
+                if withCosts:
+                    diff = np.float64(C1[i,j])-np.float64(C2[i,j]) #2<1 if you're saving secs and it's quicker
+                    if diff>0.0:
+                        minus += 1
+                        saved += diff
+            #end for j
+            rowCk1[i] = ck1
+            rowCk2[i] = ck2
+            rowLk1[i] = lk1
+            rowLk2[i] = lk2
+            rowMinus[i] = minus
+            rowSaved[i] = saved
+        #end for i
+        return rowCk1.sum(), rowCk2.sum(), rowLk1.sum(), rowLk2.sum(), rowMinus.sum(), rowSaved.sum()
+
+################################################################################
+
+    """
+    computeTripsAndDistance
+    Ck and Lk for one trips matrix
+    @param T TPred or TObs (N x N)
+    @param L distance matrix Lij (N x N)
+    @returns (trips, distance) float64
+    """
+    @staticmethod
+    def computeTripsAndDistance(T, L):
+        (Ck, Ck2, Lk, Lk2, nMinus, savedSecs) = ImpactKernel.computeModeStatistics(T, T, T, T, L, False, False)
+        return Ck, Lk
+
+################################################################################
+
+    """
+    computeCostChanges
+    nMinus and savedSecs only, for a baseline and scenario Cij
+    @param C1 baseline Cij (N x N)
+    @param C2 scenario Cij (N x N)
+    @returns (nMinus, savedSecs)
+    """
+    @staticmethod
+    @jit(nopython=True, parallel=True, nogil=True)
+    def computeCostChanges(C1, C2):
+        (M, N) = np.shape(C1)
+        rowMinus = np.zeros(M,dtype=np.int64)
+        rowSaved = np.zeros(M)
+        for i in prange(M):
+            minus = 0
+            saved = 0.0
+            for j in range(N):
+                diff = np.float64(C1[i,j])-np.float64(C2[i,j])
+                if diff>0.0:
+                    minus += 1
+                    saved += diff
+            rowMinus[i] = minus
+            rowSaved[i] = saved
+        #end for i
+        return rowMinus.sum(), rowSaved.sum()
+
+################################################################################
@@ -10,16 +10,15 @@ from numba import float64, types, typed
 #from typing import List
 #from numba.typed import List as NumbaList
 import numpy as np
-from jax import grad, jit
-from jax import lax
-from jax import random
-import jax
-import jax.numpy as jnp
+import pandas as pd
 #import cupy as cp
 import typing as pt
 
 from models.DirectNetworkChange import DirectNetworkChange
 from models.SingleOrigin import SingleOrigin
+from models.RowOverlayMatrix import RowOverlayMatrix
+from impacts.ImpactKernel import ImpactKernel
+from impacts.ImpactAccumulator import ImpactAccumulator
 
 #spec = [
 #    ('Ck1', float64[:]),
@@ -38,6 +37,7 @@ from models.SingleOrigin import SingleOrigin
 
 #@jitclass()
 class ImpactStatistics(object):
+    ZoneFormats = ['csv','csv.gz','parquet','feather'] #zone statistics file formats, see writeStatisticsFile
     Ck1: pt.List[float64]
     Ck2: pt.List[float64]
     CkDiff: pt.List[float64]
@@ -77,6 +77,14 @@ class ImpactStatistics(object):
         self.Cjk1 = np.array((1,1),dtype=float)
         self.Cjk2 = np.array((1,1),dtype=float)
         self.CjkDiff = np.array((1,1),dtype=float)
+
+        #trip length histograms [k,bin], only from computeFromAccumulators with histograms on
+        self.LkHist1 = None
+        self.LkHist2 = None
+
+        #if True, then nMinus and savedSecs from the scenario's NetworkChangeLedger are checked against comparing
+        #the whole of the baseline and scenario Cij (slow, see verifyChangeLedger)
+        self.verifyLedger = False
     
 ################################################################################
 
@@ -101,7 +109,9 @@ class ImpactStatistics(object):
             #faster - numpy
             #Lk[k]=np.sum(Tij[k] * dijKM[k])
             #JAX
-            Lk[k]=jnp.sum(Tij[k] * dijKM[k])
+            #Lk[k]=jnp.sum(Tij[k] * dijKM[k])
+            #fused kernel, in float64 without the N x N product
+            trips, Lk[k] = ImpactKernel.computeTripsAndDistance(Tij[k], dijKM[k])
         return Lk
 
 ################################################################################
@@ -207,13 +217,79 @@ class ImpactStatistics(object):
         nMinus_k = [0.0 for k in range(0,NumModes)]
         savedSecs_k = [0.0 for k in range(0,NumModes)]
         for k in range(0,NumModes):
-            nMinus_k[k]=jnp.count_nonzero(Cij2[k] < Cij1[k])
-            diff = Cij1[k]-Cij2[k] #it's saved seconds, and 2<1 if you're saving secs and it's quicker
-            diff = jnp.where(diff>0,diff,0) #filter out any negative values - savings are all positive
-            savedSecs_k[k] =np.sum(diff)
+            #nMinus_k[k]=jnp.count_nonzero(Cij2[k] < Cij1[k])
+            #diff = Cij1[k]-Cij2[k] #it's saved seconds, and 2<1 if you're saving secs and it's quicker
+            #diff = jnp.where(diff>0,diff,0) #filter out any negative values - savings are all positive
+            #savedSecs_k[k] =np.sum(diff)
+            #fused kernel, which doesn't need the N x N differences
+            nMinus_k[k], savedSecs_k[k] = ImpactKernel.computeCostChanges(Cij1[k], Cij2[k])
         #end for
         return nMinus_k, savedSecs_k
 
+################################################################################
+
+    """
+    computeNetworkStatisticsOverlay
+    Same as computeNetworkStatistics, but only looks at the cells which the scenario changed, which the
+    overlay has logged, rather than comparing every N x N cell of every mode.
+    @param overlay ScenarioOverlay that the scenario was run with
+    @returns nMinus, savedSecs
+    """
+    def computeNetworkStatisticsOverlay(self,overlay):
+        NumModes = len(overlay.baseCij)
+        nMinus_k = [0.0 for k in range(0,NumModes)]
+        savedSecs_k = [0.0 for k in range(0,NumModes)]
+        Cij2 = overlay.Cij
+        for k in range(0,NumModes):
+            rows, cols = overlay.changedCells(k)
+            diff = overlay.baseCij[k][rows, cols]-Cij2[k][rows, cols] #it's saved seconds, and 2<1 if you're saving secs and it's quicker
+            nMinus_k[k] = np.count_nonzero(diff>0)
+            savedSecs_k[k] = np.sum(diff[diff>0]) #filter out any negative values - savings are all positive
+        #end for
+        return nMinus_k, savedSecs_k
+
+
+################################################################################
+
+    """
+    computeScenarioNetworkStatistics
+    nMinus and savedSecs for a scenario, from the cheapest place that has them: the NetworkChangeLedger that
+    runWithChanges left on qm3, then the cells logged by the overlay, then comparing every cell of Cij.
+    @param qm3_base baseline quant 3 model
+    @param qm3 scenario quant 3 model
+    @param overlay optional ScenarioOverlay that qm3 was run with
+    @returns nMinus, savedSecs
+    """
+    def computeScenarioNetworkStatistics(self, qm3_base: SingleOrigin, qm3: SingleOrigin, overlay=None):
+        if qm3.changeLedger is not None:
+            nMinus_k, savedSecs_k = qm3.changeLedger.computeNetworkStatistics()
+            if self.verifyLedger:
+                self.verifyChangeLedger(qm3_base.Cij if overlay is None else overlay.baseCij, qm3.Cij, nMinus_k, savedSecs_k)
+            return nMinus_k, savedSecs_k
+        elif overlay is not None:
+            return self.computeNetworkStatisticsOverlay(overlay)
+        return self.computeNetworkStatistics(qm3_base.Cij, qm3.Cij)
+
+################################################################################
+
+    """
+    verifyChangeLedger
+    Cross check the network statistics from a NetworkChangeLedger against the full comparison of the baseline and
+    scenario Cij (computeNetworkStatistics), which is the verification mode (SG_VerifyLedger)
+    @param Cij1 baseline shortest paths (minutes) matrix by mode
+    @param Cij2 scenario shortest paths (minutes) matrix by mode
+    @param nMinus_k number of quicker cells by mode from the ledger
+    @param savedSecs_k minutes saved by mode from the ledger
+    @raises RuntimeError if they don't agree
+    """
+    def verifyChangeLedger(self, Cij1, Cij2, nMinus_k, savedSecs_k):
+        nMinusCheck, savedSecsCheck = self.computeNetworkStatistics(Cij1, Cij2)
+        for k in range(0,len(Cij1)):
+            if nMinus_k[k]!=nMinusCheck[k] or abs(savedSecs_k[k]-savedSecsCheck[k])>1.0e-9*max(1.0,abs(savedSecsCheck[k])):
+                raise RuntimeError("ImpactStatistics: change ledger for mode "+str(k)+" has nMinus="+str(nMinus_k[k])
+                    +" savedSecs="+str(savedSecs_k[k])+", but the full comparison has nMinus="+str(nMinusCheck[k])
+                    +" savedSecs="+str(savedSecsCheck[k]))
+        #end for
 
 ################################################################################
 
@@ -224,27 +300,51 @@ class ImpactStatistics(object):
     @param qm3 scenario quant 3 model
     @param dijKM vertex KM distance file, 3 modes
     @param networkChanges The scenario changes so we can compute distances, spread, geographic statistics etc.
+    @param overlay optional ScenarioOverlay that qm3 was run with, so the network statistics only need the changed cells
     """
     #@jit(nopython=True)
-    def compute(self,qm3_base: SingleOrigin,qm3: SingleOrigin, dijKM:np.matrix, networkChanges: list):
+    def compute(self,qm3_base: SingleOrigin,qm3: SingleOrigin, dijKM:np.matrix, networkChanges: list, overlay=None):
         #print("DNC::",type(networkChanges))
 
-        (M, N) = np.shape(qm3.TObs[0])
-
-        #count people on modes
-        self.Ck1 = [0 for k in range(0,qm3.numModes)]
-        self.Ck2 = [0 for k in range(0,qm3.numModes)]
-        self.CkDiff = [0 for k in range(0,qm3.numModes)]
+        (M, N) = np.shape(qm3.Cij[0])
+
+        #count people and distance travelled on modes, plus the network statistics if there is no overlay or change
+        #ledger, which is all one pass over the matrices of each mode (see ImpactKernel)
+        withCosts = overlay is None and qm3.changeLedger is None
+        self.Ck1 = [0.0 for k in range(0,qm3.numModes)]
+        self.Ck2 = [0.0 for k in range(0,qm3.numModes)]
+        self.CkDiff = [0.0 for k in range(0,qm3.numModes)]
+        self.Lk1 = [0.0 for k in range(0,qm3.numModes)]
+        self.Lk2 = [0.0 for k in range(0,qm3.numModes)]
+        self.deltaLk = [0.0 for k in range(0,qm3.numModes)]
+        self.nMinus_k = [0 for k in range(0,qm3.numModes)]
+        self.savedSecs_k = [0.0 for k in range(0,qm3.numModes)]
         for k in range(0,qm3.numModes):
-            #print("deltadk: ",np.sum(qm3.TPred[k]),np.sum(qm3_base.TPred[k]))
-            self.Ck1[k] = jnp.sum(qm3_base.TPred[k]) #baseline count people
-            self.Ck2[k] = jnp.sum(qm3.TPred[k]) #scenario count people
-            self.CkDiff[k] = self.Ck2[k] - self.Ck1[k] #difference in people by mode
-        
-        #compute distance travelled on modes
-        self.Lk1 = self.computeL_k(qm3_base.TPred,dijKM) #baseline distance travelled
-        self.Lk2 = self.computeL_k(qm3.TPred,dijKM) #scenario distance travelled
-        self.deltaLk = [self.Lk2[k]-self.Lk1[k] for k in range(0,qm3.numModes)] #difference in distance by mode
+            T1 = qm3_base.TPred[k]
+            T2 = qm3.TPred[k]
+            if self.isIncrementalOf(T2,T1):
+                #incremental scenario - only the dirty rows are different to the baseline, so the baseline totals
+                #are the same for every scenario, and the scenario is the baseline plus the differences in the dirty rows
+                baseline = self.getBaselineTotals(qm3_base, dijKM)
+                Ck1 = float(baseline.Ck[k])
+                Lk1 = float(baseline.Lk[k])
+                (nMinus, savedSecs) = ImpactKernel.computeCostChanges(qm3_base.Cij[k], qm3.Cij[k]) if withCosts else (0, 0.0)
+                self.CkDiff[k] = T2.deltaSum()
+                self.deltaLk[k] = T2.deltaSum(dijKM[k])
+                Ck2 = Ck1 + self.CkDiff[k]
+                Lk2 = Lk1 + self.deltaLk[k]
+            else:
+                (Ck1, Ck2, Lk1, Lk2, nMinus, savedSecs) = ImpactKernel.computeModeStatistics(
+                    T1, self.dense(T2), qm3_base.Cij[k], qm3.Cij[k], dijKM[k], True, withCosts)
+                self.CkDiff[k] = Ck2 - Ck1 #difference in people by mode
+                self.deltaLk[k] = Lk2 - Lk1 #difference in distance by mode
+            self.Ck1[k] = Ck1 #baseline count people
+            self.Ck2[k] = Ck2 #scenario count people
+            self.Lk1[k] = Lk1 #baseline distance travelled
+            self.Lk2[k] = Lk2 #scenario distance travelled
+            self.nMinus_k[k] = int(nMinus)
+            self.savedSecs_k[k] = savedSecs
+        #end for k
 
         #compute scenario link statistics - measures changes made by the network changes directly
         self.scenarioLinkDepth_k, self.scenarioLinkKM_k, self.scenarioLinkSavedSecs_k \
@@ -254,7 +354,48 @@ class ImpactStatistics(object):
         self.LBar_k = self.computeLBar(networkChanges, dijKM)
 
         #compute scenario network statistics - measures number of faster trips and saved time (secondary changes as a result of APSP)
-        self.nMinus_k, self.savedSecs_k = self.computeNetworkStatistics(qm3_base.Cij, qm3.Cij)
+        #NOTE: without an overlay or a change ledger, these came out of the pass above
+        if not withCosts:
+            self.nMinus_k, self.savedSecs_k = self.computeScenarioNetworkStatistics(qm3_base, qm3, overlay)
+
+################################################################################
+
+    """
+    computeFromAccumulators
+    Same as compute followed by computeZones, but for a "statistics only" scenario run, where the totals of the
+    baseline and scenario TPred are in ImpactAccumulators (see SingleOrigin.runWithChanges), so neither TPred
+    is read. If the accumulators have trip length histograms, then they go into LkHist1 and LkHist2.
+    @param baseline ImpactAccumulator of the baseline TPred
+    @param scenario ImpactAccumulator of the scenario TPred
+    @param qm3_base baseline quant 3 model
+    @param qm3 scenario quant 3 model, which only needs Cij
+    @param dijKM vertex KM distance file, 3 modes
+    @param networkChanges The scenario changes so we can compute distances, spread, geographic statistics etc.
+    @param overlay optional ScenarioOverlay that qm3 was run with, so the network statistics only need the changed cells
+    """
+    def computeFromAccumulators(self, baseline, scenario, qm3_base: SingleOrigin, qm3: SingleOrigin, dijKM, networkChanges: list, overlay=None):
+        self.Ck1 = [ float(c) for c in baseline.Ck ] #baseline count people
+        self.Ck2 = [ float(c) for c in scenario.Ck ] #scenario count people
+        self.CkDiff = [ self.Ck2[k]-self.Ck1[k] for k in range(0,qm3.numModes) ] #difference in people by mode
+        self.Lk1 = [ float(l) for l in baseline.Lk ] #baseline distance travelled
+        self.Lk2 = [ float(l) for l in scenario.Lk ] #scenario distance travelled
+        self.deltaLk = [ self.Lk2[k]-self.Lk1[k] for k in range(0,qm3.numModes) ] #difference in distance by mode
+        self.LkHist1 = baseline.histogram
+        self.LkHist2 = scenario.histogram
+
+        #zones
+        self.Cik1 = baseline.Cik
+        self.Cik2 = scenario.Cik
+        self.CikDiff = self.Cik2 - self.Cik1
+        self.Cjk1 = baseline.Cjk
+        self.Cjk2 = scenario.Cjk
+        self.CjkDiff = self.Cjk2 - self.Cjk1
+
+        #the rest is the same as compute
+        self.scenarioLinkDepth_k, self.scenarioLinkKM_k, self.scenarioLinkSavedSecs_k \
+            = self.computeScenarioLinkStatistics(networkChanges, qm3_base.Cij, dijKM)
+        self.LBar_k = self.computeLBar(networkChanges, dijKM)
+        self.nMinus_k, self.savedSecs_k = self.computeScenarioNetworkStatistics(qm3_base, qm3, overlay)
 
 ################################################################################
 
@@ -263,7 +404,7 @@ class ImpactStatistics(object):
     Computes statistics per zone, rather than overall total statistics for a scenario
     """
     def computeZones(self,qm3_base: SingleOrigin,qm3: SingleOrigin, dijKM:np.matrix, networkChanges: list):
-        (M, N) = np.shape(qm3.TObs[0])
+        (M, N) = np.shape(qm3.Cij[0])
 
          #count people on modes
         self.Cik1 = np.zeros((qm3.numModes,N),dtype=float)
@@ -274,40 +415,216 @@ class ImpactStatistics(object):
         self.CjkDiff = np.zeros((qm3.numModes,N),dtype=float)
         
         #calculations
+        baseline = self.getBaselineTotals(qm3_base, dijKM)
         for k in range(0,qm3.numModes):
-            self.Cik1[k,:] = jnp.sum(qm3_base.TPred[k],axis=1) #baseline count people
-            self.Cik2[k,:] = jnp.sum(qm3.TPred[k],axis=1) #scenario count people
+            self.Cik1[k,:] = baseline.Cik[k] #baseline count people
+            self.Cjk1[k,:] = baseline.Cjk[k] #baseline count people
+            if self.isIncrementalOf(qm3.TPred[k],qm3_base.TPred[k]):
+                #incremental scenario - only the dirty rows are different to the baseline
+                T = qm3.TPred[k]
+                self.Cik2[k,:] = self.Cik1[k,:]
+                self.Cik2[k,T.rows] = np.sum(T.values,axis=1,dtype=np.float64)
+                self.Cjk2[k,:] = self.Cjk1[k,:] + np.sum(T.values.astype(np.float64)-T.base[T.rows],axis=0)
+            else:
+                T = self.dense(qm3.TPred[k])
+                self.Cik2[k,:] = np.sum(T,axis=1,dtype=np.float64) #scenario count people
+                self.Cjk2[k,:] = np.sum(T,axis=0,dtype=np.float64) #scenario count people
             self.CikDiff[k,:] = self.Cik2[k,:] - self.Cik1[k,:] #difference in people by mode
-            self.Cjk1[k,:] = jnp.sum(qm3_base.TPred[k],axis=0) #baseline count people
-            self.Cjk2[k,:] = jnp.sum(qm3.TPred[k],axis=0) #scenario count people
             self.CjkDiff[k,:] = self.Cjk2[k,:] - self.Cjk1[k,:] #difference in people by mode
 
 
 ################################################################################
 
-    def writeStatisticsFile(self,filename,df_zonecodes):
+    """
+    getBaselineTotals
+    The totals of the baseline TPred (see ImpactAccumulator.fromMatrices) are the same for every scenario, so they are
+    worked out once and kept on qm3_base, until its TPred or the distance matrices are replaced (e.g. by
+    fastComputePredicted), which is when they're worked out again.
+    @param qm3_base baseline quant 3 model
+    @param dijKM vertex KM distance file, 3 modes
+    @returns ImpactAccumulator of the baseline TPred
+    """
+    @staticmethod
+    def getBaselineTotals(qm3_base: SingleOrigin, dijKM):
+        sources = list(qm3_base.TPred)+list(dijKM)
+        cached = qm3_base.baselineTotals
+        if cached is None or len(cached[0])!=len(sources) or any(a is not b for (a,b) in zip(cached[0],sources)):
+            totals = ImpactAccumulator.fromMatrices(qm3_base.TPred, dijKM, None, qm3_base.tileRows or 256)
+            qm3_base.baselineTotals = (sources, totals)
+        return qm3_base.baselineTotals[1]
+
+    """
+    isIncrementalOf
+    @returns True if the scenario matrix is a RowOverlayMatrix on top of the baseline matrix, which means
+    that the scenario statistics can be computed from the baseline ones plus the dirty rows only
+    """
+    @staticmethod
+    def isIncrementalOf(T2, T1):
+        return isinstance(T2,RowOverlayMatrix) and T2.base is T1
+
+    """
+    dense
+    @returns the matrix as a plain numpy array, materialising it if it's a RowOverlayMatrix
+    """
+    @staticmethod
+    def dense(T):
+        if isinstance(T,RowOverlayMatrix):
+            return T.materialise()
+        return T
+
+################################################################################
+
+    """
+    csvHeader
+    Header line for the impacts csv file, which has one row per scenario (see csvRow)
+    @param numLinks number of links in each scenario, which adds mode, i, j and secs columns for each link
+    @returns the header line, including the newline
+    """
+    @staticmethod
+    def csvHeader(numLinks):
+        header = (
+            "idx,"
+            +"Ck1Road,Ck1Bus,Ck1Rail,Ck2Road,Ck2Bus,Ck2Rail,CkDiffRoad,CkDiffBus,CkDiffRail,"
+            +"Lk1Road,Lk1Bus,Lk1Rail,Lk2Road,Lk2Bus,Lk2Rail,deltaLkRoad,deltaLkBus,deltaLkRail,"
+            +"scenarioLinkDepthRoad, scenarioLinkDepthBus, scenarioLinkDepthRail,"
+            +"scenarioLinkKMRoad, scenarioLinkKMBus, scenarioLinkKMRail,"
+            +"scenarioLinkSavedSecsRoad, scenarioLinkSavedSecsBus, scenarioLinkSavedSecsRail,"
+            +"LBarRoad, LBarBus, LBarRail,"
+            +"nMinusRoad, nMinusBus, nMinusRail,"
+            +"SavedSecsRoad, savedSecsBus, savedSecsRail"
+            #+"net_mode, net_i, net_j, net_secs\n"
+        )
+        for n in range(0,numLinks):
+            header += ",net_mode_{0}, net_i_{0}, net_j_{0}, net_secs_{0}".format(n)
+        return header+"\n"
+
+    """
+    csvRow
+    One row of the impacts csv file for the statistics computed by compute()
+    @param idx scenario number
+    @param networkChanges the scenario, which is written out as mode, i, j, secs for each link
+    @returns the row, including the newline
+    """
+    def csvRow(self, idx, networkChanges):
+        row = (
+            ('{0},' #idx
+            '{1},{2},{3},' #Ck1
+            '{4},{5},{6},' #Ck2
+            '{7},{8},{9},' #CkDiff
+            '{10},{11},{12},' #Lk1
+            '{13},{14},{15},' #Lk2
+            '{16},{17},{18},' #deltaLk
+            '{19},{20},{21},' #scenarioLinkDepth_k
+            '{22},{23},{24},' #scenarioLinkKM_K
+            '{25},{26},{27},' #scenarioLinkSavedSecs_K
+            '{28},{29},{30},' #LBar_k
+            '{31},{32},{33},' #nMinus_K
+            '{34},{35},{36}' #savedSecs_K
+            )
+            .format(
+                idx,
+                self.Ck1[0],self.Ck1[1],self.Ck1[2],
+                self.Ck2[0],self.Ck2[1],self.Ck2[2],
+                self.CkDiff[0],self.CkDiff[1],self.CkDiff[2],
+                self.Lk1[0],self.Lk1[1],self.Lk1[2],
+                self.Lk2[0],self.Lk2[1],self.Lk2[2],
+                self.deltaLk[0],self.deltaLk[1],self.deltaLk[2],
+                self.scenarioLinkDepth_k[0], self.scenarioLinkDepth_k[1], self.scenarioLinkDepth_k[2],
+                self.scenarioLinkKM_k[0], self.scenarioLinkKM_k[1], self.scenarioLinkKM_k[2],
+                self.scenarioLinkSavedSecs_k[0], self.scenarioLinkSavedSecs_k[1], self.scenarioLinkSavedSecs_k[2],
+                self.LBar_k[0], self.LBar_k[1], self.LBar_k[2],
+                self.nMinus_k[0], self.nMinus_k[1], self.nMinus_k[2],
+                self.savedSecs_k[0], self.savedSecs_k[1], self.savedSecs_k[2]
+            )
+        )
+        #now write out the game state: mode,i,j,secs for each network change
+        for nc in networkChanges:
+            row += ',{0},{1},{2},{3}'.format(nc.mode,nc.originZonei,nc.destinationZonei,nc.absoluteTimeSecs)
+        return row+'\n'
+
+    """
+    histogramCsvHeader
+    Header line for the trip length histograms csv file, which has one row per scenario and mode (see histogramCsvRows)
+    @param histogramBinsKM the bin edges (KM) of the ImpactAccumulators
+    @returns the header line, including the newline
+    """
+    @staticmethod
+    def histogramCsvHeader(histogramBinsKM):
+        return "idx,mode,"+",".join([ "km_"+str(edge) for edge in histogramBinsKM ])+"\n"
+
+    """
+    histogramCsvRows
+    Rows of the trip length histograms csv file for the scenario histogram (LkHist2) computed by computeFromAccumulators
+    @param idx scenario number, or e.g. 'baseline' for the baseline histogram
+    @param baseline write the baseline histogram (LkHist1) instead
+    @returns the rows, one per mode, including the newlines
+    """
+    def histogramCsvRows(self, idx, baseline=False):
+        histogram = self.LkHist1 if baseline else self.LkHist2
+        rows = ''
+        for k in range(0,len(histogram)):
+            rows += str(idx)+','+str(k)+','+','.join([ str(float(h)) for h in histogram[k] ])+'\n'
+        return rows
+
+################################################################################
+
+    """
+    zoneStatisticsColumns
+    @returns the column names of the zone statistics file, in order, which are the csv header of writeStatisticsFile
+    """
+    @staticmethod
+    def zoneStatisticsColumns():
+        columns = ['zonei','zonecode']
+        for name in ['Cik1','Cik2','CikDiff','Cjk1','Cjk2','CjkDiff']:
+            columns += [ name+'_'+mode for mode in ['road','bus','rail'] ]
+        return columns
+
+    """
+    zoneAreaKeys
+    Index of the zone codes by zone number, which only needs making once for any number of zone statistics files
+    @param df_zonecodes the ZoneCodes table, with zonei and areakey columns
+    @param N number of zones
+    @returns object array (N) of the areakey of each zonei
+    """
+    @staticmethod
+    def zoneAreaKeys(df_zonecodes, N):
+        areaKeys = df_zonecodes.set_index('zonei')['areakey'].reindex(np.arange(N))
+        if areaKeys.isna().any():
+            raise ValueError("ImpactStatistics.zoneAreaKeys: no areakey for zones "+str(list(np.flatnonzero(areaKeys.isna().values)[0:10])))
+        return areaKeys.to_numpy(dtype=object)
+
+    """
+    zoneStatisticsFrame
+    The zone statistics computed by computeZones (or computeFromAccumulators) as a table with one row per zone
+    @param zoneCodes the ZoneCodes table (with zonei and areakey columns), or the areakey array from zoneAreaKeys
+    @returns pandas DataFrame with the zoneStatisticsColumns
+    """
+    def zoneStatisticsFrame(self, zoneCodes):
         (M,N) = np.shape(self.Cik1)
-        with filename.open('w') as f:
-            #header line
-            f.write('zonei,zonecode,'
-                    +'Cik1_road,Cik1_bus,Cik1_rail,'
-                    +'Cik2_road,Cik2_bus,Cik2_rail,'
-                    +'CikDiff_road,CikDiff_bus,CikDiff_rail,'
-                    +'Cjk1_road,Cjk1_bus,Cjk1_rail,'
-                    +'Cjk2_road,Cjk2_bus,Cjk2_rail,'
-                    +'CjkDiff_road,CjkDiff_bus,CjkDiff_rail\n')
-            for i in range(0,N):
-                row = df_zonecodes[df_zonecodes['zonei'] == i]
-                zonecode=row['areakey'].values[0]
-                f.write(str(i)+','+zonecode+',')
-                f.write(f'{self.Cik1[0,i]},{self.Cik1[1,i]},{self.Cik1[2,i]},')
-                f.write(f'{self.Cik2[0,i]},{self.Cik2[1,i]},{self.Cik2[2,i]},')
-                f.write(f'{self.CikDiff[0,i]},{self.CikDiff[1,i]},{self.CikDiff[2,i]},')
-                f.write(f'{self.Cjk1[0,i]},{self.Cjk1[1,i]},{self.Cjk1[2,i]},')
-                f.write(f'{self.Cjk2[0,i]},{self.Cjk2[1,i]},{self.Cjk2[2,i]},')
-                f.write(f'{self.CjkDiff[0,i]},{self.CjkDiff[1,i]},{self.CjkDiff[2,i]}')
-                f.write('\n')
-            #end for
+        areaKeys = ImpactStatistics.zoneAreaKeys(zoneCodes, N) if isinstance(zoneCodes,pd.DataFrame) else zoneCodes
+        values = np.concatenate([ self.Cik1, self.Cik2, self.CikDiff, self.Cjk1, self.Cjk2, self.CjkDiff ]).T
+        df = pd.DataFrame(values, columns=ImpactStatistics.zoneStatisticsColumns()[2:])
+        df.insert(0, 'zonecode', areaKeys)
+        df.insert(0, 'zonei', np.arange(N))
+        return df
+
+    """
+    writeStatisticsFile
+    Write the zone statistics to a file, with one row per zone. The format comes from the file extension: .csv (the
+    original layout), .csv.gz (compressed csv), .parquet or .feather (these two need pyarrow).
+    @param filename pathlib.Path of the file to write
+    @param zoneCodes the ZoneCodes table (with zonei and areakey columns), or the areakey array from zoneAreaKeys
+    """
+    def writeStatisticsFile(self, filename, zoneCodes):
+        df = self.zoneStatisticsFrame(zoneCodes)
+        if filename.suffix=='.parquet':
+            df.to_parquet(filename, index=False)
+        elif filename.suffix=='.feather':
+            df.to_feather(filename)
+        elif filename.name.endswith('.csv') or filename.name.endswith('.csv.gz'):
+            df.to_csv(filename, index=False) #compression comes from the extension
+        else:
+            raise ValueError("ImpactStatistics.writeStatisticsFile: unknown format for "+str(filename)+", must be "+str(ImpactStatistics.ZoneFormats))
     ###
 
 ################################################################################
@@ -0,0 +1,363 @@
+"""
+ImpactsSink.py
+Buffered writer for the impacts of a RUN batch, which has one record per scenario with the same columns as the
+impacts csv file (see ImpactStatistics.csvHeader).
+
+The records go into a typed numpy record array, and are only written out a batch at a time, which replaces
+formatting and flushing a line of text for every scenario. A flush is the crash safe point: everything up to it
+is on disk (fsync), and tell() is the position after it, which is what the RunCheckpoint saves, so a batch which
+is resumed cuts the file back to the last checkpoint with truncate(offset).
+
+ImpactsSink is an abstract base class, which does the buffering, and each format implements writeRecords, tell
+and truncate. Formats, which come from the file extension (see ImpactsSink.open):
+    .csv      the original impacts csv file, with the same header
+    .bin      appendable binary file of the raw records, with a .bin.yaml file next to it giving numLinks, so it can
+              be read back with BinaryImpactsSink.read (a np.memmap-able record array)
+    .parquet  directory of parquet files, one per flush (needs pyarrow), which pandas.read_parquet reads as one table
+
+Usage (see the RUN loop in pyquant3):
+    with ImpactsSink.open(impacts_file, numLinks, batchSize) as sink:
+        for each scenario:
+            impacts.compute(...)
+            sink.add(idx, impacts, networkChanges)
+"""
+
+import os
+import glob
+from abc import ABC, abstractmethod
+import numpy as np
+import pandas as pd
+import yaml
+
+from impacts.ImpactStatistics import ImpactStatistics
+
+class ImpactsSink(ABC):
+
+    Formats = ['csv','parquet','bin']
+
+    #impacts columns holding counts, the rest are float64
+    IntColumns = ['idx','scenarioLinkDepthRoad','scenarioLinkDepthBus','scenarioLinkDepthRail','nMinusRoad','nMinusBus','nMinusRail']
+
+    """
+    Constructor
+    @param filename pathlib.Path of the impacts file
+    @param numLinks number of network changes the records have room for
+    @param batchSize number of records buffered before they're written
+    """
+    def __init__(self, filename, numLinks, batchSize=100):
+        self.filename = filename
+        self.name = str(filename) #for RunCheckpoint
+        self.numLinks = numLinks
+        self.batchSize = max(batchSize,1)
+        self.records = np.zeros(self.batchSize, dtype=ImpactsSink.recordDtype(numLinks))
+        self.count = 0 #records in the buffer
+
+################################################################################
+
+    """
+    recordDtype
+    @param numLinks number of network changes in a record
+    @returns numpy dtype of an impacts record, with the columns of ImpactStatistics.csvHeader (without the spaces)
+    and then numChanges, the number of network changes actually used (the rest have mode, i and j of -1)
+    """
+    @staticmethod
+    def recordDtype(numLinks):
+        fields = []
+        for name in ImpactStatistics.csvHeader(numLinks).strip().split(','):
+            name = name.strip()
+            if name in ImpactsSink.IntColumns or name.startswith('net_mode_') or name.startswith('net_i_') or name.startswith('net_j_'):
+                fields.append((name, np.int64))
+            else:
+                fields.append((name, np.float64))
+        #end for
+        fields.append(('numChanges', np.int64))
+        return np.dtype(fields)
+
+################################################################################
+
+    """
+    makeRecord
+    @param idx scenario number
+    @param impacts ImpactStatistics for the scenario
+    @param networkChanges the scenario, list of DirectNetworkChange
+    @param numLinks number of network changes the record has room for
+    @returns one impacts record (a 0 dimensional record array) which is small enough to send back from a worker process
+    """
+    @staticmethod
+    def makeRecord(idx, impacts, networkChanges, numLinks):
+        if len(networkChanges)>numLinks:
+            raise ValueError("ImpactsSink: scenario "+str(idx)+" has "+str(len(networkChanges))+" network changes, but the records only have room for "+str(numLinks))
+        values = [ idx ]
+        for stat in [ impacts.Ck1, impacts.Ck2, impacts.CkDiff, impacts.Lk1, impacts.Lk2, impacts.deltaLk,
+            impacts.scenarioLinkDepth_k, impacts.scenarioLinkKM_k, impacts.scenarioLinkSavedSecs_k, impacts.LBar_k,
+            impacts.nMinus_k, impacts.savedSecs_k ]:
+            values += [ stat[0], stat[1], stat[2] ]
+        for n in range(0,numLinks):
+            if n<len(networkChanges):
+                nc = networkChanges[n]
+                values += [ nc.mode, nc.originZonei, nc.destinationZonei, nc.absoluteTimeSecs ]
+            else:
+                values += [ -1, -1, -1, np.nan ]
+        #end for
+        values.append(len(networkChanges))
+        return np.array(tuple(values), dtype=ImpactsSink.recordDtype(numLinks))
+
+################################################################################
+
+    """
+    add
+    Buffer the impacts of one scenario, writing out the batch if the buffer is full
+    @param idx scenario number
+    @param impacts ImpactStatistics for the scenario
+    @param networkChanges the scenario, list of DirectNetworkChange
+    """
+    def add(self, idx, impacts, networkChanges):
+        if len(networkChanges)>self.numLinks and self.canGrow():
+            #e.g. graphml scenarios, which don't all have the same number of links
+            self.flush()
+            self.numLinks = len(networkChanges)
+            self.records = np.zeros(self.batchSize, dtype=ImpactsSink.recordDtype(self.numLinks))
+        self.append(ImpactsSink.makeRecord(idx, impacts, networkChanges, self.numLinks))
+
+    """
+    append
+    Buffer a record from makeRecord, writing out the batch if the buffer is full
+    @param record impacts record
+    """
+    def append(self, record):
+        self.records[self.count] = record
+        self.count+=1
+        if self.count>=self.batchSize:
+            self.flush()
+
+################################################################################
+
+    """
+    flush
+    Write out the buffered records and make sure they're on disk, which is the crash safe point for the checkpoints
+    """
+    def flush(self):
+        if self.count>0:
+            self.writeRecords(self.records[0:self.count])
+            self.count = 0
+
+    """
+    close
+    Flush the last records and close the file
+    """
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+################################################################################
+
+    """
+    canGrow
+    @returns True if the number of links in the records can change part way through the file
+    """
+    def canGrow(self):
+        return False
+
+    """
+    writeRecords
+    Write records to the file and sync it
+    @param records record array
+    """
+    @abstractmethod
+    def writeRecords(self, records):
+        pass
+
+    """
+    tell
+    Flush the buffered records, which makes this a crash safe point (RunCheckpoint calls this when it saves)
+    @returns position in the file, to pass to truncate when resuming
+    """
+    @abstractmethod
+    def tell(self):
+        pass
+
+    """
+    truncate
+    Cut the file back to a position from tell, throwing away anything written after it
+    @param offset position from tell
+    """
+    @abstractmethod
+    def truncate(self, offset):
+        pass
+
+################################################################################
+
+    """
+    open
+    Make the sink for an impacts file, with the format from its extension (see Formats)
+    @param filename pathlib.Path of the impacts file
+    @param numLinks number of network changes in each scenario
+    @param batchSize number of records buffered before they're written
+    @param offset if resuming, the tell() position of the checkpoint, which the file is cut back to before carrying
+    on with it, otherwise None for a new file
+    @returns ImpactsSink
+    """
+    @staticmethod
+    def open(filename, numLinks, batchSize=100, offset=None):
+        if filename.suffix=='.csv':
+            sink = CsvImpactsSink(filename, numLinks, batchSize, offset is not None)
+        elif filename.suffix=='.bin':
+            sink = BinaryImpactsSink(filename, numLinks, batchSize, offset is not None)
+        elif filename.suffix=='.parquet':
+            sink = ParquetImpactsSink(filename, numLinks, batchSize, offset is not None)
+        else:
+            raise ValueError("ImpactsSink: unknown format for "+str(filename)+", must be one of "+str(ImpactsSink.Formats))
+        if offset is not None:
+            sink.truncate(offset)
+        return sink
+
+################################################################################
+
+"""
+CsvImpactsSink
+The original impacts csv file, with the header from ImpactStatistics.csvHeader
+"""
+class CsvImpactsSink(ImpactsSink):
+
+    """
+    Constructor
+    @param resume append to an existing file, otherwise a new one is started with the header line
+    """
+    def __init__(self, filename, numLinks, batchSize=100, resume=False):
+        super().__init__(filename, numLinks, batchSize)
+        self.f = filename.open('a' if resume else 'w')
+        if not resume:
+            self.f.write(ImpactStatistics.csvHeader(numLinks))
+            self.sync()
+
+    def canGrow(self):
+        return True #the network changes are the last columns, so rows can have more of them
+
+    def writeRecords(self, records):
+        lines = []
+        numColumns = len(records.dtype.names)-1-4*self.numLinks #columns before the network changes
+        for record in records.tolist():
+            #only the network changes that were used, like ImpactStatistics.csvRow
+            lines.append(','.join(map(str, record[0:numColumns+4*record[-1]])))
+        self.f.write('\n'.join(lines)+'\n')
+        self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def tell(self):
+        self.flush()
+        return self.f.tell()
+
+    def truncate(self, offset):
+        self.f.truncate(offset)
+        self.f.seek(offset)
+
+    def close(self):
+        super().close()
+        self.f.close()
+
+################################################################################
+
+"""
+BinaryImpactsSink
+Appendable file of raw impacts records, with numLinks in a yaml file next to it (filename+'.yaml')
+"""
+class BinaryImpactsSink(ImpactsSink):
+
+    """
+    Constructor
+    @param resume append to an existing file, otherwise a new one is started
+    """
+    def __init__(self, filename, numLinks, batchSize=100, resume=False):
+        super().__init__(filename, numLinks, batchSize)
+        if not resume:
+            with open(str(filename)+'.yaml','w') as fd:
+                yaml.safe_dump({ 'numLinks': numLinks, 'columns': list(self.records.dtype.names) }, fd)
+        self.f = filename.open('ab' if resume else 'wb')
+
+    def writeRecords(self, records):
+        self.f.write(records.tobytes())
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def tell(self):
+        self.flush()
+        return self.f.tell()
+
+    def truncate(self, offset):
+        self.f.truncate(offset)
+        self.f.seek(offset)
+
+    def close(self):
+        super().close()
+        self.f.close()
+
+    """
+    read
+    @param filename impacts .bin file
+    @returns read only record array of the impacts, memory mapped from the file
+    """
+    @staticmethod
+    def read(filename):
+        with open(str(filename)+'.yaml','r') as fd:
+            numLinks = yaml.safe_load(fd)['numLinks']
+        dtype = ImpactsSink.recordDtype(numLinks)
+        if os.path.getsize(filename)==0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r')
+
+################################################################################
+
+"""
+ParquetImpactsSink
+Directory of parquet files, one per flush, named by the number of the first record in them, so a file is either
+all there or not there at all (they're written to a temporary file and renamed), and the position is the number
+of records written
+"""
+class ParquetImpactsSink(ImpactsSink):
+
+    """
+    Constructor
+    @param resume carry on with an existing directory, otherwise a new one is started
+    """
+    def __init__(self, filename, numLinks, batchSize=100, resume=False):
+        super().__init__(filename, numLinks, batchSize)
+        os.makedirs(filename, exist_ok=True)
+        self.written = 0 #records in the parquet files, which ImpactsSink.open sets with truncate when resuming
+        if not resume:
+            self.truncate(0)
+
+    """
+    parts
+    @returns list of the parquet files in the directory, in order
+    """
+    def parts(self):
+        return sorted(glob.glob(os.path.join(str(self.filename),'part_*.parquet')))
+
+    def writeRecords(self, records):
+        partFilename = os.path.join(str(self.filename),'part_{0:012d}.parquet'.format(self.written))
+        pd.DataFrame(records).to_parquet(partFilename+'.tmp', index=False)
+        with open(partFilename+'.tmp','rb') as fd:
+            os.fsync(fd.fileno())
+        os.replace(partFilename+'.tmp', partFilename)
+        self.written += len(records)
+
+    def tell(self):
+        self.flush()
+        return self.written
+
+    def truncate(self, offset):
+        for part in self.parts():
+            if int(os.path.basename(part)[5:17])>=offset:
+                os.remove(part)
+        #end for
+        self.written = offset
+
+################################################################################
@@ -0,0 +1,123 @@
+"""
+CalibrationSolver.py
+Beta update rules for the calibration (SingleOrigin.run), which adjusts the betas until the predicted mean trip
+cost (CBarPred) of every mode matches the observed one (CBarObs) to within the tolerance.
+
+Methods:
+multiplicative - Beta[k] *= CBarPred[k]/CBarObs[k] for every mode still outside the tolerance. This is the
+    original QUANT update, and the reference to check the others against.
+newton - multivariate Newton step using the analytic Jacobian dCBarPred[k]/dBeta[m] from
+    GravityKernel.computeStatistics. The diagonal is minus the predicted trip cost variance of the mode, and the
+    off diagonal terms come from the denominator shared by all the modes. Converges in a handful of passes.
+secant - one dimensional secant step for each mode, from the last two (Beta, CBarPred) pairs, which needs no
+    derivatives. The first step is multiplicative.
+Any step that would take a beta to zero or below is halved until it doesn't.
+
+Every iteration is kept in trace, so the convergence can be logged and checked.
+"""
+
+import numpy as np
+
+class CalibrationSolver:
+
+    Methods = ['multiplicative', 'newton', 'secant']
+
+    """
+    Constructor
+    @param method one of CalibrationSolver.Methods
+    @param tolerance converged when |CBarPred[k]-CBarObs[k]|/CBarObs[k] <= tolerance for every mode
+    @param maxIterations maximum number of beta updates before giving up
+    """
+    def __init__(self, method='multiplicative', tolerance=0.001, maxIterations=1000):
+        if method not in CalibrationSolver.Methods:
+            raise ValueError("CalibrationSolver: unknown method '"+str(method)+"', must be one of "+str(CalibrationSolver.Methods))
+        self.method = method
+        self.tolerance = tolerance
+        self.maxIterations = maxIterations
+        self.reset()
+
+###############################################################################
+
+    """
+    reset
+    Start a new calibration
+    """
+    def reset(self):
+        self.iteration = 0
+        self.trace = [] #one dictionary per iteration with the Beta, CBarPred, CBarObs and delta
+        self.lastBeta = None #for the secant method
+        self.lastError = None
+
+###############################################################################
+
+    """
+    needsJacobian
+    @returns True if step needs the Jacobian of CBarPred with respect to the betas
+    """
+    @property
+    def needsJacobian(self):
+        return self.method=='newton'
+
+###############################################################################
+
+    """
+    step
+    Check for convergence and work out the next betas
+    @param Beta list of the current betas
+    @param CBarPred predicted mean trip cost for each mode with the current betas
+    @param CBarObs observed mean trip cost for each mode
+    @param jacobian numModes x numModes matrix of dCBarPred[k]/dBeta[m], only needed for newton
+    @returns (converged, list of the new betas, which are the same as Beta if converged)
+    """
+    def step(self, Beta, CBarPred, CBarObs, jacobian=None):
+        Beta = np.asarray(Beta,dtype=np.float64)
+        CBarPred = np.asarray(CBarPred,dtype=np.float64)
+        CBarObs = np.asarray(CBarObs,dtype=np.float64)
+        error = CBarPred-CBarObs
+        delta = np.fabs(error)
+        self.trace.append({
+            'iteration': self.iteration, 'Beta': [ float(b) for b in Beta ],
+            'CBarPred': [ float(c) for c in CBarPred ], 'CBarObs': [ float(c) for c in CBarObs ],
+            'delta': [ float(d) for d in delta ]
+        })
+        outside = delta/CBarObs > self.tolerance
+        if not np.any(outside):
+            return True, list(Beta)
+        self.iteration+=1
+
+        if self.method=='multiplicative':
+            newBeta = np.where(outside, Beta*CBarPred/CBarObs, Beta)
+        else:
+            change = Beta*CBarPred/CBarObs-Beta #multiplicative, unless there is something better below
+            if self.method=='newton':
+                try:
+                    change = np.linalg.solve(jacobian, -error)
+                except np.linalg.LinAlgError:
+                    pass #singular, so it's a multiplicative step
+            elif self.method=='secant' and self.lastBeta is not None:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    slope = (error-self.lastError)/(Beta-self.lastBeta)
+                ok = np.isfinite(slope) & (slope!=0.0)
+                change[ok] = -error[ok]/slope[ok]
+            #end if
+            if self.method=='secant':
+                change[~outside] = 0.0 #the secant is one mode at a time, so modes within tolerance are left alone
+            newBeta = Beta+change
+            while np.any(newBeta<=0.0):
+                change = np.where(newBeta<=0.0, change/2.0, change)
+                newBeta = Beta+change
+        #end if
+        self.lastBeta = Beta
+        self.lastError = error
+        return False, list(newBeta)
+
+###############################################################################
+
+    """
+    isFinished
+    @returns True if the maximum number of iterations has been reached
+    """
+    def isFinished(self):
+        return self.iteration>=self.maxIterations
+
+###############################################################################
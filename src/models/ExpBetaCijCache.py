@@ -0,0 +1,86 @@
+"""
+ExpBetaCijCache.py
+Persistent store of the exponentiated cost matrices exp(-Beta[k]*Cij[k]) for a SingleOrigin model.
+
+Each mode is built once from the baseline Cij and kept until that mode's beta (or the model precision)
+changes, when it is rebuilt automatically. Scenarios then patch only the cells which the network
+changes altered and restore them afterwards, instead of doing full N x N exp passes every run.
+NOTE: the cache is keyed on beta only, so if you replace the baseline Cij matrices with different
+data, then you need to call invalidate().
+"""
+
+import numpy as np
+
+class ExpBetaCijCache:
+
+    def __init__(self):
+        self.expBetaCij = [] #one N x N matrix per mode
+        self.betas = [] #beta that each mode's matrix was built with, None if not built
+        self.dtypes = [] #precision that each mode's matrix was built with
+        self.undo = [] #list of (k, rows, cols, oldValues) to put back in restore()
+
+###############################################################################
+
+    """
+    get
+    Return the list of exp(-Beta[k]*Cij[k]) matrices for the model, building any modes which are
+    missing or whose beta has changed since they were built.
+    PRE: model.Cij must be the baseline Cij if any modes need building
+    @param model the SingleOrigin model which owns this cache
+    @returns list of N x N matrices, one per mode (NOTE: these are the cache's own matrices)
+    """
+    def get(self, model):
+        while len(self.expBetaCij)<model.numModes:
+            self.expBetaCij.append(None)
+            self.betas.append(None)
+            self.dtypes.append(None)
+        for k in range(0,model.numModes):
+            if self.betas[k]!=model.Beta[k] or self.dtypes[k]!=model.dtype:
+                if self.undo:
+                    raise RuntimeError("ExpBetaCijCache: beta changed while scenario patches are applied")
+                self.expBetaCij[k] = model.computeExpBetaCij(k)
+                self.betas[k] = model.Beta[k]
+                self.dtypes[k] = model.dtype
+        return self.expBetaCij
+
+###############################################################################
+
+    """
+    invalidate
+    Throw away all the cached matrices, so the next get() rebuilds everything.
+    """
+    def invalidate(self):
+        self.expBetaCij = []
+        self.betas = []
+        self.dtypes = []
+        self.undo = []
+
+###############################################################################
+
+    """
+    patch
+    Overwrite a set of cells in one mode with exp(-beta*Cij) of their new costs, keeping the old values
+    so that restore() can put them back.
+    @param k mode number
+    @param rows int array of row (origin) numbers
+    @param cols int array of column (destination) numbers matching rows
+    @param CijValues the new costs for those cells
+    """
+    def patch(self, k, rows, cols, CijValues):
+        e = self.expBetaCij[k]
+        self.undo.append((k, rows, cols, e[rows, cols].copy()))
+        newValues = np.multiply(CijValues, -self.betas[k], dtype=e.dtype)
+        e[rows, cols] = np.exp(newValues)
+
+###############################################################################
+
+    """
+    restore
+    Undo all patches since the last restore, in reverse order, which takes the cache back to the baseline.
+    """
+    def restore(self):
+        while self.undo:
+            (k, rows, cols, oldValues) = self.undo.pop()
+            self.expBetaCij[k][rows, cols] = oldValues
+
+###############################################################################
@@ -0,0 +1,282 @@
+"""
+GravityKernel.py
+Shared vectorised kernel for the QUANT gravity model, used by all of the SingleOrigin entry points.
+
+Tij[k] = B[j] * Oi[i] * Dj[j] * exp(-Beta[k]*Cij[k]) / denom[i]
+where denom[i] = sum_kk sum_j Dj[j] * exp(-Beta[kk]*Cij[kk])
+
+The denominator is shared by all the modes, so it only needs to be computed once per model pass
+(one matrix vector product per mode), rather than once per mode and origin. The predicted matrices are
+then just a broadcast of a row factor and a column factor over exp(-Beta*Cij).
+Everything works in row tiles, so the float64 temporaries are bounded to tileRows x N elements,
+whatever the precision of the N x N matrices.
+"""
+
+import numpy as np
+
+class GravityKernel:
+
+    """
+    computeDenominators
+    Compute the all mode denominator vector for every origin zone.
+    @param expBetaCij list of N x N exp(-Beta[k]*Cij[k]) matrices, one per mode
+    @param Dj destination totals vector (N)
+    @param tileRows number of rows processed in one block, or None for the whole matrix at once
+    @returns float64 vector (N) denom[i] = sum_k sum_j Dj[j]*expBetaCij[k][i,j]
+    """
+    @staticmethod
+    def computeDenominators(expBetaCij, Dj, tileRows=None):
+        (M, N) = np.shape(expBetaCij[0])
+        Dj64 = np.asarray(Dj,dtype=np.float64)
+        denom = np.zeros(M)
+        for r0, r1 in GravityKernel.tiles(M,tileRows):
+            for e in expBetaCij:
+                denom[r0:r1] += np.dot(e[r0:r1],Dj64) #float32 tiles are upcast here, so this always accumulates in float64
+        return denom
+
+###############################################################################
+
+    """
+    computePredicted
+    Build the predicted trips matrices for all modes from a denominator vector.
+    @param expBetaCij list of N x N exp(-Beta[k]*Cij[k]) matrices, one per mode
+    @param Oi origin totals vector (N)
+    @param Dj destination totals vector (N)
+    @param B constraints weights vector (N), all 1.0 if not using constraints
+    @param denom denominator vector from computeDenominators
+    @param dtype precision of the returned matrices
+    @param tileRows number of rows processed in one block, or None for the whole matrix at once
+    @param out optional list of N x N matrices to write the results into, otherwise new ones are made
+    @returns list of N x N TPred matrices, one per mode
+    """
+    @staticmethod
+    def computePredicted(expBetaCij, Oi, Dj, B, denom, dtype=np.float64, tileRows=None, out=None):
+        (M, N) = np.shape(expBetaCij[0])
+        rowFactor = np.asarray(Oi,dtype=np.float64)/denom
+        colFactor = np.asarray(B,dtype=np.float64)*np.asarray(Dj,dtype=np.float64)
+        if out is None:
+            out = [np.empty((M, N),dtype=dtype) for k in range(0,len(expBetaCij))]
+        for k in range(0,len(expBetaCij)):
+            for r0, r1 in GravityKernel.tiles(M,tileRows):
+                tile = expBetaCij[k][r0:r1]*colFactor
+                tile *= rowFactor[r0:r1,np.newaxis]
+                out[k][r0:r1] = tile
+        return out
+
+###############################################################################
+
+    """
+    streamPredicted
+    Same as computePredicted, but each row tile of the predicted matrices is passed to sink as soon as it's
+    computed, instead of being kept, so the N x N matrices are never built (see ImpactAccumulator).
+    @param sink function(k, rows, tile) called with the mode, the slice of the rows and the tile in dtype precision
+    @returns nothing
+    """
+    @staticmethod
+    def streamPredicted(expBetaCij, Oi, Dj, B, denom, sink, dtype=np.float64, tileRows=None):
+        (M, N) = np.shape(expBetaCij[0])
+        rowFactor = np.asarray(Oi,dtype=np.float64)/denom
+        colFactor = np.asarray(B,dtype=np.float64)*np.asarray(Dj,dtype=np.float64)
+        for k in range(0,len(expBetaCij)):
+            for r0, r1 in GravityKernel.tiles(M,tileRows):
+                tile = expBetaCij[k][r0:r1]*colFactor
+                tile *= rowFactor[r0:r1,np.newaxis]
+                sink(k, slice(r0,r1), tile.astype(dtype,copy=False)) #the same values as a TPred of that precision
+
+###############################################################################
+
+    """
+    run
+    One complete model pass: denominators, then predicted matrices for all the modes.
+    @returns (TPred list, denom vector)
+    """
+    @staticmethod
+    def run(expBetaCij, Oi, Dj, B, dtype=np.float64, tileRows=None, out=None):
+        denom = GravityKernel.computeDenominators(expBetaCij, Dj, tileRows)
+        TPred = GravityKernel.computePredicted(expBetaCij, Oi, Dj, B, denom, dtype, tileRows, out)
+        return TPred, denom
+
+###############################################################################
+
+    """
+    computeRows
+    Recompute a subset of rows (origins) of the predicted matrices for all modes. This is everything an
+    origin row needs, as the denominator for origin i only depends on row i of exp(-Beta*Cij).
+    @param expBetaCijRows list of len(rows) x N arrays of the rows of exp(-Beta[k]*Cij[k]), one per mode
+    @param Oi origin totals vector (N)
+    @param Dj destination totals vector (N)
+    @param B constraints weights vector (N)
+    @param rows int array of the row numbers to compute
+    @param dtype precision of the returned rows
+    @param tileRows number of rows processed in one block, or None for all the rows at once
+    @returns (list of len(rows) x N arrays one per mode, float64 denominator vector for the rows)
+    """
+    @staticmethod
+    def computeRows(expBetaCijRows, Oi, Dj, B, rows, dtype=np.float64, tileRows=None):
+        rows = np.asarray(rows,dtype=np.int64)
+        Dj64 = np.asarray(Dj,dtype=np.float64)
+        colFactor = np.asarray(B,dtype=np.float64)*Dj64
+        Oi64 = np.asarray(Oi,dtype=np.float64)
+        (M, N) = np.shape(expBetaCijRows[0])
+        values = [np.empty((len(rows), N),dtype=dtype) for k in range(0,len(expBetaCijRows))]
+        denom = np.zeros(len(rows))
+        for r0, r1 in GravityKernel.tiles(len(rows),tileRows):
+            eRows = [e[r0:r1] for e in expBetaCijRows]
+            for e in eRows:
+                denom[r0:r1] += np.dot(e,Dj64)
+            rowFactor = Oi64[rows[r0:r1]]/denom[r0:r1]
+            for k in range(0,len(expBetaCijRows)):
+                tile = eRows[k]*colFactor
+                tile *= rowFactor[:,np.newaxis]
+                values[k][r0:r1] = tile
+        return values, denom
+
+###############################################################################
+
+    """
+    computeStatistics
+    Matrix free model pass for calibration, which works out everything the calibration needs from the predicted
+    matrices without building them, a tile of rows at a time. With rowFactor[i] = Oi[i]/denom[i] and
+    colFactor[j] = B[j]*Dj[j], so that Tij[k][i,j] = rowFactor[i]*colFactor[j]*expBetaCij[k][i,j]:
+    trips[k] = sum_ij Tij[k][i,j], costs[k] = sum_ij Tij[k][i,j]*Cij[k][i,j], so CBarPred[k] = costs[k]/trips[k]
+    colSums[j] = sum_k sum_i Tij[k][i,j], which is the predicted Dj for the constraints
+    and optionally the Jacobian J[k,m] = dCBarPred[k]/dBeta[m] (B fixed) for a Newton step. As
+    d(expBetaCij[m])/dBeta[m] = -Cij[m]*expBetaCij[m], and denom[i] depends on every mode:
+    J[k,m] = ( sum_i rowFactor[i]*SC[m][i]/denom[i]*(W[k][i]-CBarPred[k]*A[k][i]) ) / trips[k]
+        - [k==m] * ( sum_ij Tij[k][i,j]*Cij[k][i,j]^2/trips[k] - CBarPred[k]^2 )
+    where A[k][i], W[k][i] are the rows of Tij[k] and Tij[k]*Cij[k] summed without rowFactor, and
+    SC[m][i] = sum_j Dj[j]*Cij[m][i,j]*expBetaCij[m][i,j]. The k==m term is the variance of the trip costs.
+    @param expBetaCij list of N x N exp(-Beta[k]*Cij[k]) matrices, one per mode
+    @param Cij list of N x N cost matrices, one per mode
+    @param Oi origin totals vector (N)
+    @param Dj destination totals vector (N)
+    @param B constraints weights vector (N), all 1.0 if not using constraints
+    @param tileRows number of rows processed in one block, or None for the whole matrix at once
+    @param jacobian also compute the Jacobian
+    @returns (denom vector (N), trips vector (modes), costs vector (modes), colSums vector (N)), all float64,
+    plus the Jacobian (modes x modes) on the end if jacobian is True
+    """
+    @staticmethod
+    def computeStatistics(expBetaCij, Cij, Oi, Dj, B, tileRows=None, jacobian=False):
+        (M, N) = np.shape(expBetaCij[0])
+        numModes = len(expBetaCij)
+        Dj64 = np.asarray(Dj,dtype=np.float64)
+        Oi64 = np.asarray(Oi,dtype=np.float64)
+        colFactor = np.asarray(B,dtype=np.float64)*Dj64
+        denom = np.zeros(M)
+        trips = np.zeros(numModes)
+        costs = np.zeros(numModes)
+        colSums = np.zeros(N)
+        costs2 = np.zeros(numModes) #sum of Tij*Cij^2 for the jacobian
+        dTrips = np.zeros((numModes,numModes)) #the denominator part of dtrips[k]/dBeta[m]
+        dCosts = np.zeros((numModes,numModes)) #and dcosts[k]/dBeta[m]
+        for r0, r1 in GravityKernel.tiles(M,tileRows):
+            eTiles = [e[r0:r1] for e in expBetaCij]
+            for e in eTiles:
+                denom[r0:r1] += np.dot(e,Dj64)
+            rowFactor = Oi64[r0:r1]/denom[r0:r1]
+            A = []
+            W = []
+            SC = []
+            for k in range(0,numModes):
+                eC = eTiles[k]*Cij[k][r0:r1]
+                A.append(np.dot(eTiles[k],colFactor))
+                W.append(np.dot(eC,colFactor))
+                trips[k] += np.dot(rowFactor,A[k])
+                costs[k] += np.dot(rowFactor,W[k])
+                colSums += np.dot(rowFactor,eTiles[k])
+                if jacobian:
+                    SC.append(np.dot(eC,Dj64))
+                    eC *= Cij[k][r0:r1]
+                    costs2[k] += np.dot(rowFactor,np.dot(eC,colFactor))
+            #end for k
+            if jacobian:
+                for m in range(0,numModes):
+                    g = rowFactor*SC[m]/denom[r0:r1]
+                    for k in range(0,numModes):
+                        dTrips[k,m] += np.dot(g,A[k])
+                        dCosts[k,m] += np.dot(g,W[k])
+        #end for tiles
+        colSums *= colFactor
+        if not jacobian:
+            return denom, trips, costs, colSums
+        CBar = costs/trips
+        J = (dCosts-CBar[:,np.newaxis]*dTrips)/trips[:,np.newaxis]
+        J -= np.diag(costs2/trips-CBar*CBar)
+        return denom, trips, costs, colSums, J
+
+###############################################################################
+
+    """
+    computeColumnFactors
+    Column sums of the predicted matrices over all the modes without the B weights, for balancing the constraints.
+    As denom[i] doesn't depend on B, the predicted destination totals for any B weights are then just
+    DjPred[j] = B[j]*Dj[j]*G[j], so the constraints can be balanced on vectors without another model pass.
+    @param expBetaCij list of N x N exp(-Beta[k]*Cij[k]) matrices, one per mode
+    @param Oi origin totals vector (N)
+    @param Dj destination totals vector (N)
+    @param tileRows number of rows processed in one block, or None for the whole matrix at once
+    @returns (denom vector (N), G vector (N)) G[j] = sum_k sum_i Oi[i]/denom[i]*expBetaCij[k][i,j], both float64
+    """
+    @staticmethod
+    def computeColumnFactors(expBetaCij, Oi, Dj, tileRows=None):
+        (M, N) = np.shape(expBetaCij[0])
+        Dj64 = np.asarray(Dj,dtype=np.float64)
+        Oi64 = np.asarray(Oi,dtype=np.float64)
+        denom = np.zeros(M)
+        G = np.zeros(N)
+        for r0, r1 in GravityKernel.tiles(M,tileRows):
+            eTiles = [e[r0:r1] for e in expBetaCij]
+            for e in eTiles:
+                denom[r0:r1] += np.dot(e,Dj64)
+            rowFactor = Oi64[r0:r1]/denom[r0:r1]
+            for e in eTiles:
+                G += np.dot(rowFactor,e)
+        return denom, G
+
+###############################################################################
+
+    """
+    computeRowStatistics
+    Per origin sufficient statistics of one mode at one beta, from which the denominators, trip totals and
+    CBar of any combination of betas can be worked out without building the predicted matrices (see
+    sweepcalibrate). With e = exp(-Beta*Cij) in the model's precision, like computeExpBetaCij:
+    S[i] = sum_j Dj[j]*e[i,j] and W[i] = sum_j Dj[j]*Cij[i,j]*e[i,j]
+    @param Cij N x N cost matrix for the mode
+    @param Dj destination totals vector (N), multiplied by B if using B weights
+    @param Beta beta for the mode
+    @param dtype precision of exp(-Beta*Cij)
+    @param tileRows number of rows processed in one block, or None for the whole matrix at once
+    @returns (S, W) float64 vectors (N)
+    """
+    @staticmethod
+    def computeRowStatistics(Cij, Dj, Beta, dtype=np.float64, tileRows=None):
+        (M, N) = np.shape(Cij)
+        Dj64 = np.asarray(Dj,dtype=np.float64)
+        S = np.zeros(M)
+        W = np.zeros(M)
+        for r0, r1 in GravityKernel.tiles(M,tileRows):
+            C = Cij[r0:r1]
+            e = np.multiply(C,-dtype(Beta),dtype=dtype)
+            np.exp(e,out=e)
+            S[r0:r1] = np.dot(e,Dj64)
+            e *= C
+            W[r0:r1] = np.dot(e,Dj64)
+        return S, W
+
+###############################################################################
+
+    """
+    tiles
+    Generator for the (start,end) row ranges of blocks of tileRows rows.
+    @param M number of rows
+    @param tileRows rows per block, None or <=0 for one block of all M rows
+    """
+    @staticmethod
+    def tiles(M, tileRows):
+        if not tileRows or tileRows<=0:
+            tileRows = max(M,1)
+        for r0 in range(0,M,tileRows):
+            yield r0, min(r0+tileRows,M)
+
+###############################################################################
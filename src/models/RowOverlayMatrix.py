@@ -0,0 +1,84 @@
+"""
+RowOverlayMatrix.py
+An N x N matrix presented as a baseline matrix plus a small set of replaced rows.
+
+This is what an incremental scenario run produces for TPred: a network change at cell (i,j) only changes
+the denominator of origin i, so only the rows which APSP touched are different from the baseline TPred.
+The baseline is shared, never copied, and the aggregates needed for the impacts can be computed from
+the baseline aggregates plus the differences in the replaced rows.
+"""
+
+import numpy as np
+
+class RowOverlayMatrix:
+
+    """
+    Constructor
+    @param base N x N baseline matrix, which is shared and never written to
+    @param rows sorted unique int array of the row numbers which are replaced
+    @param values len(rows) x N array of the replacement rows
+    """
+    def __init__(self, base, rows, values):
+        self.base = base
+        self.rows = np.asarray(rows,dtype=np.int64)
+        self.values = values
+
+    @property
+    def shape(self):
+        return np.shape(self.base)
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+###############################################################################
+
+    """
+    deltaSum
+    Sum of (overlay - base), optionally weighted, which only needs the replaced rows.
+    e.g. total = baseTotal + deltaSum() or distance = baseDistance + deltaSum(dijKM)
+    @param weights optional N x N matrix to weight the differences by
+    @returns float64 sum of the differences
+    """
+    def deltaSum(self, weights=None):
+        diff = self.values.astype(np.float64) - self.base[self.rows]
+        if weights is not None:
+            diff *= weights[self.rows]
+        return float(np.sum(diff))
+
+###############################################################################
+
+    """
+    sum
+    Same as numpy sum for axis=None, 0 or 1, but without materialising the matrix.
+    NOTE: this is still a full pass over the baseline, use deltaSum if the baseline sums are already known.
+    """
+    def sum(self, axis=None, dtype=np.float64):
+        if axis is None:
+            return np.sum(self.base, dtype=dtype) + self.deltaSum()
+        elif axis==0 or axis==-2:
+            return np.sum(self.base, axis=0, dtype=dtype) + np.sum(self.values.astype(np.float64) - self.base[self.rows], axis=0)
+        elif axis==1 or axis==-1:
+            result = np.sum(self.base, axis=1, dtype=dtype)
+            result[self.rows] = np.sum(self.values, axis=1, dtype=dtype)
+            return result
+        raise ValueError("RowOverlayMatrix.sum: axis must be None, 0 or 1")
+
+###############################################################################
+
+    """
+    materialise
+    @returns a new dense N x N copy of the matrix with the rows applied
+    """
+    def materialise(self):
+        result = np.array(self.base)
+        result[self.rows] = self.values
+        return result
+
+    def __array__(self, dtype=None, copy=None):
+        result = self.materialise()
+        if dtype is not None:
+            result = result.astype(dtype)
+        return result
+
+###############################################################################
@@ -0,0 +1,101 @@
+"""
+ScenarioOverlay.py
+Copy on write view of the baseline Cij matrices for running scenarios, which replaces copying all the
+Cij matrices before every scenario.
+
+Each mode's Cij is presented as the baseline matrix until a scenario first needs to write to it, when a
+scratch copy of that mode is made (once only, not once per scenario). Every cell that a scenario changes
+is logged, so reset() only has to put the baseline values back into those cells, which takes time in
+proportion to the size of the change, rather than an N x N copy of every mode.
+The scenario TPred is the same idea by rows, see RowOverlayMatrix and SingleOrigin.runWithChanges
+(incremental=True).
+
+Usage (see the RUN loop in pyquant3):
+    overlay = ScenarioOverlay(qm3_base.Cij)
+    for each scenario:
+        overlay.reset()
+        qm3 = copy.copy(qm3_base)
+        qm3.runWithChanges(OiDjHash, networkChanges, False, True, overlay)
+        impacts.compute(qm3_base, qm3, dijKM, networkChanges, overlay)
+"""
+
+import numpy as np
+
+class ScenarioOverlay:
+
+    """
+    Constructor
+    @param baseCij list of N x N baseline cost matrices, one per mode, which are never written to
+    """
+    def __init__(self, baseCij):
+        self.baseCij = list(baseCij)
+        self.scratch = [ None for k in range(0,len(self.baseCij)) ] #writable copy of each mode, made on first write
+        self.cells = [ [] for k in range(0,len(self.baseCij)) ] #list of (rows, cols) arrays changed on each mode
+
+###############################################################################
+
+    """
+    Cij
+    @returns list of the current scenario Cij matrices, which is the scratch copy for any mode that has
+    been written to and the baseline for the rest (NOTE: don't write into these, use writable)
+    """
+    @property
+    def Cij(self):
+        return [ self.baseCij[k] if self.scratch[k] is None else self.scratch[k] for k in range(0,len(self.baseCij)) ]
+
+###############################################################################
+
+    """
+    writable
+    @param k mode number
+    @returns the scratch Cij matrix for mode k, which can be changed in place, as long as every cell which
+    is changed is passed to record
+    """
+    def writable(self, k):
+        if self.scratch[k] is None:
+            self.scratch[k] = np.array(self.baseCij[k]) #a writable copy, even if the baseline is memory mapped
+        return self.scratch[k]
+
+###############################################################################
+
+    """
+    record
+    Log cells of mode k which have been changed in the scratch matrix, so reset can put them back.
+    Duplicate cells are fine.
+    @param k mode number
+    @param rows int array of row numbers
+    @param cols int array of column numbers matching rows
+    """
+    def record(self, k, rows, cols):
+        self.cells[k].append((np.asarray(rows,dtype=np.int64), np.asarray(cols,dtype=np.int64)))
+
+###############################################################################
+
+    """
+    changedCells
+    @param k mode number
+    @returns (rows, cols) int arrays of the distinct cells logged on mode k since the last reset, in row major order
+    """
+    def changedCells(self, k):
+        if not self.cells[k]:
+            return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64)
+        (M, N) = np.shape(self.baseCij[k])
+        rows = np.concatenate([ c[0] for c in self.cells[k] ])
+        cols = np.concatenate([ c[1] for c in self.cells[k] ])
+        idx = np.unique(rows*N+cols)
+        return idx//N, idx%N
+
+###############################################################################
+
+    """
+    reset
+    Put the baseline values back into every cell that was changed since the last reset, so that Cij is the
+    baseline again. The scratch matrices are kept for the next scenario.
+    """
+    def reset(self):
+        for k in range(0,len(self.baseCij)):
+            for (rows, cols) in self.cells[k]:
+                self.scratch[k][rows, cols] = self.baseCij[k][rows, cols]
+            self.cells[k] = []
+
+###############################################################################
@@ -6,6 +6,11 @@ import time
 import copy
 
 from networks.ModifiedZonesAPSP import ModifiedZonesAPSP
+from networks.NetworkChangeLedger import NetworkChangeLedger
+from models.GravityKernel import GravityKernel
+from models.ExpBetaCijCache import ExpBetaCijCache
+from models.RowOverlayMatrix import RowOverlayMatrix
+from models.CalibrationSolver import CalibrationSolver
 
 
 """
@@ -31,6 +36,22 @@ class SingleOrigin:
         self.CBarObs=[] #average trip time minutes (mode) observed
         self.CBarPred=[] #average trip time minutes (mode) predicted
 
+        #precision policy - float32 keeps TObs, Cij, TPred and expBetaCij in single precision, while the
+        #denominators, marginals and CBar sums are always accumulated in float64 (see docs/precision.md)
+        self.dtype=np.float64
+        self.tileRows=256 #rows per block in the GravityKernel, which bounds the size of the float64 temporaries
+        self.expBetaCijCache=ExpBetaCijCache() #exp(-Beta[k]*Cij[k]) built once from the baseline and rebuilt if Beta changes
+        self.OiObs=None #observed origin totals (all modes), cached by computeObservedMarginals
+        self.DjObs=None #observed destination totals (all modes), cached by computeObservedMarginals
+        self.DjCons=None #predicted baseline destination totals (all modes), cached by computeBaselineDj for the constraints
+        self.calibrationSolver=CalibrationSolver() #beta update rule for run, which keeps the trace of the last calibration
+        self.calibrationConverged=False #set by run
+        self.constraintsMaxIterations=100 #cap on the balancing rounds of the B weights for each model pass
+        self.constraintsConverged=True #False if the last run or runWithChanges hit constraintsMaxIterations
+        self.changeLedger=None #NetworkChangeLedger of the Cij cells changed by the last runWithChanges
+        self.TPredParams=None #(TPred, Beta, B) that the baseline TPred was built with, see recordPredictedParams
+        self.baselineTotals=None #(TPred and Lij, ImpactAccumulator of their totals), see ImpactStatistics.getBaselineTotals
+
     """
     calculateCBar
     Mean trips calculation
@@ -51,8 +72,8 @@ class SingleOrigin:
         #CBar = CNumerator / CDenominator
         #print("CBar=",CBar)
         #faster
-        CNumerator2 = np.sum(Tij*cij)
-        CDenominator2 = np.sum(Tij)
+        CNumerator2 = np.sum(Tij*cij,dtype=np.float64) #always accumulate in double, even in float32 mode
+        CDenominator2 = np.sum(Tij,dtype=np.float64)
         CBar2=CNumerator2/CDenominator2
         #print("CBar2=",CBar2)
         #cupy example
@@ -72,14 +93,17 @@ class SingleOrigin:
     def deepcopy(self):
         qm3 = SingleOrigin()
         qm3.numModes = self.numModes
+        qm3.dtype = self.dtype
+        qm3.tileRows = self.tileRows
         qm3.isUsingConstraints = self.isUsingConstraints
+        qm3.constraintsMaxIterations = self.constraintsMaxIterations
         qm3.constraints = copy.deepcopy(self.constraints)
         qm3.Beta = copy.deepcopy(self.Beta)
         #qm3.Beta = [ self.Beta[k] for k in range(0,self.numModes) ]
         #b = np.array(a, copy=True) or b = np.copy(a) ???
         #qm3.TObs = copy.deepcopy(self.TObs)
         #qm3.TObs = [ np.array(self.TObs[k],copy=True) for k in range(0,self.numModes) ]
-        qm3.TObs = [ np.copy(self.TObs[k]) for k in range(0,self.numModes) ]
+        qm3.TObs = [ np.copy(self.TObs[k]) for k in range(0,len(self.TObs)) ] #TObs can be released, see releaseObserved
         #qm3.TObs = [deepcopyarray(self.TObs[k]) for k in range(0,self.numModes)]
         #qm3.TPred = copy.deepcopy(self.TPred)
         #qm3.TPred = [ np.array(self.TPred[k],copy=True) for k in range(0,self.numModes) ]
@@ -99,8 +123,91 @@ class SingleOrigin:
         #    qm3.Cij[k] = np.copy(self.Cij[k])
         
         qm3.B = copy.deepcopy(self.B)
+        qm3.OiObs = copy.deepcopy(self.OiObs)
+        qm3.DjObs = copy.deepcopy(self.DjObs)
+        qm3.DjCons = copy.deepcopy(self.DjCons)
+        qm3.calibrationSolver = copy.deepcopy(self.calibrationSolver)
+        if self.isPredictedCurrent():
+            qm3.TPredParams = (list(qm3.TPred), list(self.TPredParams[1]), np.copy(self.TPredParams[2]))
         return qm3
 
+###############################################################################
+
+    """
+    computeExpBetaCij
+    Pre-calculate exp(-Beta[k]*Cij[k]) for one mode in the model's precision (self.dtype).
+    The beta is cast to self.dtype first, otherwise a numpy float64 beta would silently
+    promote a float32 Cij to a float64 result.
+    @param k mode number
+    @returns NDArray exp(-Beta[k]*Cij[k])
+    """
+    def computeExpBetaCij(self,k):
+        expBetaCij = np.multiply(self.Cij[k],-self.Beta[k],dtype=self.dtype)
+        np.exp(expBetaCij,out=expBetaCij)
+        return expBetaCij
+
+###############################################################################
+
+    """
+    computeExpBetaCijRows
+    Same as computeExpBetaCij, but only for a set of rows, which gives exactly the same values as the
+    same rows of the full matrix.
+    @param k mode number
+    @param rows int array of the row numbers
+    @returns NDArray (len(rows) x N) exp(-Beta[k]*Cij[k][rows])
+    """
+    def computeExpBetaCijRows(self,k,rows):
+        expBetaCij = np.multiply(self.Cij[k][rows],-self.Beta[k],dtype=self.dtype)
+        np.exp(expBetaCij,out=expBetaCij)
+        return expBetaCij
+
+###############################################################################
+
+    """
+    computeObservedMarginals
+    Origin and destination totals of TObs summed over all the modes. These are computed once and cached
+    on the model, so scenario runs don't need TObs at all once they have been set.
+    NOTE: set OiObs and DjObs back to None if you change TObs, or pass refresh=True.
+    @param refresh sum TObs again, even if the marginals are already cached
+    @returns (OiObs, DjObs) float64 vectors (N) - NOTE: these are the cached vectors, so copy before changing them
+    """
+    def computeObservedMarginals(self, refresh=False):
+        if refresh or self.OiObs is None or self.DjObs is None:
+            self.OiObs = sum([ self.TObs[k].sum(axis=1,dtype=np.float64) for k in range(0,self.numModes) ])
+            self.DjObs = sum([ self.TObs[k].sum(axis=0,dtype=np.float64) for k in range(0,self.numModes) ])
+        return self.OiObs, self.DjObs
+
+###############################################################################
+
+    """
+    computeBaselineDj
+    Predicted destination totals of the baseline model (all modes) with the calibrated B weights, which are the
+    limits that runWithChanges holds the constrained zones to. These come from the column factors, so the baseline
+    TPred isn't needed, and they are computed once and cached on the model, like the observed marginals.
+    NOTE: set DjCons back to None if you change Beta, B or the baseline Cij. Compute this on the baseline model
+    before making copies of it for the scenarios, so they all share it.
+    @returns float64 vector (N) DjCons[j] = sum_k sum_i TPred[k][i,j]
+    """
+    def computeBaselineDj(self):
+        if self.DjCons is None:
+            OiObs, DjObs = self.computeObservedMarginals()
+            denom, G = GravityKernel.computeColumnFactors(self.expBetaCijCache.get(self), OiObs, DjObs, self.tileRows)
+            self.DjCons = np.asarray(self.B,dtype=np.float64)*DjObs*G
+        return self.DjCons
+
+###############################################################################
+
+    """
+    releaseObserved
+    Drop TObs once the model has been calibrated, as the scenario runs only need the cached marginals (and DjCons
+    if using constraints), which saves three N x N matrices. run and fastComputePredicted need TObs back.
+    """
+    def releaseObserved(self):
+        self.computeObservedMarginals()
+        if self.isUsingConstraints:
+            self.computeBaselineDj()
+        self.TObs = []
+
 
 ###############################################################################
 
@@ -166,44 +273,18 @@ class SingleOrigin:
     def fastComputePredicted(self):
         (M, N) = np.shape(self.TObs[0])
         
-        #Oi obs
-        ksum=np.array([np.zeros(N),np.zeros(N),np.zeros(N)])
-        for k in range(0,self.numModes):
-            ksum[k]=self.TObs[k].sum(axis=1)
-        OiObs = ksum.sum(axis=0)
-
-        #Dj obs
-        ksum=np.array([np.zeros(N),np.zeros(N),np.zeros(N)])
-        for k in range(0,self.numModes):
-            ksum[k]=self.TObs[k].sum(axis=0)
-        DjObs = ksum.sum(axis=0)
+        #Oi obs and Dj obs, which are cached for the scenario runs
+        OiObs, DjObs = self.computeObservedMarginals(refresh=True)
+        self.DjCons = None #computeBaselineDj works this out from the new betas if it's needed
 
-        #constraints initialisation
-        B = [1.0 for i in range(0,N)] #hack
-        Z = [0.0 for i in range(0,N)]
-        for j in range(0,N):
-            Z[j] = 1.7976931348623157e+308 #float_info.max
-            if self.isUsingConstraints:
-                if self.constraints[j] >= 1.0: #constraints array taking place of Gj (Green Belt) in documentation
-                    #Gj=1 means 0.8 of MSOA land is green belt, so can't be built on
-                    #set constraint to original Dj
-                    Z[j] = DjObs[j]
-        #end of constraints initialisation - have now set B[] and Z[] based on IsUsingConstraints, Constraints[] and DObs[]
+        #constraints - the B weights come from the calibration (or Constraints_B), otherwise they are all 1.0
+        B = self.B if self.isUsingConstraints else np.ones(N)
 
         #pre-calculate exp(-Beta[k]*self.Cij[k]) for speed
-        expBetaCij = [np.exp(-self.Beta[k]*self.Cij[k]) for k in range(0,self.numModes)]
-        self.TPred = [np.zeros(N*N).reshape(N, N) for k in range(0,self.numModes) ]
-        for k in range(0,self.numModes): #mode loop
-            for i in range(0,N):
-                denom2=0.0
-                for kk in range(0,self.numModes):
-                    denom2+=np.sum(DjObs*expBetaCij[kk][i,:])
-
-                #numerator calculation for this mode (k)
-                Tijk2=OiObs[i]*(B*DjObs*expBetaCij[k][i]/denom2)
-                self.TPred[k][i,:]=Tijk2 #put answer slice back in return array 
-            #end for i
-        #end for k
+        expBetaCij = self.expBetaCijCache.get(self)
+        #the denominator is shared by all modes, so it's computed once, then broadcast into each mode's TPred
+        self.TPred, denom = GravityKernel.run(expBetaCij, OiObs, DjObs, B, self.dtype, self.tileRows)
+        self.recordPredictedParams(B)
     #end def
 
 ###############################################################################
@@ -213,133 +294,74 @@ class SingleOrigin:
     Calibrate model - yes, I know, but it was always called "run" for some reason
     and it's stuck. It's really calibrate, but you have to run the model over
     and over again while you tune the betas, so I guess it's run.
+    The beta iterations don't build the predicted matrices (see GravityKernel.computeStatistics), TPred is
+    only built once at the end from the converged betas.
+    POST: Beta, B, CBarObs, CBarPred and TPred all set
+    @param initialBeta optional list of betas to start from, e.g. from a previous calibration, otherwise 1.0
+    @param initialB optional B weights (N) to start the constraints from, otherwise 1.0
     @returns nothing
     """
-    @jit(nopython=True)
-    def run(self):
+    def run(self, initialBeta=None, initialB=None):
         (M, N) = np.shape(self.TObs[0])
         
-        #set up Beta for modes 0, 1 and 2 to 1.0f
-        self.Beta = [1.0 for k in range(0,self.numModes)]
+        #set up Beta for modes 0, 1 and 2 to 1.0f, unless it's a warm start
+        self.Beta = [1.0 for k in range(0,self.numModes)] if initialBeta is None else list(initialBeta)
 
         #work out Dobs and Tobs from rows and columns of TObs matrix
-        #These don't ever change so they need to be outside the convergence loop
-        DjObs = np.zeros(N) #np.arange(N)
-        OiObs = np.zeros(N) #np.arange(N)
-        #sum=0.0
-
-        #OiObs
-        #for i in range(0,N):
-        #    sum = 0.0
-        #    for j in range(0,N):
-        #        for k in range(0, self.numModes):
-        #            sum += self.TObs[k][i, j]
-        #    OiObs[i] = sum
-        #MUCH FASTER!
-        ksum=np.array([np.zeros(N),np.zeros(N),np.zeros(N)])
-        for k in range(0,self.numModes):
-            ksum[k]=self.TObs[k].sum(axis=1)
-        OiObs = ksum.sum(axis=0)
-        #print("check 1: ",OiObs[0],ksum[0][0]+ksum[1][0]+ksum[2][0])
-        #print("check 1: ",OiObs2[0])
-        #for i in range(0,N):
-        #    print(OiObs[i],OiObs2[i])
-
-        #DjObs
-        #for j in range(0,N):
-        #    sum = 0.0
-        #    for i in range(0,N):
-        #        for k in range(0,self.numModes):
-        #            sum += self.TObs[k][i, j]
-        #    DjObs[j] = sum
-        #MUCH FASTER!
-        ksum=np.array([np.zeros(N),np.zeros(N),np.zeros(N)])
-        for k in range(0,self.numModes):
-            ksum[k]=self.TObs[k].sum(axis=0)
-        DjObs = ksum.sum(axis=0)
-        #for i in range(0,N):
-        #    print(DjObs[i],DjObs2[i])
+        #These don't ever change so they need to be outside the convergence loop, and they are cached for the scenarios
+        OiObs, DjObs = self.computeObservedMarginals(refresh=True)
 
         print("OiObs and DjObs calculated")
 
         #constraints initialisation
-        B = [1.0 for i in range(0,N)] #hack
-        Z = [0.0 for i in range(0,N)]
-        for j in range(0,N):
-            Z[j] = float_info.max
-            if self.isUsingConstraints:
-                if self.constraints[j] >= 1.0: #constraints array taking place of Gj (Green Belt) in documentation
-                    #Gj=1 means 0.8 of MSOA land is green belt, so can't be built on
-                    #set constraint to original Dj
-                    Z[j] = DjObs[j]
+        B = np.ones(N) if initialB is None else np.array(initialB,dtype=np.float64)
+        Z = self.computeConstraintsTargets(DjObs) #constrained zones are held to their original Dj
         #end of constraints initialisation - have now set B[] and Z[] based on IsUsingConstraints, Constraints[] and DObs[]
 
 
-        Tij = [np.zeros(N*N).reshape(N, N) for k in range(0,self.numModes) ] #array of matrix over each mode(k) - need declaration outside loop
+        #CBarObs doesn't change either, so it's only computed once
+        self.CBarObs = [ self.calculateCBar(self.TObs[k], self.Cij[k]) for k in range(0,self.numModes) ]
+
+        #NOTE: the loop doesn't build the Tij matrices, as CBarPred and the predicted Dj for the constraints come
+        #straight from the per origin denominators and the cost weighted row sums (GravityKernel.computeStatistics),
+        #so TPred is only built once the betas have converged
+        solver = self.calibrationSolver
+        solver.reset()
+        self.constraintsConverged = True
         converged = False
         while not converged:      
             constraintsMet = False
+            constraintsIteration = 0
             while not constraintsMet:
                 #residential constraints
                 constraintsMet = True #unless violated one or more times below
                 failedConstraintsCount = 0
 
                 #model run
-                #Tij = [np.zeros(N*N).reshape(N, N) for k in range(0,self.numModes) ]
-                #pre-calculate exp(-Beta[k]*self.Cij[k]) for speed
-                expBetaCij = [np.exp(-self.Beta[k]*self.Cij[k]) for k in range(0,self.numModes)]
-                for k in range(0,self.numModes): #mode loop
-                    print("Running model for mode ",k)
-                    #Tij[k] = np.zeros(N*N).reshape(N, N)
-
-                    for i in range(0,N):
-                        #denominator calculation which is sum of all modes
-                        #denom = 0.0  #double
-                        #for kk in range(0,self.numModes): #second mode loop
-                        #    for j in range(0,N):
-                        #        denom += DjObs[j] * exp(-Beta[kk] * self.Cij[kk][i, j])
-                        #    #end for j
-                        ##end for kk
-                        #print("denom=",denom)
-                        #faster...?
-                        denom2=0.0
-                        for kk in range(0,self.numModes):
-                            #expBetaCij=np.exp(-Beta[kk]*self.Cij[kk])
-                            #print("expBetaCij=",expBetaCij)
-                            denom2+=np.sum(DjObs*expBetaCij[kk][i,:])
-                        #print("denom2=",denom2)
-
-                        #numerator calculation for this mode (k)
-                        #for j in range(0,N):
-                        #    Tij[k][i, j] = B[j] * OiObs[i] * DjObs[j] * exp(-Beta[k] * self.Cij[k][i, j]) / denom
-                        #print("Tijk[0,0]=",Tij[k][i,0])
-                        #faster
-                        Tijk2=OiObs[i]*(B*DjObs*expBetaCij[k][i]/denom2)
-                        Tij[k][i,:]=Tijk2 #put answer slice back in return array 
-                        #print("Tijk2[0,0]=",Tijk2[0])
-                    #end for i
-                #end for k
-
-                #constraints check
+                #pre-calculate exp(-Beta[k]*self.Cij[k]) for speed - the cache only rebuilds the modes whose beta changed
+                expBetaCij = self.expBetaCijCache.get(self)
+                #denominator calculation which is sum of all modes, then the statistics of the numerator for every mode (k)
+                #Tij[k][i, j] = B[j] * OiObs[i] * DjObs[j] * exp(-Beta[k] * self.Cij[k][i, j]) / denom[i]
+                print("Running model for all modes")
+                stats = GravityKernel.computeStatistics(expBetaCij, self.Cij, OiObs, DjObs, B, self.tileRows, solver.needsJacobian)
+                (denom, trips, costs, DjPred) = stats[0:4]
+
+                #constraints check - DjPred is the column sums over i and k of Tij[k][i,j], so all the violated
+                #zones are rebalanced at once, then the model pass is repeated for the CBar with the new B weights
                 if self.isUsingConstraints:
                     print("Constraints test")
-
-                    for j in range(0,N):
-                        Dj = 0.0
-                        for i in range(0,N): Dj += Tij[0][i,j]+Tij[1][i,j]+Tij[2][i,j]
-                        if self.constraints[j] >= 1.0: #Constraints is taking the place of Gj in the documentation
-                            if (Dj - Z[j]) >= 0.5: #was >1.0
-                                B[j] = B[j] * Z[j] / Dj
-                                constraintsMet = False
-                                failedConstraintsCount+=1
-                                print("Constraints violated on " + failedConstraintsCount + " MSOA zones")
-                                print("Dj=", Dj, " Zj=", Z[j], " Bj=", B[j])
-                            #end if (Dj-Z[j])>=0.5
-                        #end if Constraints[j]>=1.0
-                    #end for j
-                         
-                    #copy B2 into B ready for the next round
-                    #for (int j = 0; j < N; j++) B[j] = B2[j];
+                    newB, failedConstraintsCount = self.balanceConstraints(B, DjPred, Z)
+                    if failedConstraintsCount>0:
+                        print("Constraints violated on " + str(failedConstraintsCount) + " MSOA zones")
+                        if constraintsIteration>=self.constraintsMaxIterations:
+                            #keep the B weights that CBarPred came from
+                            print("Constraints not met after "+str(constraintsIteration)+" rounds")
+                            self.constraintsConverged = False
+                        else:
+                            B = newB
+                            constraintsMet = False
+                            constraintsIteration+=1
+                    #end if failedConstraintsCount>0
                 #end if self.isUsingConstraints
                 print("FailedConstraintsCount=", failedConstraintsCount)
 
@@ -354,36 +376,36 @@ class SingleOrigin:
 
             #calculate mean predicted trips and mean observed trips (this is CBar)
             self.CBarPred = [0.0 for k in range(0,self.numModes)]
-            self.CBarObs = [0.0 for k in range(0,self.numModes)]
-            delta = [0.0 for k in range(0,self.numModes)]
             for k in range(0,self.numModes):
-                self.CBarPred[k] = self.calculateCBar(Tij[k], self.Cij[k])
-                self.CBarObs[k] = self.calculateCBar(self.TObs[k], self.Cij[k])
+                self.CBarPred[k] = costs[k]/trips[k] #same as calculateCBar(Tij[k], self.Cij[k])
                 print("Mode "+str(k)+" CBar Pred="+str(self.CBarPred[k])+" CBar Obs="+str(self.CBarObs[k]))
-                delta[k] = fabs(self.CBarPred[k] - self.CBarObs[k]) #the aim is to minimise delta[0]+delta[1]+...
             #end for k
 
-            #delta check on all betas (Beta0, Beta1, Beta2) stopping condition for convergence
-            #double gradient descent search on Beta0 and Beta1 and Beta2
-            converged = True
-            for k in range(0,self.numModes):
-                if delta[k] / self.CBarObs[k] > 0.001:
-                    self.Beta[k] = self.Beta[k] * self.CBarPred[k] / self.CBarObs[k]
-                    converged = False
-            #end for k
+            #delta check on all betas (Beta0, Beta1, Beta2) stopping condition for convergence, then the solver
+            #works out the next betas, which is gradient descent on Beta0 and Beta1 and Beta2 for the default multiplicative
+            converged, newBeta = solver.step(self.Beta, self.CBarPred, self.CBarObs, stats[4] if solver.needsJacobian else None)
             #Debug block
+            delta = solver.trace[-1]['delta'] #the aim is to minimise delta[0]+delta[1]+...
             for k in range(0,self.numModes):
                 print("Beta", k, "=", self.Beta[k])
                 print("delta", k, "=", delta[k])
             #end for k
-            #print("delta", delta[0], delta[1], delta[2]) #should be a k loop
             #end of debug block
+            if not converged and solver.isFinished():
+                #keep the betas that CBarPred came from
+                print("Calibration not converged after "+str(solver.iteration)+" iterations of "+solver.method)
+                break
+            self.Beta = newBeta
         #end while not Converged
 
-        #Set the output, TPred[]
-        self.TPred = []
-        for k in range(0,self.numModes):
-            self.TPred.append(Tij[k])
+        self.calibrationConverged = converged
+        self.B = B
+        self.DjCons = DjPred #the predicted Dj of the last pass, which had these betas and B weights
+        print("Calibration "+solver.method+" converged="+str(converged)+" after "+str(solver.iteration)+" iterations")
+
+        #Set the output, TPred[], which is the model with the converged betas (these were the betas of the last pass)
+        self.TPred, denom = GravityKernel.run(self.expBetaCijCache.get(self), OiObs, DjObs, B, self.dtype, self.tileRows)
+        self.recordPredictedParams(B)
 
         #debugging:
         #for (int i = 0; i < N; i++)
@@ -395,7 +417,7 @@ class SingleOrigin:
     RunWithChanges
     NOTE: this was copied directly from the Quant 1 model
     Run the quant model with different values for the Oi and Dj zones.
-    PRE: needs TObs, cij and beta
+    PRE: needs TObs (or only its cached marginals, see releaseObserved), cij and beta
     TODO: need to instrument this
     TODO: writes out one file, which is the sum of the three predicted matrices produced
     @param name="OiDjHash" Hashmap of zonei index and Oi, Dj values for that area. A value of -1 for Oi or Dj means no change.
@@ -403,16 +425,27 @@ class SingleOrigin:
     zone ids are used to identify rows and columns. Time is in SECONDS. The array is k=0 (road), k=1 (bus), k=2 (rail).
     NOTE: you can pass in null for no changes. At the moment, these are directional, so zone 0->1 DOES NOT affect zone 1->0.
     @param name="hasConstraints" Run with random values added to the Dj values.
+    @param name="incremental" Only recompute the rows (origins) of TPred that the network changes touched, see
+    canRunIncremental for when this is possible. TPred is then a list of RowOverlayMatrix sharing the baseline
+    TPred, which must have been computed (fastComputePredicted or run) with the same betas and baseline Cij.
+    Falls back to a full run if the conditions aren't met.
+    @param name="overlay" Optional ScenarioOverlay holding the baseline Cij. If this is passed, then the network
+    changes are made to the overlay's scratch matrices and logged, instead of to self.Cij, so the caller doesn't
+    need to copy Cij for every scenario, and self.Cij is set to the overlay's scenario Cij at the end.
+    Without an overlay, the changes are made to self.Cij, apart from any modes which are read only (e.g. memory
+    mapped matrices in float32 mode), which are copied first.
+    @param name="accumulator" Optional ImpactAccumulator for a "statistics only" run, which must start with the
+    totals of the baseline TPred (a copy of ImpactAccumulator.fromMatrices(baseline TPred)). The TPred row tiles go
+    straight into it instead of being kept, so it ends up with the scenario totals, and self.TPred is left empty.
+    An incremental run only replaces the dirty rows in it.
+    @returns NetworkChangeLedger of every Cij cell that the network changes made, with its baseline and scenario
+    costs, which is also kept in self.changeLedger for ImpactStatistics
     """
-    def runWithChanges(self, OiDjHash, NetworkChanges, hasConstraints):
+    def runWithChanges(self, OiDjHash, NetworkChanges, hasConstraints, incremental=False, overlay=None, accumulator=None):
 
-        (M, N) = np.shape(self.TObs[0])
-
-        #DjObs = [0.0 for i in range(0,N)]
-        #OiObs = [0.0 for i in range(0,N)]
-        #Sum=0.0
+        (M, N) = np.shape(self.Cij[0])
 
-        #OiObs
+        #OiObs and DjObs - these are cached on the model, so copy them as the OiDjHash changes go into them
         #for i in range(0,N):
         #    sum = 0.0
         #    for j in range(0,N):
@@ -420,89 +453,28 @@ class SingleOrigin:
         #    #end for j
         #    OiObs[i] = sum
         #end for i
-        #MUCH FASTER!
-        ksum=np.array([np.zeros(N),np.zeros(N),np.zeros(N)])
-        for k in range(0,self.numModes):
-            ksum[k]=self.TObs[k].sum(axis=1)
-        OiObs = ksum.sum(axis=0)
+        #MUCH FASTER! (and only done once)
+        OiObs, DjObs = self.computeObservedMarginals()
+        OiObs = np.copy(OiObs)
+        DjObs = np.copy(DjObs)
+
+        #an incremental run can't have constraints, and doesn't use the exp(-beta*Cij) cache at all, only the dirty
+        #rows, which it works out for itself
+        isIncremental = incremental and self.canRunIncremental(OiDjHash)
+        if not isIncremental:
+            #exp(-Beta[k]*self.Cij[k]) comes from the cache, which was built from the baseline Cij
+            expBetaCij = self.expBetaCijCache.get(self)
 
-        #DjObs
-        #for j in range(0,N):
-        #    sum = 0.0
-        #    for i in range(0,N):
-        #        for k in range(0,self.numModes): sum += self.TObs[k][i, j]
-        #    #end for i
-        #    DjObs[j] = sum
-        #end for j
-        #MUCH FASTER!
-        ksum=np.array([np.zeros(N),np.zeros(N),np.zeros(N)])
-        for k in range(0,self.numModes):
-            ksum[k]=self.TObs[k].sum(axis=0)
-        DjObs = ksum.sum(axis=0)
-
-        #this is a complete hack - generate a TPred matrix that we can get Dj constraints from
-        TPredCons = [np.arange(N*N,dtype=np.float64).reshape(N, N) for k in range(0,self.numModes) ]
-        #pre-calculate exp(-Beta[k]*self.Cij[k]) for speed
-        expBetaCij = [np.exp(-self.Beta[k]*self.Cij[k]) for k in range(0,self.numModes)]
-        for k in range(0,self.numModes): #mode loop
-            #TPredCons[k] = np.arange(N*N).reshape(N,N)
-
-            for i in range(0,N):
-                #denominator calculation which is sum of all modes
-                #denom = 0.0
-                #for kk in range(0,self.numModes): #second mode loop
-                #    for j in range(0,N):
-                #        denom += DjObs[j] * exp(-self.Beta[kk] * self.Cij[kk][i, j])
-                #    #end for j
-                #end for kk
-                #faster...?
-                denom2=0.0
-                for kk in range(0,self.numModes):
-                    #expBetaCij=np.exp(-Beta[kk]*self.Cij[kk])
-                    #print("expBetaCij=",expBetaCij)
-                    denom2+=np.sum(DjObs*expBetaCij[kk][i,:])
-
-                #numerator calculation for this mode (k)
-                #for j in range(0,N):
-                #    TPredCons[k][i, j] = self.B[j] * OiObs[i] * DjObs[j] * exp(-self.Beta[k] * self.Cij[k][i, j]) / denom
-                #end for j
-                #faster
-                Tijk2=OiObs[i]*(self.B*DjObs*expBetaCij[k][i]/denom2)
-                TPredCons[k][i,:]=Tijk2 #put answer slice back in return array
-            #end for i
-        #end for k
-        #now the DjCons - you could just set Zj here?
-        DjCons = [0.0 for j in range(0,N)]
-        #for j in range(0,N):
-        #    sum = 0.0
-        #    for i in range(0,N):
-        #        for k in range(0,self.numModes): sum += TPredCons[k][i, j]
-        #    #end for i
-        #    DjCons[j] = sum
-        #end for j
-        #MUCH FASTER!
-        ksum=np.array([np.zeros(N),np.zeros(N),np.zeros(N)])
-        for k in range(0,self.numModes):
-            ksum[k]=TPredCons[k].sum(axis=0)
-        DjCons = ksum.sum(axis=0)
-            
         #
         #
         #TODO: Question - do the constraints take place before or after the Oi Dj changes? If before, then it's impossible to increase jobs in greenbelt zones. If after, then changes override the green belt.
 
         #constraints initialisation - this is the same as the calibration, except that the B[j] values are initially taken from the calibration, while Z[j] is initialised from Dj[j] as before.
-        Z = [0.0 for j in range(0,N)]
-        for j in range(0,N):
-            Z[j] = 1.7976931348623157e+308 #float_info.max
-            if self.isUsingConstraints:
-                if self.constraints[j] >= 1.0: #constraints array taking place of Gj (Green Belt) in documentation
-                    #Gj=1 means a high enough percentage of MSOA land is green belt, so can't be built on
-                    #set constraint to original Dj
-                    #Z[j] = DjObs[j];
-                    Z[j] = DjCons[j]
-                #end if constraints[j]
-            #end if self.isUsingConstraints
-        #end for j
+        #Gj=1 means a high enough percentage of MSOA land is green belt, so can't be built on
+        #the Dj constraints are the predicted baseline Dj, which are cached on the model, as they're the same for every
+        #scenario, so there is no pre-pass (this must be before the network changes go into the exp(-beta*Cij) cache)
+        if self.isUsingConstraints:
+            Z = self.computeConstraintsTargets(self.computeBaselineDj())
         #end of constraints initialisation - have now set B[] and Z[] based on IsUsingConstraints, Constraints[] and DObs[]
 
         #apply changes here from the hashmap
@@ -514,93 +486,98 @@ class SingleOrigin:
         #end for key
 
         #apply network changes - these are directly made to the dis matrices
+        dirtyRows = [] #origin rows touched by the network changes on any mode, which are all an incremental run needs to compute
+        ledger = NetworkChangeLedger(self.numModes, N) #every Cij cell the changes make, for the network statistics
+        self.changeLedger = ledger
         if NetworkChanges: #test against none type
             #InstrumentStatusText = "Making network changes";
             count = 0
             countMode = [ 0, 0, 0 ]
             for dnc in NetworkChanges:
-                self.Cij[dnc.mode][dnc.originZonei, dnc.destinationZonei] = dnc.absoluteTimeSecs / 60.0 #seconds to minutes (NOTE: this is done in ComputeModAPSP anyway)
+                #with an overlay, the changes go into its scratch copy, which leaves the baseline alone
+                if overlay is None and not self.Cij[dnc.mode].flags.writeable:
+                    #e.g. a read only memmap from loadQUANTMatrixMapped, so this model gets its own copy of the mode, in
+                    #a new list, as self.Cij may be shared with the baseline model (pass an overlay to avoid the copy)
+                    self.Cij = list(self.Cij)
+                    self.Cij[dnc.mode] = np.array(self.Cij[dnc.mode])
+                dis = self.Cij[dnc.mode] if overlay is None else overlay.writable(dnc.mode)
+                link = np.array([[dnc.originZonei, dnc.destinationZonei],[dnc.destinationZonei, dnc.originZonei]],dtype=np.int64)
+                oldCosts = np.array(dis[link[:,0], link[:,1]],dtype=np.float64)
+                dis[dnc.originZonei, dnc.destinationZonei] = dnc.absoluteTimeSecs / 60.0 #seconds to minutes (NOTE: this is done in ComputeModAPSP anyway)
                 #and add the reverse link
-                self.Cij[dnc.mode][dnc.destinationZonei, dnc.originZonei] = dnc.absoluteTimeSecs / 60.0 #seconds to minutes
-                #compute secondary links - both ways around
-                #int linkCount1, linkCount2;
-                #float totalMinsSaved1, totalMinsSaved2;
-                start_time = time.process_time()
-                linkCount1, totalMinsSaved1 = ModifiedZonesAPSP.computeModAPSP(self.Cij[dnc.mode], dnc.originZonei, dnc.destinationZonei, dnc.absoluteTimeSecs / 60.0)
-                end_time1 = time.process_time()
-                linkCount2, totalMinsSaved2 = ModifiedZonesAPSP.computeModAPSP(self.Cij[dnc.mode], dnc.destinationZonei, dnc.originZonei, dnc.absoluteTimeSecs / 60.0)
-                end_time2 = time.process_time()
-                print("ModifiedZonesAPSP:: ASPS1="+str(end_time1-start_time)+" APSP2="+str(end_time2-end_time1)+" secs")
-                count += linkCount1 + linkCount2
-                countMode[dnc.mode] += linkCount1 + linkCount2
-                #totalMinsSaved = totalMinsSaved1+totalMinsSaved2; //if you need the minutes saved...
+                dis[dnc.destinationZonei, dnc.originZonei] = dnc.absoluteTimeSecs / 60.0 #seconds to minutes
+                ledger.record(dnc.mode, link, oldCosts, dis[link[:,0], link[:,1]])
+                #compute secondary links - both ways around in one parallel pass
+                start_time = time.perf_counter() #wall clock, as process time adds up all the threads
+                linkCount, totalMinsSaved, cells, oldCosts = ModifiedZonesAPSP.computeModAPSPSymmetric(dis, dnc.originZonei, dnc.destinationZonei, dnc.absoluteTimeSecs / 60.0)
+                end_time = time.perf_counter()
+                ledger.record(dnc.mode, cells, oldCosts, dis[cells[:,0], cells[:,1]])
+                ledger.recordAPSP(dnc.mode, linkCount, totalMinsSaved)
+                print("ModifiedZonesAPSP:: APSP="+str(end_time-start_time)+" secs")
+                count += linkCount
+                countMode[dnc.mode] += linkCount
             #endfor
             #write out changed dis matrices if necessary
             #if (countMode[(int)QUANT3Modes.Q3Road] > 0)
             #    dis[(int)QUANT3Modes.Q3Road].DirtySerialise(Path.Combine(rootdir,"dis_road.bin"));
 
             print("QUANTModel3::RunWithChanges ComputeModAPSP links changed = ",count)
-            #now need to recompute exp(-beta * Cij) as Cij has changed!
-            expBetaCij = [np.exp(-self.Beta[k]*self.Cij[k]) for k in range(0,self.numModes)]
+            if overlay is not None:
+                self.Cij = overlay.Cij #a new list, as self.Cij may be shared with the baseline model
+            #now need to update exp(-beta * Cij) as Cij has changed, but only in the cells that APSP changed
+            #these are restored at the end, so the cache goes back to the baseline for the next scenario
+            for k in range(0,self.numModes):
+                if ledger.cells[k]:
+                    rows, cols = ledger.changedCells(k)
+                    if not isIncremental:
+                        self.expBetaCijCache.patch(k, rows, cols, self.Cij[k][rows, cols])
+                    if overlay is not None:
+                        overlay.record(k, rows, cols)
+                    dirtyRows.append(rows)
         #endif network changes!=null
 
 
-        constraintsMet = False
-        while not constraintsMet:
-            #residential constraints
-            constraintsMet = True #unless violated one or more times below
-            failedConstraintsCount = 0
-
-            #run 3 model
-            print("Run 3 model")
-            self.TPred=[]
-            for k in range(0,self.numModes): #mode loop
-                #self.TPred[k] = np.arange(N*N).reshape(N,N)
-                self.TPred.append(np.arange(N*N,dtype=np.float64).reshape(N,N))
-
-                for i in range(0,N):
-                    #denominator calculation which is sum of all modes
-                    #denom = 0.0
-                    #for kk in range(0,self.numModes): #second mode loop
-                    #    for j in range(0,N):
-                    #        denom += self.B[j]*DjObs[j] * exp(-self.Beta[kk] * self.Cij[kk][i, j])
-                    #end for kk
-                    #faster...?
-                    denom2=0.0
-                    for kk in range(0,self.numModes):
-                        #expBetaCij=np.exp(-Beta[kk]*self.Cij[kk])
-                        #print("expBetaCij=",expBetaCij)
-                        denom2+=np.sum(DjObs*expBetaCij[kk][i,:])
-
-                    #numerator calculation for this mode (k)
-                    #for j in range(0,N):
-                    #    self.TPred[k][i, j] = self.B[j] * OiObs[i] * DjObs[j] * exp(-self.Beta[k] * self.Cij[k][i, j]) / denom
-                    #faster
-                    Tijk2=OiObs[i]*(self.B*DjObs*expBetaCij[k][i]/denom2)
-                    self.TPred[k][i,:]=Tijk2 #put answer slice back in return array
-                #end for i
-            #end for k
+        try:
+            if isIncremental:
+                #cell (i,j) changes only affect the denominator of origin i, so only the dirty rows of TPred need
+                #recomputing, and everything else stays shared with the baseline TPred
+                dirtyRows = np.unique(np.concatenate(dirtyRows)) if dirtyRows else np.zeros(0,dtype=np.int64)
+                print("Run 3 model incremental, dirty rows = ",len(dirtyRows))
+                baseTPred = [ T.base if isinstance(T,RowOverlayMatrix) else T for T in self.TPred ]
+                expBetaCijRows = [ self.computeExpBetaCijRows(k, dirtyRows) for k in range(0,self.numModes) ]
+                values, denom = GravityKernel.computeRows(expBetaCijRows, OiObs, DjObs, self.B, dirtyRows, self.dtype, self.tileRows)
+                if accumulator is not None:
+                    for k in range(0,self.numModes):
+                        accumulator.replaceRows(k, dirtyRows, baseTPred[k][dirtyRows], values[k])
+                    self.TPred = []
+                else:
+                    self.TPred = [ RowOverlayMatrix(baseTPred[k], dirtyRows, values[k]) for k in range(0,self.numModes) ]
+            else:
+                self.TPredParams = None #this TPred comes from the scenario Cij, so it can't be the baseline of an incremental run
+                if self.isUsingConstraints:
+                    #the balancing rounds are all done on the column factors, as DjPred[j] = B[j]*DjObs[j]*G[j] for
+                    #any B, so TPred is only built once, with the balanced B weights
+                    print("Constraints test")
+                    denom, G = GravityKernel.computeColumnFactors(expBetaCij, OiObs, DjObs, self.tileRows)
+                    self.B = self.solveConstraints(self.B, DjObs, G, Z) #a new vector, as self.B may be shared with the baseline
+                #end if self.isUsingConstraints
 
-            #constraints check
-            if self.isUsingConstraints:
-                print("Constraints test")
-
-                for j in range(0,N):
-                    Dj = 0.0
-                    for i in range(0,N): Dj += self.TPred[0][i, j] + self.TPred[1][i, j] + self.TPred[2][i, j]
-                    if self.constraints[j] >= 1.0: #Constraints is taking the place of Gj in the documentation
-                        #System.Diagnostics.Debug.WriteLine("Test: " + Dj + ", " + Z[j] + "," + B[j]);
-                        if (Dj - Z[j]) >= 0.5: #was >1.0 threshold
-                            self.B[j] = self.B[j] * Z[j] / Dj
-                            constraintsMet = False
-                            failedConstraintsCount+=1
-#                                System.Diagnostics.Debug.WriteLine("Constraints violated on " + FailedConstraintsCount + " MSOA zones");
-#                                System.Diagnostics.Debug.WriteLine("Dj=" + Dj + " Zj=" + Z[j] + " Bj=" + B[j]);
-                        #end if (D[j]-Z[j])>=0.5
-                    #end if Constraints[j]>=1.0
-                #end for j
-            #end if self.isUsingConstraints
-        #end while not constraintsMet
+                #run 3 model
+                print("Run 3 model")
+                #self.TPred[k][i, j] = self.B[j] * OiObs[i] * DjObs[j] * exp(-self.Beta[k] * self.Cij[k][i, j]) / denom[i]
+                if accumulator is not None:
+                    #statistics only, so the TPred tiles go into the accumulator, and are never kept
+                    accumulator.clear()
+                    denom = GravityKernel.computeDenominators(expBetaCij, DjObs, self.tileRows)
+                    GravityKernel.streamPredicted(expBetaCij, OiObs, DjObs, self.B, denom, accumulator.addRows, self.dtype, self.tileRows)
+                    self.TPred = []
+                else:
+                    self.TPred, denom = GravityKernel.run(expBetaCij, OiObs, DjObs, self.B, self.dtype, self.tileRows)
+        finally:
+            self.expBetaCijCache.restore() #put the baseline exp(-beta*Cij) back
+        #end try
+
+        return ledger
 
         #add all three TPred together
         #TPredAll = np.arange(N*N).reshape(N,N)
@@ -624,6 +601,108 @@ class SingleOrigin:
     #end def runWithChanges
 
 
+###############################################################################
+
+    """
+    computeConstraintsTargets
+    The Z[j] limits on the predicted destination totals, which are Dj[j] for the constrained zones
+    (constraints[j]>=1, taking the place of Gj in the documentation) and float_info.max for all the others.
+    @param Dj destination totals vector (N) that the constrained zones are held to
+    @returns float64 vector (N) Z, all float_info.max if not using constraints
+    """
+    def computeConstraintsTargets(self, Dj):
+        Z = np.full(len(Dj), float_info.max)
+        if self.isUsingConstraints:
+            isConstrained = np.asarray(self.constraints,dtype=np.float64) >= 1.0
+            Z[isConstrained] = np.asarray(Dj,dtype=np.float64)[isConstrained]
+        return Z
+
+###############################################################################
+
+    """
+    balanceConstraints
+    One balancing round of the B weights, B[j] = B[j]*Z[j]/DjPred[j] for all the zones with a predicted Dj
+    over their limit, at once.
+    @param B constraints weights vector (N)
+    @param DjPred predicted destination totals vector (N) with the B weights
+    @param Z limits vector (N) from computeConstraintsTargets
+    @returns (new B weights vector (N), number of zones that violated their constraint)
+    """
+    def balanceConstraints(self, B, DjPred, Z):
+        violated = (DjPred - Z) >= 0.5 #was >1.0 threshold
+        B = np.array(B,dtype=np.float64)
+        B[violated] *= Z[violated]/DjPred[violated]
+        return B, int(np.count_nonzero(violated))
+
+###############################################################################
+
+    """
+    solveConstraints
+    Balance the B weights from the column factors G of GravityKernel.computeColumnFactors, which don't change
+    with B, so every round is a vector operation rather than a model pass. The predicted Dj is linear in B[j],
+    so a round puts every violated zone straight onto its limit, and the loop normally stops on the next check.
+    Sets self.constraintsConverged to False if constraintsMaxIterations rounds weren't enough.
+    @param B constraints weights vector (N) to start from
+    @param Dj destination totals vector (N)
+    @param G column factors vector (N)
+    @param Z limits vector (N) from computeConstraintsTargets
+    @returns new B weights vector (N)
+    """
+    def solveConstraints(self, B, Dj, G, Z):
+        colFactor = np.asarray(Dj,dtype=np.float64)*G
+        B = np.asarray(B,dtype=np.float64)
+        self.constraintsConverged = False
+        for iteration in range(0,self.constraintsMaxIterations):
+            B, failedConstraintsCount = self.balanceConstraints(B, B*colFactor, Z)
+            print("Constraints violated on " + str(failedConstraintsCount) + " MSOA zones")
+            if failedConstraintsCount==0:
+                self.constraintsConverged = True
+                break
+        #end for
+        return B
+
+###############################################################################
+
+    """
+    canRunIncremental
+    An incremental runWithChanges is only the same as a full run when the Oi, Dj and B vectors are the same
+    as the baseline, so there must be no Oi/Dj changes and no constraints, and the baseline TPred must exist and
+    have been built with the model's current Beta and B (see recordPredictedParams).
+    @param OiDjHash the Oi/Dj changes that will be passed to runWithChanges
+    @returns True if runWithChanges can recompute only the rows touched by the network changes
+    """
+    def canRunIncremental(self, OiDjHash):
+        if self.isUsingConstraints: return False
+        if OiDjHash: return False
+        if len(self.TPred)!=self.numModes: return False
+        if not self.isPredictedCurrent(): return False
+        return True
+
+###############################################################################
+
+    """
+    recordPredictedParams
+    Remember the Beta and B that the baseline TPred has just been built with, so canRunIncremental can tell if
+    they've been changed since (e.g. new betas set on the model without calling fastComputePredicted again)
+    @param B the B weights vector (N) that TPred was built with
+    """
+    def recordPredictedParams(self, B):
+        self.TPredParams = (list(self.TPred), [ float(b) for b in self.Beta ], np.array(B,dtype=np.float64))
+
+    """
+    isPredictedCurrent
+    @returns True if TPred (or the baseline under its RowOverlayMatrix rows) is the one recordPredictedParams was
+    called for, and the model's Beta and B are still the ones it was built with
+    """
+    def isPredictedCurrent(self):
+        if self.TPredParams is None: return False
+        (TPred, Beta, B) = self.TPredParams
+        baseTPred = [ T.base if isinstance(T,RowOverlayMatrix) else T for T in self.TPred ]
+        if len(baseTPred)!=len(TPred) or any(T is not T0 for (T,T0) in zip(baseTPred,TPred)): return False
+        if [ float(b) for b in self.Beta ]!=Beta: return False
+        if np.shape(self.B)!=B.shape or not np.array_equal(np.asarray(self.B,dtype=np.float64), B): return False
+        return True
+
 ###############################################################################
 
     """
@@ -635,15 +714,11 @@ class SingleOrigin:
         (M, N) = np.shape(Tij)
         starttime = time.time()
         for r in range(0,numRuns):
-            TPred = np.zeros(N*N).reshape(N, N)
             Oi = self.calculateOi(Tij)
             Dj = self.calculateDj(Tij)
             expBetaCij = np.exp(-Beta*Cij) #pre-calculate an exp(-Beta*cij) matrix for speed
-            for i in range(0,N):
-                denom = np.sum(Dj*expBetaCij[i,:]) #sigmaj Dj exp(-Beta*Cij)
-                Tij2=Oi[i]*(Dj*expBetaCij[i]/denom)
-                TPred[i,:]=Tij2 #put answer slice back in return array
-            #end for i
+            #single mode version of the same kernel the model uses, denom[i] = sigmaj Dj exp(-Beta*Cij)
+            (TPred,), denom = GravityKernel.run([expBetaCij], Oi, Dj, np.ones(N), expBetaCij.dtype, self.tileRows)
         #end for r
         finishtime = time.time()
         #print("SingleDest: benchmarkRun ",finishtime-starttime," seconds")
@@ -5,7 +5,7 @@ Algorithm for modified all pairs shortest paths on a fully connected zone to zon
 TODO: the walk of N x N matrix is terrible for Python performance - how to do this?
 """
 
-from numba import jit
+from numba import jit, prange
 import numpy as np
 
 class ModifiedZonesAPSP:
@@ -13,7 +13,7 @@ class ModifiedZonesAPSP:
     """
     Modified all pairs shortest paths on a fully connected zone to zone costs matrix i.e. the QUANT "dis" distance and cost matrices.
     NOTE: the link is directional, so call it with A=>B and B=>A if you want both.
-    TODO: why isn't this parallel?
+    NOTE: see computeModAPSPSymmetric for a parallel version which does both directions at once.
     @param name="dis" The original costs matrix as input, which is edited in place to return the modified matrix with the new shorter paths
     @param name="Origin" The origin zone, assumed to be directional, so link is O=>D only
     @param name="Destination" The destination zone, assumed to be directional, so link is O=>D only
@@ -55,3 +55,172 @@ class ModifiedZonesAPSP:
         return count, totalMinsSaved #and the dis matrix that we changed
     
     ################################################################################
+
+    """
+    computeModAPSPCells
+    Exactly the same as computeModAPSP, except that it also records which cells of dis were changed, so
+    that anything derived from dis (e.g. the exp(-beta*Cij) cache in SingleOrigin) can be patched
+    incrementally instead of being recomputed for all N x N cells.
+    @returns count, totalMinsSaved and an int64 array (count x 2) of the (i,j) cells that were changed
+    """
+    @staticmethod
+    @jit(nopython=True)
+    def computeModAPSPCells(dis, Origin, Destination, NewCost):
+        (M, N) = np.shape(dis)
+        count = 0
+        totalMinsSaved = 0.0
+        cells = np.empty((1024,2),dtype=np.int64) #grows by doubling if needed
+        for i in range(0,N):
+            io = dis[i, Origin]
+            for j in range(0,N):
+                dj = dis[Destination, j]
+                if io>dis[i,j] or dj>dis[i,j] or (io+dj)>dis[i,j]: continue #impossible for it to be lower
+                dist = io + NewCost + dj
+                if dist<dis[i,j]:
+                    totalMinsSaved += dis[i, j] - dist
+                    dis[i, j] = dist
+                    if count>=cells.shape[0]:
+                        bigger = np.empty((cells.shape[0]*2,2),dtype=np.int64)
+                        bigger[0:count,:] = cells[0:count,:]
+                        cells = bigger
+                    cells[count,0] = i
+                    cells[count,1] = j
+                    count+=1
+                #end if
+            #end for j
+        #end for i
+        return count, totalMinsSaved, cells[0:count,:]
+
+    ################################################################################
+
+    """
+    computeModAPSPPruned
+    Same result as computeModAPSPCells, but only relaxes the cells which can possibly change, instead of
+    walking all N x N of them.
+    A path i->O->D->j can only be shorter than dis[i,j] if row i gains from the link at the destination, and
+    column j gains from the link at the origin:
+        I = { i : dis[i,O] + NewCost < dis[i,D] }
+        J = { j : NewCost + dis[D,j] < dis[O,j] }
+    as dis[i,j] <= dis[i,D]+dis[D,j] and dis[i,j] <= dis[i,O]+dis[O,j]. Those are two N vector passes down
+    a column and along a row, then the relaxation is only over I x J, which for most new links is a tiny
+    fraction of the matrix.
+    The callers (e.g. SingleOrigin.runWithChanges) write the link into dis[O,D] (and dis[D,O]) first, which
+    breaks those inequalities for rows O and D and columns O and D, e.g. dis[O,O]+NewCost < dis[O,D] is false
+    once dis[O,D]=NewCost, so O and D are always candidates, whether the link has been written or not.
+    PRE: apart from the link itself, dis must satisfy the triangle inequality, which it does if it is an all
+    pairs shortest paths matrix (as the QUANT dis matrices are) and it stays true after every call to this function.
+    @returns count, totalMinsSaved and an int64 array (count x 2) of the (i,j) cells that were changed, in
+    the same row major order as computeModAPSPCells
+    """
+    @staticmethod
+    @jit(nopython=True)
+    def computeModAPSPPruned(dis, Origin, Destination, NewCost):
+        (M, N) = np.shape(dis)
+        isRow = dis[:,Origin] + NewCost < dis[:,Destination]
+        isCol = NewCost + dis[Destination,:] < dis[Origin,:]
+        #the link cells themselves, see above
+        isRow[Origin] = isRow[Destination] = True
+        isCol[Origin] = isCol[Destination] = True
+        I = np.nonzero(isRow)[0]
+        J = np.nonzero(isCol)[0]
+        #take copies of the row and column that the relaxation reads, as it writes into dis as it goes
+        io = dis[:,Origin].copy()
+        dj = dis[Destination,:].copy()
+        count = 0
+        totalMinsSaved = 0.0
+        cells = np.empty((len(I)*len(J),2),dtype=np.int64) #upper bound, as only I x J can change
+        for i in I:
+            for j in J:
+                dist = io[i] + NewCost + dj[j]
+                if dist<dis[i,j]:
+                    totalMinsSaved += dis[i, j] - dist
+                    dis[i, j] = dist
+                    cells[count,0] = i
+                    cells[count,1] = j
+                    count+=1
+                #end if
+            #end for j
+        #end for i
+        return count, totalMinsSaved, cells[0:count,:]
+
+    ################################################################################
+
+    """
+    computeModAPSPSymmetric
+    Both directions of a two way link O<=>D in one parallel pass, which gives the same matrix as calling
+    computeModAPSPPruned for O=>D and then D=>O. The candidate rows and columns are the union of the ones
+    for each direction (see computeModAPSPPruned), then every candidate cell takes the minimum of its
+    current cost and the paths through the link in both directions:
+        dis[i,j] = min(dis[i,j], dis[i,O]+NewCost+dis[D,j], dis[i,D]+NewCost+dis[O,j])
+    Paths which use the link twice can never be shorter, so the snapshots of rows and columns O and D are
+    all that the relaxation needs to read, which makes the rows independent. They are split over threads
+    with prange (set NUMBA_NUM_THREADS to limit them) and the GIL is released while it runs.
+    As with computeModAPSPPruned, O and D are always candidate rows and columns, as the link has normally been
+    written into dis[O,D] and dis[D,O] already, and then the result is the same as the two computeModAPSP calls
+    that runWithChanges used to make after writing it.
+    It's done in two passes over the candidate rows: the first counts the changes per row, then a prefix
+    sum of the counts gives each row its place in the cells array, so the second pass can write the cells
+    and the new costs without any locking, in the same row major order as the single threaded version.
+    PRE: apart from the link itself, dis must satisfy the triangle inequality, as for computeModAPSPPruned.
+    NOTE: count is the number of distinct cells changed, so a cell which is shortened by both directions is
+    only counted once, where the two single direction calls would count it twice. The minutes saved are the
+    same either way.
+    @returns count, totalMinsSaved, an int64 array (count x 2) of the (i,j) cells that were changed and a float64
+    array (count) of their costs before the change, which is what a NetworkChangeLedger needs
+    """
+    @staticmethod
+    @jit(nopython=True, parallel=True, nogil=True)
+    def computeModAPSPSymmetric(dis, Origin, Destination, NewCost):
+        (M, N) = np.shape(dis)
+        #snapshots of the costs to and from both ends of the link
+        iO = dis[:,Origin].copy()
+        iD = dis[:,Destination].copy()
+        Oj = dis[Origin,:].copy()
+        Dj = dis[Destination,:].copy()
+        #candidate rows and columns for O=>D or D=>O
+        isRow = (iO + NewCost < iD) | (iD + NewCost < iO)
+        isCol = (NewCost + Dj < Oj) | (NewCost + Oj < Dj)
+        #and O and D themselves, as the link has normally been written already
+        isRow[Origin] = isRow[Destination] = True
+        isCol[Origin] = isCol[Destination] = True
+        I = np.nonzero(isRow)[0]
+        J = np.nonzero(isCol)[0]
+        rowCounts = np.zeros(len(I),dtype=np.int64)
+        rowMinsSaved = np.zeros(len(I))
+        #pass 1: count the cells that will change in each row
+        for n in prange(len(I)):
+            i = I[n]
+            c = 0
+            for j in J:
+                dist = min(iO[i] + NewCost + Dj[j], iD[i] + NewCost + Oj[j])
+                if dist<dis[i,j]:
+                    c+=1
+            #end for j
+            rowCounts[n] = c
+        #end for n
+        offsets = np.zeros(len(I)+1,dtype=np.int64)
+        offsets[1:] = np.cumsum(rowCounts)
+        count = offsets[len(I)]
+        cells = np.empty((count,2),dtype=np.int64)
+        oldCosts = np.empty(count)
+        #pass 2: make the changes, each row writing into its own part of cells
+        for n in prange(len(I)):
+            i = I[n]
+            p = offsets[n]
+            saved = 0.0
+            for j in J:
+                dist = min(iO[i] + NewCost + Dj[j], iD[i] + NewCost + Oj[j])
+                if dist<dis[i,j]:
+                    saved += dis[i, j] - dist
+                    oldCosts[p] = dis[i, j]
+                    dis[i, j] = dist
+                    cells[p,0] = i
+                    cells[p,1] = j
+                    p+=1
+                #end if
+            #end for j
+            rowMinsSaved[n] = saved
+        #end for n
+        return count, np.sum(rowMinsSaved), cells, oldCosts
+
+    ################################################################################
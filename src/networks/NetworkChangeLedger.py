@@ -0,0 +1,106 @@
+"""
+NetworkChangeLedger.py
+Per mode record of every Cij cell that the network changes of a scenario wrote to, with its baseline cost
+(before the first change) and its scenario cost (after the last one). SingleOrigin.runWithChanges fills it in
+from the direct link changes and ModifiedZonesAPSP, which already know exactly which cells they changed, so the
+network statistics (the number of quicker cells, nMinus, and the minutes saved, savedSecs, see ImpactStatistics)
+come straight from it, without comparing the baseline and scenario Cij over all N x N cells of every mode.
+"""
+
+import numpy as np
+
+class NetworkChangeLedger:
+
+    """
+    Constructor
+    @param numModes number of modes
+    @param N number of zones
+    """
+    def __init__(self, numModes, N):
+        self.numModes = numModes
+        self.N = N
+        self.cells = [ [] for k in range(0,numModes) ] #list of (cells x 2) arrays of the (i,j) written to on each mode
+        self.oldCosts = [ [] for k in range(0,numModes) ] #cost of each cell before the write
+        self.newCosts = [ [] for k in range(0,numModes) ] #cost of each cell after the write
+        self.apspCount = [ 0 for k in range(0,numModes) ] #linkCount from ModifiedZonesAPSP, added up over the changes
+        self.apspMinsSaved = [ 0.0 for k in range(0,numModes) ] #totalMinsSaved from ModifiedZonesAPSP, added up over the changes
+
+###############################################################################
+
+    """
+    record
+    Log cells of mode k which have been written to, in the order the writes were made. A cell can be logged any
+    number of times, as only the first old cost and the last new cost are used.
+    @param k mode number
+    @param cells int array (n x 2) of the (i,j) cells
+    @param oldCosts array (n) of the costs of the cells before the write
+    @param newCosts array (n) of the costs of the cells after the write
+    """
+    def record(self, k, cells, oldCosts, newCosts):
+        self.cells[k].append(np.asarray(cells,dtype=np.int64).reshape(-1,2))
+        self.oldCosts[k].append(np.asarray(oldCosts,dtype=np.float64))
+        self.newCosts[k].append(np.asarray(newCosts,dtype=np.float64))
+
+    """
+    recordAPSP
+    Add the totals returned by a ModifiedZonesAPSP call on mode k, which are kept for logging
+    @param k mode number
+    @param linkCount number of cells changed by the call
+    @param totalMinsSaved minutes saved by the call
+    """
+    def recordAPSP(self, k, linkCount, totalMinsSaved):
+        self.apspCount[k] += int(linkCount)
+        self.apspMinsSaved[k] += float(totalMinsSaved)
+
+###############################################################################
+
+    """
+    changes
+    @param k mode number
+    @returns (rows, cols, baseline costs, scenario costs) of the distinct cells written to on mode k, in row major order
+    """
+    def changes(self, k):
+        if not self.cells[k]:
+            return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64), np.zeros(0), np.zeros(0)
+        cells = np.concatenate(self.cells[k])
+        oldCosts = np.concatenate(self.oldCosts[k])
+        newCosts = np.concatenate(self.newCosts[k])
+        idx = cells[:,0]*self.N+cells[:,1]
+        #first write of each cell has the baseline cost, and the last one has the scenario cost
+        keys, first = np.unique(idx, return_index=True)
+        keysReversed, last = np.unique(idx[::-1], return_index=True)
+        last = len(idx)-1-last
+        return keys//self.N, keys%self.N, oldCosts[first], newCosts[last]
+
+###############################################################################
+
+    """
+    changedCells
+    @param k mode number
+    @returns (rows, cols) int arrays of the distinct cells written to on mode k, in row major order
+    """
+    def changedCells(self, k):
+        rows, cols, oldCosts, newCosts = self.changes(k)
+        return rows, cols
+
+###############################################################################
+
+    """
+    computeNetworkStatistics
+    Number of cells which are quicker in the scenario than in the baseline, and the minutes saved on them, for each
+    mode, which are exactly the same as comparing the whole baseline and scenario Cij (cells which the scenario made
+    slower, e.g. a direct link slower than the existing path, don't count in either)
+    @returns nMinus (list of int), savedSecs (list of float), one per mode
+    """
+    def computeNetworkStatistics(self):
+        nMinus_k = [0 for k in range(0,self.numModes)]
+        savedSecs_k = [0.0 for k in range(0,self.numModes)]
+        for k in range(0,self.numModes):
+            rows, cols, oldCosts, newCosts = self.changes(k)
+            diff = oldCosts-newCosts #it's saved minutes, and new<old if it's quicker
+            nMinus_k[k] = int(np.count_nonzero(diff>0))
+            savedSecs_k[k] = float(np.sum(diff[diff>0]))
+        #end for
+        return nMinus_k, savedSecs_k
+
+###############################################################################
@@ -0,0 +1,263 @@
+"""
+parallelrun.py
+Parallel version of the RUN scenario loop in pyquant3.
+
+The baseline is loaded and calibrated once in the main process, then everything that a scenario needs is
+published once through shared memory: Cij, Lij and the baseline TPred for every mode, plus the observed
+Oi and Dj marginals (so the workers never need TObs) and the baseline Dj if using constraints. Worker processes
+attach to these read only, each with its own ScenarioOverlay for the Cij changes, and run scenarios from the
+generator in the main process.
+The impacts records come back in scenario order, so the impacts file is identical to a serial run.
+
+Set SG_NumWorkers (or --numworkers) to the number of worker processes to use this.
+NOTE: the shared memory holds a copy of the matrices, so the main process needs room for both while the
+workers are running. The workers share the cores between them for the numba parallel APSP code.
+"""
+
+import os
+import copy
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import numba
+
+from models.SingleOrigin import SingleOrigin
+from models.ScenarioOverlay import ScenarioOverlay
+from impacts.ImpactStatistics import ImpactStatistics
+from impacts.ImpactsSink import ImpactsSink
+from impacts.ImpactAccumulator import ImpactAccumulator
+
+#the state of a worker process, which is set up once by initWorker
+workerState = {}
+
+################################################################################
+
+"""
+publishSharedArrays
+Copy a set of arrays into new shared memory blocks.
+@param arrays dictionary of name to numpy array
+@returns (list of the SharedMemory blocks, which the caller must close and unlink when finished,
+    dictionary of name to (block name, shape, dtype) which attachSharedArrays needs to find them)
+"""
+def publishSharedArrays(arrays):
+    blocks = []
+    spec = {}
+    try:
+        for name, a in arrays.items():
+            a = np.asarray(a)
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes,1))
+            blocks.append(shm)
+            view = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+            view[...] = a
+            spec[name] = (shm.name, a.shape, a.dtype.str)
+        #end for
+    except Exception:
+        releaseSharedArrays(blocks)
+        raise
+    return blocks, spec
+
+################################################################################
+
+"""
+attachSharedArrays
+Attach to arrays published by publishSharedArrays in another process
+@param spec dictionary of name to (block name, shape, dtype) from publishSharedArrays
+@returns (list of the SharedMemory blocks, which must be kept open while the arrays are used,
+    dictionary of name to read only numpy array)
+"""
+def attachSharedArrays(spec):
+    blocks = []
+    arrays = {}
+    for name, (blockName, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=blockName)
+        blocks.append(shm)
+        a = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        a.flags.writeable = False
+        arrays[name] = a
+    #end for
+    return blocks, arrays
+
+################################################################################
+
+"""
+releaseSharedArrays
+Close and unlink the shared memory blocks made by publishSharedArrays
+"""
+def releaseSharedArrays(blocks):
+    for shm in blocks:
+        try:
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+    #end for
+
+################################################################################
+
+"""
+initWorker
+Pool initialiser which builds the baseline model in a worker process from the shared arrays
+@param spec shared arrays from publishSharedArrays
+@param params dictionary of the small model parameters: numModes, dtype, tileRows, Beta, B, incremental and the
+    constraints (isUsingConstraints, constraints, constraintsMaxIterations), statisticsOnly, verifyLedger, numLinks and
+    predictedParams, the (Beta, B) that the baseline TPred was built with (see SingleOrigin.recordPredictedParams)
+@param numThreads number of threads for this worker's numba parallel code
+"""
+def initWorker(spec, params, numThreads):
+    #the main process decides when to stop (see RunCheckpoint), so a SIGTERM or Ctrl-C sent to the whole process
+    #group mustn't kill the workers part way through, which would leave the pool waiting for them forever
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    numba.set_num_threads(numThreads)
+    blocks, arrays = attachSharedArrays(spec)
+    numModes = params['numModes']
+    qm3_base = SingleOrigin()
+    qm3_base.numModes = numModes
+    qm3_base.dtype = params['dtype']
+    qm3_base.tileRows = params['tileRows']
+    qm3_base.Beta = params['Beta']
+    qm3_base.B = params['B']
+    qm3_base.isUsingConstraints = params['isUsingConstraints']
+    qm3_base.constraints = params['constraints']
+    qm3_base.constraintsMaxIterations = params['constraintsMaxIterations']
+    qm3_base.Cij = [ arrays['Cij_'+str(k)] for k in range(0,numModes) ]
+    qm3_base.TPred = [ arrays['TPred_'+str(k)] for k in range(0,numModes) ]
+    qm3_base.OiObs = arrays['OiObs']
+    qm3_base.DjObs = arrays['DjObs']
+    qm3_base.DjCons = arrays.get('DjCons')
+    if params['predictedParams'] is not None:
+        #the shared TPred was built with these, so the workers can run incrementally on it
+        (Beta, B) = params['predictedParams']
+        qm3_base.TPredParams = (list(qm3_base.TPred), Beta, B)
+    workerState['blocks'] = blocks #keep these open for as long as the worker is alive
+    workerState['qm3_base'] = qm3_base
+    workerState['Lij'] = [ arrays['Lij_'+str(k)] for k in range(0,numModes) ]
+    workerState['overlay'] = ScenarioOverlay(qm3_base.Cij)
+    workerState['incremental'] = params['incremental']
+    workerState['verifyLedger'] = params['verifyLedger']
+    workerState['numLinks'] = params['numLinks']
+    workerState['baselineTotals'] = None
+    if params['statisticsOnly']:
+        workerState['baselineTotals'] = ImpactAccumulator.fromMatrices(qm3_base.TPred, workerState['Lij'], None, qm3_base.tileRows)
+
+################################################################################
+
+"""
+runScenario
+Run one scenario in a worker process, which is the same as one iteration of the serial RUN loop
+@param task (idx, networkChanges) scenario number and list of DirectNetworkChange with the link times set
+@returns (idx, the impacts record for the scenario, see ImpactsSink.makeRecord)
+"""
+def runScenario(task):
+    (idx, networkChanges) = task
+    qm3_base = workerState['qm3_base']
+    overlay = workerState['overlay']
+    overlay.reset() #undo the last scenario's Cij changes
+    qm3 = copy.copy(qm3_base)
+    start_time = time.perf_counter()
+    baselineTotals = workerState['baselineTotals']
+    impacts = ImpactStatistics()
+    impacts.verifyLedger = workerState['verifyLedger']
+    if baselineTotals is not None:
+        #statistics only, so the scenario TPred is never kept
+        scenarioTotals = baselineTotals.copy()
+        qm3.runWithChanges({},networkChanges,False,workerState['incremental'],overlay,scenarioTotals)
+        impacts.computeFromAccumulators(baselineTotals,scenarioTotals,qm3_base,qm3,workerState['Lij'],networkChanges,overlay)
+    else:
+        qm3.runWithChanges({},networkChanges,False,workerState['incremental'],overlay)
+        impacts.compute(qm3_base,qm3,workerState['Lij'],networkChanges,overlay)
+    end_time = time.perf_counter()
+    print('parallelrun:: worker '+str(os.getpid())+' scenario '+str(idx)+' '+str(end_time-start_time)+' secs')
+    return idx, ImpactsSink.makeRecord(idx,impacts,networkChanges,workerState['numLinks'])
+
+################################################################################
+
+"""
+runScenariosParallel
+Run a set of scenarios on a pool of worker processes and write the impacts records to a sink in scenario order.
+PRE: qm3_base must have its baseline TPred computed (i.e. calibrated). If it's using constraints, then the baseline
+Dj and the constraints settings go to the workers, which balance the B weights for every scenario the same as the
+serial RUN loop, so those scenarios are always full runs (see SingleOrigin.canRunIncremental)
+@param qm3_base the calibrated baseline model
+@param Lij list of the distance matrices (KM) for all modes, for the impacts
+@param tasks iterable of (idx, networkChanges), which is read in the main process, so the scenario generators
+    don't need to be shared
+@param numWorkers number of worker processes
+@param incremental passed on to runWithChanges
+@param sink ImpactsSink to write the impacts records into
+@param chunkSize number of scenarios sent to a worker at a time
+@param scenarioFinished optional function(idx) called after each record is added, which returns False to stop the
+    batch cleanly, when the scenarios already sent to the workers are finished and written, but no more are started
+@param statisticsOnly run the scenarios without keeping their TPred, see SingleOrigin.runWithChanges
+@param verifyLedger check the network statistics from each scenario's change ledger against the full Cij comparison,
+    see ImpactStatistics.verifyChangeLedger
+@returns number of scenarios run
+"""
+def runScenariosParallel(qm3_base, Lij, tasks, numWorkers, incremental, sink, chunkSize=4, scenarioFinished=None, statisticsOnly=False, verifyLedger=False):
+    OiObs, DjObs = qm3_base.computeObservedMarginals()
+    arrays = { 'OiObs': OiObs, 'DjObs': DjObs }
+    if qm3_base.isUsingConstraints:
+        arrays['DjCons'] = qm3_base.computeBaselineDj()
+    for k in range(0,qm3_base.numModes):
+        arrays['Cij_'+str(k)] = qm3_base.Cij[k]
+        arrays['Lij_'+str(k)] = Lij[k]
+        arrays['TPred_'+str(k)] = qm3_base.TPred[k]
+    #end for
+    params = {
+        'numModes': qm3_base.numModes, 'dtype': qm3_base.dtype, 'tileRows': qm3_base.tileRows,
+        'Beta': list(qm3_base.Beta), 'B': np.asarray(qm3_base.B), 'incremental': incremental,
+        'isUsingConstraints': qm3_base.isUsingConstraints, 'constraints': np.asarray(qm3_base.constraints),
+        'constraintsMaxIterations': qm3_base.constraintsMaxIterations, 'statisticsOnly': statisticsOnly,
+        'verifyLedger': verifyLedger, 'numLinks': sink.numLinks,
+        'predictedParams': qm3_base.TPredParams[1:] if qm3_base.isPredictedCurrent() else None
+    }
+    numThreads = max(1, numba.config.NUMBA_NUM_THREADS//numWorkers)
+    logging.info('parallelrun:: numWorkers='+str(numWorkers)+' numba threads per worker='+str(numThreads))
+
+    #the pool reads the tasks as fast as it can, so this limits how many scenarios are made ahead of the rows
+    #that have been written, and lets the batch stop without starting any more of them
+    maxInFlight = 2*numWorkers*chunkSize
+    inFlight = threading.Semaphore(maxInFlight)
+    stopping = threading.Event()
+    def feedTasks():
+        for task in tasks:
+            inFlight.acquire()
+            if stopping.is_set():
+                return
+            yield task
+        #end for
+
+    count = 0
+    blocks, spec = publishSharedArrays(arrays)
+    try:
+        #spawn, not fork, as the main process already has numba's threading layer running, which a forked child can't use
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(numWorkers, initializer=initWorker, initargs=(spec, params, numThreads)) as pool:
+            try:
+                for (idx, record) in pool.imap(runScenario, feedTasks(), chunkSize): #imap keeps the results in order
+                    sink.append(record)
+                    count+=1
+                    inFlight.release()
+                    logging.info('parallelrun:: scenarios finished '+str(count))
+                    if scenarioFinished is not None and not scenarioFinished(idx):
+                        stopping.set() #the rest of the scenarios in flight still come back and are written
+                #end for
+                pool.close()
+                pool.join()
+            except BaseException:
+                #the workers ignore SIGTERM, so they have to be killed, and the task feeder mustn't be left waiting
+                stopping.set()
+                inFlight.release(maxInFlight)
+                for p in multiprocessing.active_children():
+                    p.kill()
+                raise
+        #end with pool
+    finally:
+        releaseSharedArrays(blocks)
+    return count
+
+################################################################################
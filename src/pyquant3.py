@@ -52,16 +52,22 @@ import numpy as np
 import pandas as pd
 
 #local imports
-from utils import loadQUANTMatrix, loadQUANTMatrixFAST
+from utils import loadQUANTMatrix, loadQUANTMatrixFAST, loadQUANTMatrixMapped, getPrecision, getCalibrationSolver, getConstraints, loadGreenBeltConstraints, loadConstraintsB
 from models.SingleOrigin import SingleOrigin
 from models.DirectNetworkChange import DirectNetworkChange
+from models.ScenarioOverlay import ScenarioOverlay
 from impacts.ImpactStatistics import ImpactStatistics
+from impacts.ImpactAccumulator import ImpactAccumulator
+from impacts.ImpactsSink import ImpactsSink
 from networks.NetworkUtils import NetworkUtils
 from scenarios.FileScenario import FileScenario
 from scenarios.OneLink import OneLinkLimitR
 from scenarios.NLink import NLinkLimitR
+from scenarios.RadiusNeighbourIndex import RadiusNeighbourIndex
 from debug import debug_countScenarios
 from sweepcalibrate import sweep_calibrate
+from parallelrun import runScenariosParallel
+from checkpoint import RunCheckpoint
 
 ################################################################################
 
@@ -75,7 +81,8 @@ def parseArgs(argv):
     opts,args = getopt.getopt(argv,
             'hdo:i:j:',
             ['help','dafni','opcode=','betaroad=','betabus=','betarail=',
-             'numlinks=','numiterations=','mode=','radiuskm=','speedkph=','starti=','startj=','network='])
+             'numlinks=','numiterations=','mode=','radiuskm=','speedkph=','starti=','startj=','network=',
+             'precision=','incremental=','numworkers=','solver=','warmstart=','constraints=','statisticsonly=','histogramkm=','zonesformat=','impactsformat='])
     for opt, arg in opts:
         if opt in('-h','--help'):
             print ('pyquant3.py -o [CALIBRATE|RUN] [--betaroad] [--betabus] [--beta rail]')
@@ -83,6 +90,17 @@ def parseArgs(argv):
             print('or ')
             print('--network filename.graphml --mode=2 to run a single rail network scenario from a file (overrides other settings)')
             print('files are all relative to the inputs directory')
+            print('--precision=float32 to run the model matrices in single precision (default float64)')
+            print('--incremental=0 to recompute every row of TPred for every scenario (default 1, only the changed rows)')
+            print('--numworkers=8 to run the scenarios on 8 worker processes (default 1, runs them in this process)')
+            print('--statisticsonly=1 to compute the scenario impacts without keeping the scenario matrices (default 0)')
+            print('--histogramkm=0,2,5,10,20,50 to write trip length histograms with these bin edges in KM, which turns on')
+            print('    --statisticsonly and runs the scenarios in this process (--numworkers is ignored)')
+            print('--impactsformat=parquet for the impacts file, csv, parquet or bin (default csv)')
+            print('--zonesformat=parquet for the zone impacts files of a --network run, csv, csv.gz, parquet or feather (default csv)')
+            print('--solver=newton to calibrate with a Newton or secant solver (default multiplicative)')
+            print('--warmstart=1 to start the calibration from the last outputs/calibration.yaml, or --warmstart=file.yaml in the inputs directory')
+            print('--constraints=1 to use the green belt constraints (default 0)')
             sys.exit()
         elif opt in ('-d','--dafni'):
             os.environ['IsOnDAFNI']=True
@@ -110,6 +128,26 @@ def parseArgs(argv):
             os.environ['SG_Start_j']=arg
         elif opt in ('--network'):
             os.environ['SG_Network']=arg
+        elif opt in ('--precision'):
+            os.environ['Precision']=arg
+        elif opt in ('--incremental'):
+            os.environ['SG_Incremental']=arg
+        elif opt in ('--statisticsonly'):
+            os.environ['SG_StatisticsOnly']=arg
+        elif opt in ('--histogramkm'):
+            os.environ['SG_HistogramKM']=arg
+        elif opt in ('--zonesformat'):
+            os.environ['SG_ZonesFormat']=arg
+        elif opt in ('--impactsformat'):
+            os.environ['SG_ImpactsFormat']=arg
+        elif opt in ('--numworkers'):
+            os.environ['SG_NumWorkers']=arg
+        elif opt in ('--solver'):
+            os.environ['CalibrationSolver']=arg
+        elif opt in ('--warmstart'):
+            os.environ['CalibrationWarmStart']=arg
+        elif opt in ('--constraints'):
+            os.environ['UseConstraints']=arg
 #end def
 
 ################################################################################
@@ -125,7 +163,11 @@ def main(argv):
     global Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail #observed flows between zones
     global Cij_road, Cij_bus, Cij_rail #costs (time minutes) between zones
     global Lij_road, Lij_bus, Lij_rail #distance between zones
+    global precision #np.float32 or np.float64 for the model matrices
+    global calibrationSolver #beta update rule for calibrate
+    global isUsingConstraints, constraintsMaxIterations, greenBeltConstraints, constraintsB #green belt constraints for calibrate
 
+    startTime = time.monotonic() #the SG_MaxWallClockSecs budget is for the whole job
     print("hello world!")
 
     #read any command line args which may override the following file paths
@@ -221,21 +263,33 @@ def main(argv):
     #OK, so we've got a valid opcode and it's uppercase - we can continue
     logging.info("pyquant3: OpCode = " + opcode)
 
+    #precision policy for the matrices - float32 means we can map the .bin files directly without any copies
+    precision = getPrecision(configuration)
+    logging.info("pyquant3: Precision = " + np.dtype(precision).name)
+    calibrationSolver = getCalibrationSolver(configuration)
+    logging.info("pyquant3: CalibrationSolver = "+calibrationSolver.method+" tolerance="+str(calibrationSolver.tolerance)+" maxIterations="+str(calibrationSolver.maxIterations))
+    isUsingConstraints, constraintsMaxIterations = getConstraints(configuration)
+    logging.info("pyquant3: UseConstraints = "+str(isUsingConstraints)+" maxIterations="+str(constraintsMaxIterations))
+    if precision==np.float32:
+        loadMatrix = loadQUANTMatrixMapped #zero copy, read only
+    else:
+        loadMatrix = loadQUANTMatrixFAST
+
     logging.info("pyquant3: environment variables read, now loading data")
 
     #load matrices - from local files
     try:
-        Tij_Obs_road = loadQUANTMatrixFAST(os.path.join(ModelRunsDir,TijObsRoadFilename))
-        Tij_Obs_bus = loadQUANTMatrixFAST(os.path.join(ModelRunsDir,TijObsBusFilename))
-        Tij_Obs_rail = loadQUANTMatrixFAST(os.path.join(ModelRunsDir,TijObsRailFilename))
+        Tij_Obs_road = loadMatrix(os.path.join(ModelRunsDir,TijObsRoadFilename))
+        Tij_Obs_bus = loadMatrix(os.path.join(ModelRunsDir,TijObsBusFilename))
+        Tij_Obs_rail = loadMatrix(os.path.join(ModelRunsDir,TijObsRailFilename))
         #and costs
-        Cij_road = loadQUANTMatrixFAST(os.path.join(ModelRunsDir,DisRoadFilename))
-        Cij_bus = loadQUANTMatrixFAST(os.path.join(ModelRunsDir,DisBusFilename))
-        Cij_rail = loadQUANTMatrixFAST(os.path.join(ModelRunsDir,DisGBRailFilename))
+        Cij_road = loadMatrix(os.path.join(ModelRunsDir,DisRoadFilename))
+        Cij_bus = loadMatrix(os.path.join(ModelRunsDir,DisBusFilename))
+        Cij_rail = loadMatrix(os.path.join(ModelRunsDir,DisGBRailFilename))
         #and transport KM distances
-        Lij_road = loadQUANTMatrixFAST(os.path.join(ModelRunsDir,DisCrowflyVertexRoadsKMFilename))
-        Lij_bus = loadQUANTMatrixFAST(os.path.join(ModelRunsDir,DisCrowflyVertexBusKMFilename))
-        Lij_rail = loadQUANTMatrixFAST(os.path.join(ModelRunsDir,DisCrowflyVertexGBRailKMFilename))
+        Lij_road = loadMatrix(os.path.join(ModelRunsDir,DisCrowflyVertexRoadsKMFilename))
+        Lij_bus = loadMatrix(os.path.join(ModelRunsDir,DisCrowflyVertexBusKMFilename))
+        Lij_rail = loadMatrix(os.path.join(ModelRunsDir,DisCrowflyVertexGBRailKMFilename))
     except Exception as e:
         logging.error("Exception in matrix loading: ", exc_info=True)
         print(e)
@@ -252,6 +306,23 @@ def main(argv):
         print(e)
 
 
+    #load the green belt constraints and the B weights for them, which are only needed if we're using constraints
+    greenBeltConstraints = None
+    constraintsB = None
+    if isUsingConstraints:
+        try:
+            (M, N) = np.shape(Tij_Obs_road)
+            greenBeltConstraints = loadGreenBeltConstraints(os.path.join(ModelRunsDir,GreenBeltConstraintsFilename),N)
+            logging.info("pyquant3: "+str(int(np.count_nonzero(greenBeltConstraints>=1.0)))+" green belt constrained zones")
+            ConstraintsBPath = os.path.join(ModelRunsDir,ConstraintsBFilename)
+            if os.path.exists(ConstraintsBPath):
+                constraintsB = loadConstraintsB(ConstraintsBPath,N)
+            else:
+                logging.info("pyquant3: no "+ConstraintsBFilename+" so the B weights start from 1.0")
+        except Exception as e:
+            logging.error("Exception loading constraints tables: ", exc_info=True)
+            print(e)
+
     #we have to add the all modes matrices because they don't exist in this form on the server
     #Tij_Obs = Tij_Obs_road + Tij_Obs_bus + Tij_Obs_rail #not needed?
 
@@ -272,7 +343,9 @@ def main(argv):
         #this is a debug analysis function for research
         logging.info('sweepcalibrate')
         try:
-            sweep_calibrate(Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail, Cij_road, Cij_bus, Cij_rail)
+            sweep = configuration.get("sweep",{}) #beta grid, the same for all three modes
+            sweep_calibrate(Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail, Cij_road, Cij_bus, Cij_rail, precision,
+                sweep.get("betaStart",0.02), sweep.get("betaStop",0.2), sweep.get("betaStep",0.01))
         except Exception as e:
             logging.error("Exception: ", exc_info=True)
             print(e)
@@ -292,9 +365,26 @@ def main(argv):
         start_j = int(os.getenv('SG_Start_j','-1'))
         numLinks = int(os.getenv('SG_NumLinks','1'))
         networkFile = os.getenv('SG_Network','')
+        isIncremental = int(os.getenv('SG_Incremental','1'))!=0
+        isStatisticsOnly = int(os.getenv('SG_StatisticsOnly','0'))!=0
+        isVerifyLedger = int(os.getenv('SG_VerifyLedger','0'))!=0
+        impactsFormat = os.getenv('SG_ImpactsFormat','csv')
+        if impactsFormat not in ImpactsSink.Formats:
+            raise ValueError("SG_ImpactsFormat: unknown format '"+impactsFormat+"', must be one of "+str(ImpactsSink.Formats))
+        zonesFormat = os.getenv('SG_ZonesFormat','csv')
+        if zonesFormat not in ImpactStatistics.ZoneFormats:
+            raise ValueError("SG_ZonesFormat: unknown format '"+zonesFormat+"', must be one of "+str(ImpactStatistics.ZoneFormats))
+        histogramBinsKM = os.getenv('SG_HistogramKM','')
+        histogramBinsKM = [ float(edge) for edge in histogramBinsKM.split(',') ] if histogramBinsKM!='' else None
+        numWorkers = int(os.getenv('SG_NumWorkers','1'))
+        isCheckpoint = int(os.getenv('SG_Checkpoint','1'))!=0
+        checkpointEvery = int(os.getenv('SG_CheckpointEvery','10'))
+        maxWallClockSecs = float(os.getenv('SG_MaxWallClockSecs','0'))
+        seed = os.getenv('SG_Seed','')
+        seed = int(seed) if seed!='' else None
         if networkFile!='':
             networkFile = os.path.join(input_folder,networkFile)
-            numIterations=1
+            numIterations=len(FileScenario.findScenarioFiles(networkFile)) #one scenario per graphml file
         logging.info('SG_NumIterations='+str(numIterations))
         logging.info('SG_Mode='+str(mode))
         logging.info('SG_RadiusKM='+str(radiusKM))
@@ -303,161 +393,220 @@ def main(argv):
         logging.info('SG_Start_j='+str(start_j))
         logging.info('SG_NumLinks='+str(numLinks))
         logging.info('SG_Network='+str(networkFile))
-
-        #start an impacts file here
-        now = datetime.now()
-        impacts_file = output_folder.joinpath("impacts_"+now.strftime("%Y%m%d_%H%M%S")+".csv")
+        logging.info('SG_Incremental='+str(isIncremental))
+        logging.info('SG_StatisticsOnly='+str(isStatisticsOnly))
+        logging.info('SG_HistogramKM='+str(histogramBinsKM))
+        logging.info('SG_VerifyLedger='+str(isVerifyLedger))
+        logging.info('SG_ImpactsFormat='+impactsFormat)
+        logging.info('SG_ZonesFormat='+zonesFormat)
+        logging.info('SG_NumWorkers='+str(numWorkers))
+        logging.info('SG_Checkpoint='+str(isCheckpoint))
+        logging.info('SG_CheckpointEvery='+str(checkpointEvery))
+        logging.info('SG_MaxWallClockSecs='+str(maxWallClockSecs))
+        logging.info('SG_Seed='+str(seed))
+
+        #checkpoints let a batch that was stopped carry on where it finished, so look for one from the same batch first
+        #NOTE: a one off SG_Network scenario doesn't need one
+        checkpoint = None
+        resume = None
+        if isCheckpoint and networkFile=='':
+            settings = {
+                'numIterations': numIterations, 'mode': mode, 'radiusKM': radiusKM, 'speedKPH': speedKPH,
+                'start_i': start_i, 'start_j': start_j, 'numLinks': numLinks, 'histogramKM': histogramBinsKM,
+                'betas': [ os.getenv("BetaRoad",'0.0'), os.getenv("BetaBus",'0.0'), os.getenv("BetaRail",'0.0') ]
+            }
+            checkpoint = RunCheckpoint(output_folder.joinpath('run_checkpoint.yaml'),settings,checkpointEvery,maxWallClockSecs,startTime)
+            checkpoint.installSignalHandler() #SIGTERM now stops cleanly after the current scenario
+            resume = checkpoint.load()
+
+        startIteration = 0
+        if resume:
+            #carry on with the same impacts file, cutting off anything after the last complete row
+            impacts_file = Path(resume['impactsFilename'])
+            startIteration = resume['nextIteration']
+            RunCheckpoint.restoreFiles(resume) #e.g. the trip length histograms, which have a row per scenario too
+            logging.info('Resuming batch from checkpoint at iteration '+str(startIteration)+' impacts file '+str(impacts_file))
+            print('Resuming batch from checkpoint at iteration '+str(startIteration))
+        else:
+            #start an impacts file here
+            now = datetime.now()
+            impacts_file = output_folder.joinpath("impacts_"+now.strftime("%Y%m%d_%H%M%S")+"."+impactsFormat)
 
         try:
-            with impacts_file.open('w') as f: #open an impacts log file here...
+            #open an impacts log file here, which buffers the rows and writes them a batch at a time, and is cut back to
+            #the last complete batch if resuming
+            with ImpactsSink.open(impacts_file,numLinks,checkpointEvery,resume['offset'] if resume else None) as sink:
                 #look for betas in the environment variables, which lets us skip the lengthy calibration stage
                 betaRoad = float(os.getenv("BetaRoad", default='0.0'))
                 betaBus = float(os.getenv("BetaBus", default='0.0'))
                 betaRail = float(os.getenv("BetaRail", default='0.0'))
             
                 qm3_base = calibrate(betaRoad,betaBus,betaRail) #calibrate our model - only if no betas passed in
+                #the scenarios only need the marginals of TObs, which are cached on qm3_base, so TObs can go now
+                qm3_base.releaseObserved()
+                Tij_Obs_road = Tij_Obs_bus = Tij_Obs_rail = None
                 #this was used if you want to save the whole baseline model object for later - 5GB! doesn't work on DAFNI
                 #with open('outputs/qm3_base.bin', 'wb') as qfile: #todo: it's [output_folder]/qm3_base.bin on DAFNI
                 #    pickle.dump(qm3_base, qfile)
-                saveCij = [ np.copy(qm3_base.Cij[k]) for k in range(0,qm3_base.numModes)] #save the pre-scenario Cij matrix as we're about to change it
-
-                #write the header line to the impacts file
-                f.write(
-                    "idx,"
-                    +"Ck1Road,Ck1Bus,Ck1Rail,Ck2Road,Ck2Bus,Ck2Rail,CkDiffRoad,CkDiffBus,CkDiffRail,"
-                    +"Lk1Road,Lk1Bus,Lk1Rail,Lk2Road,Lk2Bus,Lk2Rail,deltaLkRoad,deltaLkBus,deltaLkRail,"
-                    +"scenarioLinkDepthRoad, scenarioLinkDepthBus, scenarioLinkDepthRail,"
-                    +"scenarioLinkKMRoad, scenarioLinkKMBus, scenarioLinkKMRail,"
-                    +"scenarioLinkSavedSecsRoad, scenarioLinkSavedSecsBus, scenarioLinkSavedSecsRail,"
-                    +"LBarRoad, LBarBus, LBarRail,"
-                    +"nMinusRoad, nMinusBus, nMinusRail,"
-                    +"SavedSecsRoad, savedSecsBus, savedSecsRail"
-                    #+"net_mode, net_i, net_j, net_secs\n"
-                )
-                for n in range(0,numLinks): #todo: if we're loading from a graphml file, then we don't know the number of links
-                    f.write(",net_mode_{0}, net_i_{0}, net_j_{0}, net_secs_{0}".format(n))
-                f.write("\n")
+                #scenarios write their Cij changes into a copy on write overlay, which keeps qm3_base.Cij as the baseline
+                #and is reset after each scenario by putting back only the cells that were changed
+                overlay = ScenarioOverlay(qm3_base.Cij)
+                #statistics only - the scenarios push their TPred tiles into a copy of the baseline totals, rather than
+                #keeping the matrices, and the trip length histograms need this too
+                baselineTotals = None
+                histogram_file = None
+                checkpointFiles = None #files with a row per scenario, other than the impacts file, see RunCheckpoint.restoreFiles
+                if isStatisticsOnly or histogramBinsKM is not None:
+                    isStatisticsOnly = True
+                    baselineTotals = ImpactAccumulator.fromMatrices(qm3_base.TPred,[ Lij_road, Lij_bus, Lij_rail ],histogramBinsKM,qm3_base.tileRows)
+                if histogramBinsKM is not None:
+                    histogram_file = impacts_file.with_name(impacts_file.stem.replace('impacts_','trip_lengths_',1)+'.csv')
+                    logging.info('Trip length histograms file '+str(histogram_file))
+                    if not resume:
+                        baselineImpacts = ImpactStatistics()
+                        baselineImpacts.LkHist1 = baselineTotals.histogram
+                        with histogram_file.open('w') as hf:
+                            hf.write(ImpactStatistics.histogramCsvHeader(histogramBinsKM))
+                            hf.write(baselineImpacts.histogramCsvRows('baseline',baseline=True))
+                    checkpointFiles = [ histogram_file ]
+                    if numWorkers>1:
+                        logging.info('SG_HistogramKM needs the scenarios to run in this process, so SG_NumWorkers is ignored')
+                        numWorkers = 1
+
+                #NOTE: the csv ImpactsSink writes the header line, and it adds link columns to the rows if a graphml scenario has
+                #more than numLinks links
 
                 N = len(df_ZoneCodes.index)
+                #zonei to areakey for the zone impacts files, made once for all the scenarios
+                zoneAreaKeys = ImpactStatistics.zoneAreaKeys(df_ZoneCodes,N) if networkFile!='' else None
                 #linkSpeed = speedKPH #KPH
                 Lij_mode = [ Lij_road, Lij_bus, Lij_rail ][mode] #select correct distance matrix for scenario mode
+                #index of all the links within radiusKM, which the generators pick from, cached next to the distance matrix
+                LijFilename_mode = [ DisCrowflyVertexRoadsKMFilename, DisCrowflyVertexBusKMFilename, DisCrowflyVertexGBRailKMFilename ][mode]
+                radiusIndex = None
+                if networkFile=='':
+                    radiusIndex = RadiusNeighbourIndex.loadOrBuild(Lij_mode,radiusKM,
+                        RadiusNeighbourIndex.cacheFilename(os.path.join(ModelRunsDir,LijFilename_mode),radiusKM))
                 #Build a scenario generator based on whether numLinks=1 or >1
                 #this is a hack! if you specify 1 link, you get OneLink sequential, while >1 gives N links randomly picked
                 #NOTE: OneLink is sequential, while NLink is a randomly picked scenario
                 if networkFile!='': #if we have a network file defined, then that takes precedence
                     scenarioGenerator = FileScenario(networkFile,mode,df_ZoneCodes)
                 elif numLinks==1: #otherwise, it's down to the number of links to pick a generator
-                    scenarioGenerator = OneLinkLimitR(radiusKM,N,mode,Lij_mode) #was 20KM, not 5
+                    scenarioGenerator = OneLinkLimitR(radiusKM,N,mode,Lij_mode,radiusIndex) #was 20KM, not 5
                     scenarioGenerator.i=start_i #carry on where we left off
                     scenarioGenerator.j=start_j #carry on where we left off
                 else:
-                    scenarioGenerator = NLinkLimitR(numLinks,radiusKM,N,mode,Lij_mode) #NOTE: this picks random N link scenarios
-
-                for i in range(0,numIterations):
-                    print('iteration '+str(i))
-                    now = datetime.now()
-                    logging.info('Iteration '+str(i)+' start: '+now.strftime("%Y%m%d_%H%M%S"))
+                    scenarioGenerator = NLinkLimitR(numLinks,radiusKM,N,mode,Lij_mode,radiusIndex,seed) #NOTE: this picks random N link scenarios
+                    logging.info('NLinkLimitR seed='+str(scenarioGenerator.seedSequence.entropy)) #pass this as SG_Seed to repeat the batch
+                if resume:
+                    scenarioGenerator.setState(resume['generatorState'])
+                if checkpoint is not None:
+                    checkpoint.begin()
+
+                if numWorkers>1 and networkFile=='':
+                    #parallel version of the loop below, where the scenarios are still made here in order, but are run on
+                    #a pool of worker processes sharing the baseline, and the impacts rows come back in the same order
+                    #the generator state is kept for each scenario in flight, as the checkpoint needs the state after the
+                    #last row written, while the scenarios are made ahead of that
+                    generatorStates = {}
+                    def makeTasks():
+                        for i in range(startIteration,numIterations):
+                            networkChanges = nextScenario(scenarioGenerator,networkFile,Lij_mode,speedKPH)
+                            generatorStates[i] = scenarioGenerator.getState()
+                            yield (i, networkChanges)
+                    def scenarioFinished(i):
+                        generatorState = generatorStates.pop(i)
+                        return checkpoint is None or checkpoint.scenarioFinished(sink,i+1,generatorState)
+                    count = runScenariosParallel(qm3_base,[ Lij_road, Lij_bus, Lij_rail ],makeTasks(),numWorkers,isIncremental,sink,scenarioFinished=scenarioFinished,statisticsOnly=isStatisticsOnly,verifyLedger=isVerifyLedger)
+                    isFinished = startIteration+count>=numIterations
+                else:
+                    isFinished = True
+                    for i in range(startIteration,numIterations):
+                        print('iteration '+str(i))
+                        now = datetime.now()
+                        logging.info('Iteration '+str(i)+' start: '+now.strftime("%Y%m%d_%H%M%S"))
                     
-                    start_time=time.process_time()
-                    #qm3 = qm3_base.deepcopy() #clone a new QUANT model so we can apply changes and difference with the baseline
-                    #with open('outputs/qm3_base.bin', 'rb') as qfile:
-                    #    qm3 = pickle.load(qfile)
-                    qm3 = copy.copy(qm3_base) #don't deep clone the whole model, just copy Cij - nothing else changes (I hope!)
-                    qm3.Cij = [ np.copy(saveCij[k]) for k in range(0,qm3.numModes) ] #copy pre-scenario Cij back
-                    #OK, so what we've jsut done is to shallow copy qm3_base, then write over the Cij properties
-                    #so that we're free to change them in qm3 for the new scenario, while being able to get the
-                    #original Cij back quickly again from saveCij - only Cij is changed by the scenario
-                    #NOTE: we need qm3_base to hold the unchanged Cij when we go to the impacts, otherwise
-                    #you can't compute how many route changes have been made
-                    #This method takes around 1s, comapred to the 10s of the full qm3=deepcopy(qm3_base) method
-                    end_time = time.process_time()
-                    print('pyquant3::deep_copy '+str(end_time-start_time)+' secs')
-                    logging.info('pyquant3::deep_copy '+str(end_time-start_time)+' secs')
-
-                    ###scenario changes section here - make up a scenario
-                    OiDjHash = {} #hash of zonei number as key, with array [Oi,Dj] new totals as value
-                    #todo: you need to make up some network changes here
-                    #r = NetworkUtils.linkKMPerHourToSeconds(0,1,Lij_rail,100.0) #0->1 at 100KPH
-                    #networkChanges = {
-                    #    DirectNetworkChange(2,0,1,r)  #mode=2,i=0,j=1,r=runlink in seconds
-                    #}
-                    networkChanges = scenarioGenerator.next()
-                    #todo: this section is a bit of a hack, need to fix this
-                    if networkFile=='': #if not a FileScenario, then we need to set link times ourselves
-                        for nc in networkChanges:
-                            r = NetworkUtils.linkKMPerHourToSeconds(nc.originZonei,nc.destinationZonei,Lij_mode,speedKPH)
-                            nc.absoluteTimeSecs = r
-                    ###end of scenario changes section
-
-                    ###scenario run section
-                    start_time = time.process_time()
-                    #NOTE: runWithChanges will alter dis matrices - just in case you're doing multiple runs
-                    qm3.runWithChanges(OiDjHash,networkChanges,False)
-                    end_time = time.process_time()
-                    print('pyquant3:: qm3.runWithChanges() '+str(end_time-start_time)+' secs')
-                    logging.info('pyquant3:: qm3.runWithChanges() '+str(end_time-start_time)+' secs')
-                    ###end scenario run section
-
-                    now = datetime.now()
-                    logging.info('Iteration '+str(i)+' model finished, starting impact statistics: '+now.strftime("%Y%m%d_%H%M%S"))
-
-                    ###write out impacts section
-                    #now output results - impacts - score?
-                    start_time = time.process_time()
-                    impacts = ImpactStatistics()
-                    impacts.compute(qm3_base,qm3,[ Lij_road, Lij_bus, Lij_rail ], networkChanges)
-                    end_time = time.process_time()
-                    print('pyquant3:: impacts.compute '+str(end_time-start_time)+' secs')
-                    logging.info('pyquant3:: impacts.compute '+str(end_time-start_time)+' secs')
-                    f.write(
-                        ('{0},' #idx
-                        '{1},{2},{3},' #Ck1
-                        '{4},{5},{6},' #Ck2
-                        '{7},{8},{9},' #CkDiff
-                        '{10},{11},{12},' #Lk1
-                        '{13},{14},{15},' #Lk2
-                        '{16},{17},{18},' #deltaLk
-                        '{19},{20},{21},' #scenarioLinkDepth_k
-                        '{22},{23},{24},' #scenarioLinkKM_K
-                        '{25},{26},{27},' #scenarioLinkSavedSecs_K
-                        '{28},{29},{30},' #LBar_k
-                        '{31},{32},{33},' #nMinus_K
-                        '{34},{35},{36}' #savedSecs_K
-                        )
-                        .format(
-                            i,
-                            impacts.Ck1[0],impacts.Ck1[1],impacts.Ck1[2],
-                            impacts.Ck2[0],impacts.Ck2[1],impacts.Ck2[2],
-                            impacts.CkDiff[0],impacts.CkDiff[1],impacts.CkDiff[2],
-                            impacts.Lk1[0],impacts.Lk1[1],impacts.Lk1[2],
-                            impacts.Lk2[0],impacts.Lk2[1],impacts.Lk2[2],
-                            impacts.deltaLk[0],impacts.deltaLk[1],impacts.deltaLk[2],
-                            impacts.scenarioLinkDepth_k[0], impacts.scenarioLinkDepth_k[1], impacts.scenarioLinkDepth_k[2],
-                            impacts.scenarioLinkKM_k[0], impacts.scenarioLinkKM_k[1], impacts.scenarioLinkKM_k[2],
-                            impacts.scenarioLinkSavedSecs_k[0], impacts.scenarioLinkSavedSecs_k[1], impacts.scenarioLinkSavedSecs_k[2],
-                            impacts.LBar_k[0], impacts.LBar_k[1], impacts.LBar_k[2],
-                            impacts.nMinus_k[0], impacts.nMinus_k[1], impacts.nMinus_k[2],
-                            impacts.savedSecs_k[0], impacts.savedSecs_k[1], impacts.savedSecs_k[2]
-                        )
-                    )
-                    #now write out the game state: mode,i,j,secs for each network change
-                    for nc in networkChanges:
-                        f.write(',{0},{1},{2},{3}'.format(nc.mode,nc.originZonei,nc.destinationZonei,nc.absoluteTimeSecs))
-                    f.write('\n')
-                    f.flush()
-
-                    #todo: now write out a zone statistics file if needed
-                    if networkFile!='': #trigger on the graphml file being present todo: make this a switch option
-                        impacts_zone_file = output_folder.joinpath("impacts_zones_"+now.strftime("%Y%m%d_%H%M%S")+"_"+str(i)+".csv")
-                        impacts.computeZones(qm3_base,qm3,[ Lij_road, Lij_bus, Lij_rail ], networkChanges)
-                        impacts.writeStatisticsFile(impacts_zone_file,df_ZoneCodes)
-                    #endif
-
-                    now = datetime.now()
-                    logging.info('Iteration '+str(i)+' finish: '+now.strftime("%Y%m%d_%H%M%S"))
-
-                #end for i
-            #end with f
+                        start_time=time.process_time()
+                        #qm3 = qm3_base.deepcopy() #clone a new QUANT model so we can apply changes and difference with the baseline
+                        #with open('outputs/qm3_base.bin', 'rb') as qfile:
+                        #    qm3 = pickle.load(qfile)
+                        overlay.reset() #undo the last scenario's Cij changes
+                        qm3 = copy.copy(qm3_base) #don't deep clone the whole model - only Cij is changed by the scenario, and that goes into the overlay
+                        #NOTE: we need qm3_base to hold the unchanged Cij when we go to the impacts, otherwise
+                        #you can't compute how many route changes have been made
+                        #This used to copy all the Cij matrices here (around 1s), but the overlay reset is in proportion to the
+                        #number of cells the last scenario changed
+                        end_time = time.process_time()
+                        print('pyquant3::overlay_reset '+str(end_time-start_time)+' secs')
+                        logging.info('pyquant3::overlay_reset '+str(end_time-start_time)+' secs')
+
+                        ###scenario changes section here - make up a scenario
+                        OiDjHash = {} #hash of zonei number as key, with array [Oi,Dj] new totals as value
+                        #todo: you need to make up some network changes here
+                        #r = NetworkUtils.linkKMPerHourToSeconds(0,1,Lij_rail,100.0) #0->1 at 100KPH
+                        #networkChanges = {
+                        #    DirectNetworkChange(2,0,1,r)  #mode=2,i=0,j=1,r=runlink in seconds
+                        #}
+                        networkChanges = nextScenario(scenarioGenerator,networkFile,Lij_mode,speedKPH)
+                        ###end of scenario changes section
+
+                        ###scenario run section
+                        start_time = time.process_time()
+                        #NOTE: runWithChanges will alter dis matrices - just in case you're doing multiple runs
+                        #NOTE: incremental only recomputes the TPred rows that the scenario changed, the rest are shared with qm3_base
+                        #NOTE: statistics only doesn't keep the scenario TPred at all, only its totals
+                        scenarioTotals = baselineTotals.copy() if isStatisticsOnly else None
+                        qm3.runWithChanges(OiDjHash,networkChanges,False,isIncremental,overlay,scenarioTotals)
+                        end_time = time.process_time()
+                        print('pyquant3:: qm3.runWithChanges() '+str(end_time-start_time)+' secs')
+                        logging.info('pyquant3:: qm3.runWithChanges() '+str(end_time-start_time)+' secs')
+                        ###end scenario run section
+
+                        now = datetime.now()
+                        logging.info('Iteration '+str(i)+' model finished, starting impact statistics: '+now.strftime("%Y%m%d_%H%M%S"))
+
+                        ###write out impacts section
+                        #now output results - impacts - score?
+                        start_time = time.process_time()
+                        impacts = ImpactStatistics()
+                        impacts.verifyLedger = isVerifyLedger
+                        if isStatisticsOnly:
+                            impacts.computeFromAccumulators(baselineTotals,scenarioTotals,qm3_base,qm3,[ Lij_road, Lij_bus, Lij_rail ], networkChanges, overlay)
+                        else:
+                            impacts.compute(qm3_base,qm3,[ Lij_road, Lij_bus, Lij_rail ], networkChanges, overlay)
+                        end_time = time.process_time()
+                        print('pyquant3:: impacts.compute '+str(end_time-start_time)+' secs')
+                        logging.info('pyquant3:: impacts.compute '+str(end_time-start_time)+' secs')
+                        sink.add(i,impacts,networkChanges)
+                        if histogram_file is not None:
+                            with histogram_file.open('a') as hf:
+                                hf.write(impacts.histogramCsvRows(i))
+
+                        #todo: now write out a zone statistics file if needed
+                        if networkFile!='': #trigger on the graphml file being present todo: make this a switch option
+                            impacts_zone_file = output_folder.joinpath("impacts_zones_"+now.strftime("%Y%m%d_%H%M%S")+"_"+str(i)+"."+zonesFormat)
+                            if not isStatisticsOnly: #otherwise computeFromAccumulators has done the zones already
+                                impacts.computeZones(qm3_base,qm3,[ Lij_road, Lij_bus, Lij_rail ], networkChanges)
+                            impacts.writeStatisticsFile(impacts_zone_file,zoneAreaKeys)
+                            logging.info('Iteration '+str(i)+' scenario '+str(scenarioGenerator.currentFilename)+' zones file '+str(impacts_zone_file))
+                        #endif
+
+                        now = datetime.now()
+                        logging.info('Iteration '+str(i)+' finish: '+now.strftime("%Y%m%d_%H%M%S"))
+                        if checkpoint is not None and not checkpoint.scenarioFinished(sink,i+1,scenarioGenerator.getState(),checkpointFiles):
+                            #stop cleanly, the checkpoint has been written, so the next run will carry on from here
+                            isFinished = i+1>=numIterations
+                            break
+
+                    #end for i
+                if checkpoint is not None:
+                    if isFinished:
+                        checkpoint.finish()
+                    else:
+                        logging.info('Batch stopped, it will carry on from the checkpoint when it is run again')
+                        print('Batch stopped, it will carry on from the checkpoint when it is run again')
+            #end with sink
         except Exception as e:
             logging.error("Exception: ", exc_info=True)
             print(e)
@@ -473,6 +622,27 @@ def main(argv):
 
 ################################################################################
 
+"""
+nextScenario
+Get the next scenario from a scenario generator and set the link times if it's a computer generated one
+@param scenarioGenerator FileScenario, OneLinkLimitR or NLinkLimitR
+@param networkFile the SG_Network graphml file, or '' if the scenarios are computer generated
+@param Lij_mode distance matrix (KM) for the scenario mode
+@param speedKPH speed of the new links
+@returns list of DirectNetworkChange
+"""
+def nextScenario(scenarioGenerator,networkFile,Lij_mode,speedKPH):
+    networkChanges = scenarioGenerator.next()
+    #todo: this section is a bit of a hack, need to fix this
+    if networkFile=='': #if not a FileScenario, then we need to set link times ourselves
+        for nc in networkChanges:
+            r = NetworkUtils.linkKMPerHourToSeconds(nc.originZonei,nc.destinationZonei,Lij_mode,speedKPH)
+            nc.absoluteTimeSecs = r
+    return networkChanges
+#end def nextScenario
+
+################################################################################
+
 """
 Calibrate and write out yaml file
 @param "betaRoad" road beta - if all three passed in then calibration skipped
@@ -484,14 +654,25 @@ def calibrate(betaRoad,betaBus,betaRail):
     global output_folder
     global Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail
     global Cij_road, Cij_bus, Cij_rail
+    global precision
+    global calibrationSolver
+    global isUsingConstraints, constraintsMaxIterations, greenBeltConstraints, constraintsB
 
     qm3 = SingleOrigin()
+    qm3.dtype = precision
+    qm3.calibrationSolver = calibrationSolver
     qm3.TObs = [ Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail ]
     qm3.Cij = [ Cij_road, Cij_bus, Cij_rail ]
     #constraints initialisation - no constraints as default - need to initialise B weights to all 1.0
-    qm3.isUsingConstraints=False
+    #otherwise the B weights start from the Constraints_B table, if there is one
+    qm3.isUsingConstraints=isUsingConstraints
+    qm3.constraintsMaxIterations=constraintsMaxIterations
     (M, N) = np.shape(Tij_Obs_road)
     qm3.B = np.ones(N)
+    if isUsingConstraints:
+        qm3.constraints = greenBeltConstraints
+        if constraintsB is not None:
+            qm3.B = np.copy(constraintsB)
     
     #skip calibration stage if non valid betas have been passed in - useful for scenario runs
     if betaRoad>0 and betaBus>0 and betaRail>0:
@@ -500,21 +681,70 @@ def calibrate(betaRoad,betaBus,betaRail):
         qm3.fastComputePredicted() #computes a baseline TPred set from the betas
     else:
         logging.info("Calibration from matrices as no betas passed in environment")
-        qm3.run()
+        #warm start from a previous calibration if there is one, which is much quicker after small changes to the inputs
+        initialBeta = None
+        initialB = qm3.B if isUsingConstraints else None
+        warmStartFile = getWarmStartFile()
+        if warmStartFile is not None:
+            if warmStartFile.exists():
+                with open(warmStartFile,'r') as fd:
+                    previous = yaml.safe_load(fd)
+                initialBeta = [ previous['beta_road'], previous['beta_bus'], previous['beta_rail'] ]
+                if qm3.isUsingConstraints and 'B' in previous and len(previous['B'])==N:
+                    initialB = previous['B']
+                logging.info("calibrate: warm start from "+str(warmStartFile)+" betas="+str(initialBeta)+" B="+str(initialB is not None))
+            else:
+                logging.info("calibrate: no warm start as "+str(warmStartFile)+" doesn't exist, starting from beta=1.0")
+                warmStartFile = None
+        #end if
+        start_time = time.perf_counter()
+        qm3.run(initialBeta, initialB)
+        wallTime = time.perf_counter()-start_time
+        for t in qm3.calibrationSolver.trace:
+            logging.info("calibrate: "+qm3.calibrationSolver.method+" iteration "+str(t['iteration'])+" beta="+str(t['Beta'])+" CBarPred="+str(t['CBarPred'])+" CBarObs="+str(t['CBarObs']))
+        if not qm3.calibrationConverged:
+            logging.warning("calibrate: not converged after "+str(qm3.calibrationSolver.iteration)+" iterations")
+        logging.info("calibrate: "+str(qm3.calibrationSolver.iteration)+" iterations in "+str(wallTime)+" secs")
         #and return the betas here
         logging.info("beta (road)="+str(qm3.Beta[0])+" beta (bus)="+str(qm3.Beta[1])+" beta (rail)="+str(qm3.Beta[2]))
         #the float() casts are because yaml.safe_dump can't handle the numpy double conversion properly "invalid object"
         calibration = {
             'beta_road':float(qm3.Beta[0]), 'beta_bus':float(qm3.Beta[1]), 'beta_rail':float(qm3.Beta[2]),
             'CBarObs_road':float(qm3.CBarObs[0]), 'CBarObs_bus':float(qm3.CBarObs[1]), 'CBarObs_rail':float(qm3.CBarObs[2]),
-            'CBarPred_road':float(qm3.CBarPred[0]), 'CBarPred_bus':float(qm3.CBarPred[1]), 'CBarPred_rail':float(qm3.CBarPred[2])
+            'CBarPred_road':float(qm3.CBarPred[0]), 'CBarPred_bus':float(qm3.CBarPred[1]), 'CBarPred_rail':float(qm3.CBarPred[2]),
+            'solver':qm3.calibrationSolver.method, 'iterations':qm3.calibrationSolver.iteration,
+            'converged':bool(qm3.calibrationConverged), 'wallTimeSecs':float(wallTime),
+            'warmStart':'' if warmStartFile is None else str(warmStartFile)
         }
-        yaml.safe_dump(calibration, open(output_folder.joinpath('calibration.yaml'),'w'))
+        if qm3.isUsingConstraints:
+            calibration['B'] = [ float(b) for b in qm3.B ] #so the next calibration can start from these too
+            calibration['constraintsConverged'] = bool(qm3.constraintsConverged)
+        with open(output_folder.joinpath('calibration.yaml'),'w') as fd:
+            yaml.safe_dump(calibration, fd)
     #end if
 
     return qm3
 #end def calibrate
 
+################################################################################
+
+"""
+getWarmStartFile
+The calibration.yaml to warm start the calibration from, which is set by the CalibrationWarmStart environment
+variable (--warmstart). 1 means the calibration.yaml in the outputs directory, which is the last calibration,
+anything else is a file name, relative to the inputs directory.
+@returns Path of the file, or None for a cold start
+"""
+def getWarmStartFile():
+    global input_folder, output_folder
+    warmStart = os.getenv('CalibrationWarmStart','')
+    if warmStart=='' or warmStart=='0':
+        return None
+    if warmStart=='1':
+        return output_folder.joinpath('calibration.yaml')
+    return input_folder.joinpath(warmStart) #NOTE: an absolute path stays as it is
+#end def getWarmStartFile
+
 
 ################################################################################
 
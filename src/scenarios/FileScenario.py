@@ -1,81 +1,138 @@
 """
-next() - use this as the interface to generate a scenario NOTE: it's always the same scenario
+next() - use this as the interface to generate a scenario NOTE: it's always the same scenario for a single file
+findScenarioFiles - list the graphml files in a file, directory or manifest
 findNearestZone - finds nearest zone centroid to the lat/lon of a real network change
+findNearestZones - vectorised version of findNearestZone for lots of points at once
 loadFromGraphML - load a scenario graphml file and return a list of directnetworkchanges
 """
+import os
+import copy
+import hashlib
 import pandas as pd
-import xml.dom.minidom
+import xml.etree.ElementTree as ET
 from models.DirectNetworkChange import DirectNetworkChange
+from scenarios.ZoneCentroidIndex import ZoneCentroidIndex
 
 class FileScenario:
+    """
+    Constructor
+    @param filename a graphml file, a directory of graphml files, or a manifest (text file) listing graphml files,
+    one per line, relative to the manifest, see findScenarioFiles
+    @param mode 0=road, 1-bus, 2=rail
+    @param zonecodes the ZoneCodes table, for snapping nodes to zones
+    """
     def __init__(self,filename:str, mode:int, zonecodes:pd.DataFrame):
         self.filename = filename
         self.mode = mode
         self.zonecodes = zonecodes
+        self.zoneIndex = None #ZoneCentroidIndex, built the first time it's needed
+        self.filenames = FileScenario.findScenarioFiles(filename)
+        self.fileIndex = 0 #next file for next() to return
+        self.currentFilename = None #file of the last scenario returned by next()
+        self.cache = {} #dict(filename, (mtime, sha1, list of DirectNetworkChange)) of files already loaded
+    ###
+
+    """
+    findScenarioFiles
+    @param filename a graphml file, a directory (all the *.graphml files in it, in name order) or a manifest,
+    which is any other file, listing one graphml file per line (blank lines and lines starting # are skipped)
+    @returns list of graphml filenames
+    """
+    @staticmethod
+    def findScenarioFiles(filename:str) -> list:
+        if os.path.isdir(filename):
+            return [ os.path.join(filename,name) for name in sorted(os.listdir(filename)) if name.lower().endswith('.graphml') ]
+        if str(filename).lower().endswith('.graphml'):
+            return [ filename ]
+        filenames = []
+        with open(filename,'r') as fd:
+            for line in fd:
+                line = line.strip()
+                if line!='' and not line.startswith('#'):
+                    filenames.append(os.path.join(os.path.dirname(filename),line))
+            #end for
+        return filenames
+    ###
+
+    """
+    findNearestZones
+    Find the nearest zones to a set of lat/lon points in one go, using a spatial index of the zone
+    centroids (see ZoneCentroidIndex), which measures great circle distance rather than Euclidean
+    distance on the lat/lon values.
+    @param lons array of longitudes
+    @param lats array of latitudes
+    @returns array of the zonei of the zone centroid closest to each lon,lat
+    """
+    def findNearestZones(self, lons, lats):
+        if self.zoneIndex is None:
+            self.zoneIndex = ZoneCentroidIndex(self.zonecodes)
+        zonei, distKM = self.zoneIndex.nearestZones(lons, lats)
+        return zonei
     ###
 
     """
     findNearestZone
     Private function to find the nearest zone to the given lat/lon
-    This is sub-optimal for a number of reasons, not least that it's using Euclidean
-    distance on lat/lon values. The full table scan doesn't exactly make it good
-    either. However, it's used once and only for the individual links in a scenario,
-    so shouldn't be a performance issue to scan an 8436 entry table about 10 times.
     @returns the zonei of the zone centroid closest to lat,lon
     """
     def findNearestZone(self, lon:float, lat:float) -> int:
-        bestNode=-1
-        bestdist2=1e10
-        for idx, row in self.zonecodes.iterrows():
-            lat2 = row['lat']
-            lon2 = row['lon']
-            dx=lon2-lon
-            dy=lat2-lat
-            dist2 = (dx*dx)+(dy*dy)
-            if dist2<bestdist2:
-                bestdist2=dist2
-                bestNode=row['zonei']
-        ##endif
-        return bestNode
+        return int(self.findNearestZones([lon], [lat])[0])
     ###
-    
+
     """
     loadFromGraphML
-    static load method, returns a list of DirectNetworkChange(s) from a special format graphml file
-    @param graphml file, BUT this one need to have additional lat="" and lon="" attributes on the <nodes>
-    so that we can link the scenario to the nearest nodes (i.e. QUANT3 scenario)
-    @param 0=road, 1-bus, 2=rail
-    @returns a list of DirectNetworkChange(s)
+    Returns a list of DirectNetworkChange(s) from a special format graphml file.
+    The file is streamed with iterparse, so the whole document tree is never built, and the result is cached,
+    so the file is only parsed again if it changes (a different modified time and contents hash).
+    @param filename graphml file (default self.filename), BUT this one need to have additional lat="" and lon=""
+    attributes on the <nodes> so that we can link the scenario to the nearest nodes (i.e. QUANT3 scenario)
+    @returns a list of DirectNetworkChange(s), which are new copies, so they can be changed
     """
-    def loadFromGraphML(self) -> list :
-        #todo: build lookup of nearest zones
-        dnc = []
-        xml_doc = xml.dom.minidom.parse(self.filename)
-        nearestZone = {} #dict(string,int), link between nodes in the graphml and their nearest zone centroids
-        nodes = xml_doc.getElementsByTagName('node')
-        for node in nodes:
-            #<node id="CHH" code="" lines="E" lon="0.128262928" lat="51.56802985" name="Chadwell Heath Station" />
-            id = node.getAttribute('id')
-            strLon = node.getAttribute('lon')
-            strLat = node.getAttribute('lat')
-            lon = float(strLon)
-            lat = float(strLat)
-            #and add it to a dictionary lookup
-            areakey = self.findNearestZone(lon, lat)
-            nearestZone[id]=areakey
-            print("loadFromGraphML Node: ",id,strLon,strLat," -> ",areakey)
+    def loadFromGraphML(self, filename:str=None) -> list :
+        if filename is None:
+            filename = self.filename
+        mtime = os.stat(filename).st_mtime_ns
+        cached = self.cache.get(filename)
+        if cached is not None and cached[0]==mtime:
+            return copy.deepcopy(cached[2])
+        with open(filename,'rb') as fd:
+            digest = hashlib.sha1(fd.read()).hexdigest()
+        if cached is not None and cached[1]==digest: #touched but not changed
+            self.cache[filename] = (mtime, digest, cached[2])
+            return copy.deepcopy(cached[2])
+
+        ids = []
+        lons = []
+        lats = []
+        edges = [] #(source, target, seconds)
+        for event, elem in ET.iterparse(filename, events=('end',)):
+            tag = elem.tag.rsplit('}',1)[-1] #without the graphml namespace
+            if tag=='node':
+                #<node id="CHH" code="" lines="E" lon="0.128262928" lat="51.56802985" name="Chadwell Heath Station" />
+                ids.append(elem.get('id'))
+                lons.append(float(elem.get('lon')))
+                lats.append(float(elem.get('lat')))
+                elem.clear()
+            elif tag=='edge':
+                #assumes the first data element is the link time e.g. <data key="weight">250</data>
+                nodeData = next(child for child in elem if child.tag.rsplit('}',1)[-1]=='data')
+                edges.append((elem.get('source'), elem.get('target'), float(nodeData.text)))
+                elem.clear()
         #end for
 
+        #snap all the nodes to their nearest zones in one go and add them to a dictionary lookup
+        nearestZone = {} #dict(string,int), link between nodes in the graphml and their nearest zone centroids
+        if ids:
+            areakeys = self.findNearestZones(lons, lats)
+            for id, lon, lat, areakey in zip(ids, lons, lats, areakeys):
+                nearestZone[id]=int(areakey)
+                print("loadFromGraphML Node: ",id,lon,lat," -> ",nearestZone[id])
+            #end for
+
         #now the links
-        edges = xml_doc.getElementsByTagName('edge')
-        for edge in edges:
-            source = edge.getAttribute('source')
-            target = edge.getAttribute('target')
-            nodeData = edge.getElementsByTagName('data')[0]
-            strWeight = nodeData.firstChild #assumes it's a text node inside e.g. <data key="weight">250</data>
-            seconds = float(strWeight.nodeValue)
+        dnc = []
+        for (source, target, seconds) in edges:
             print('Edge:',source,target,seconds,"mode=",self.mode)
-
             #matching work
             sourceI = nearestZone[source]
             targetI = nearestZone[target]
@@ -83,19 +140,21 @@ class FileScenario:
             dnc.append(newDNC)
         #end for
 
-        return dnc
-    
+        self.cache[filename] = (mtime, digest, dnc)
+        return copy.deepcopy(dnc)
+
     ################################################################################
 
     """
     next()
     This is the entry point to return the list of changes, as loaded from a graphml file.
     This is slightly strange compared to OneLink and NLink, which are designed to run
-    thousands of random scenarios, but this enables a single reference scenario to be
-    run via the same interface.
-    Future - you could add the ability to run a list of files through it, or alter
-    the scenario in some randomised way i.e. first run is no changes, then it starts
-    to alter the scenario.
+    thousands of random scenarios, but this enables a set of reference scenarios to be
+    run via the same interface, one per file, in order, so they all share one baseline.
+    After the last file it starts again at the first, so a single file is always the same scenario.
+    self.currentFilename is the file that the scenario came from.
     """
     def next(self) -> list:
-        return self.loadFromGraphML()
\ No newline at end of file
+        self.currentFilename = self.filenames[self.fileIndex]
+        self.fileIndex = (self.fileIndex+1)%len(self.filenames)
+        return self.loadFromGraphML(self.currentFilename)
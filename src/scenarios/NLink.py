@@ -3,10 +3,21 @@ NLink.py
 Scenario generator for exhaustively building 'N' link scenarios.
 N=2 gives you two link scenarios, 3=three link etc.
 NOTE: don't confuse this N (=LinkN) with the other N, which is number of zones (=8436)
+
+Each scenario is a random walk of linkN links, starting from a random zone, where each link goes to a random
+zone within maxRadiusKM of the end of the last link, but never straight back to where the last link came from.
+The walks come from a seeded numpy Generator, so a batch can be repeated from its seed, and spawn() gives
+independent streams, e.g. one for each worker, which never overlap.
+nextBatch makes K scenarios at once, with all K walks taking each step together, so millions of scenarios
+can be made up front cheaply.
 """
 
-import random
+import numpy as np
 from models.DirectNetworkChange import DirectNetworkChange
+from scenarios.RadiusNeighbourIndex import RadiusNeighbourIndex
+
+#one link of a scenario in the arrays returned by nextBatch, mode=-1 marks a link that couldn't be made
+scenarioLinkDType = np.dtype([('mode',np.int8),('i',np.int32),('j',np.int32),('secs',np.float64)])
 
 class NLinkLimitR:
 
@@ -17,16 +28,88 @@ class NLinkLimitR:
     @param numZones number of zones in the model, which limits the i and j numbers generated
     @param mode the mode number which goes into the DirectNetworkChange e.g. 0=road, 1=bus, 2=rail
     @param LijKM the distance matrix (crowfly vertex km) matching the mode param above, used to limit distances to maxRadiusKM
+    @param index optional RadiusNeighbourIndex for LijKM and maxRadiusKM (e.g. from RadiusNeighbourIndex.loadOrBuild), otherwise one is built
+    @param seed int seed or numpy SeedSequence for the random numbers, None for a random one (see self.seedSequence.entropy to repeat it)
     """
-    def __init__(self,linkN,maxRadiusKM,numZones,mode,LijKM):
+    def __init__(self,linkN,maxRadiusKM,numZones,mode,LijKM,index=None,seed=None):
         self.linkN = linkN
         self.maxRadiusKM = maxRadiusKM
         self.N = numZones
         self.mode = mode
         self.LijKM = LijKM
+        self.index = index if index is not None else RadiusNeighbourIndex.build(LijKM,maxRadiusKM)
+        self.seedSequence = seed if isinstance(seed,np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.rng = np.random.Generator(np.random.PCG64(self.seedSequence))
         self.i = 0 #origin
         self.j = -1 #destination
 
+################################################################################
+
+    """
+    spawn
+    Make independent copies of this generator, with child random streams which don't overlap with each
+    other or with this one, e.g. to give each worker process its own scenarios.
+    @param n number of generators
+    @returns list of n NLinkLimitR sharing the same index
+    """
+    def spawn(self, n):
+        return [ NLinkLimitR(self.linkN,self.maxRadiusKM,self.N,self.mode,self.LijKM,self.index,child) for child in self.seedSequence.spawn(n) ]
+
+################################################################################
+
+    """
+    nextBatch
+    Make K scenarios at once as a structured array of links.
+    @param K number of scenarios
+    @param speedKPH optional speed of the new links, which sets secs from LijKM like
+    NetworkUtils.linkKMPerHourToSeconds, otherwise secs=-1 to be filled in later
+    @returns array (K x linkN) of scenarioLinkDType (mode, i, j, secs). If a walk gets stuck, with nowhere to go
+    within the radius apart from back where it came from, then the rest of its links have mode=i=j=-1.
+    """
+    def nextBatch(self, K, speedKPH=None):
+        result = np.full((K, self.linkN), -1, dtype=scenarioLinkDType)
+        indptr = self.index.indptr
+        #pick the first origins - can be any of the N zones
+        i = self.rng.integers(0, self.N, size=K)
+        backlink = np.full(K, -1, dtype=np.int64) #used to make sure we don't backtrack - it's the previous origin
+        alive = np.ones(K, dtype=bool) #walks which haven't got stuck
+        for n in range(0,self.linkN):
+            #choose from all the destinations within maxRadiusKM of i apart from backlink, by picking a position in
+            #the neighbours of i with backlink taken out, then stepping over backlink if it's at or before that position
+            counts = indptr[i+1]-indptr[i]
+            backPos = self.index.find(i, backlink)
+            hasBack = backPos>=0
+            choices = counts-hasBack
+            alive &= choices>0
+            p = (self.rng.random(K)*np.maximum(choices,1)).astype(np.int64)
+            p += hasBack & (p>=backPos-indptr[i])
+            j = self.index.indices[np.minimum(indptr[i]+p, len(self.index.indices)-1)].astype(np.int64)
+            #log it
+            result['mode'][alive,n] = self.mode
+            result['i'][alive,n] = i[alive]
+            result['j'][alive,n] = j[alive]
+            #and then i=j to move the link along the chain
+            backlink = np.where(alive, i, backlink)
+            i = np.where(alive, j, i)
+        #end for
+        if speedKPH is not None:
+            links = result['mode']>=0
+            result['secs'][links] = (np.asarray(self.LijKM[result['i'][links],result['j'][links]],dtype=np.float64)/speedKPH)*3600.0
+        if K>0:
+            (self.i, self.j) = (int(i[-1]), int(result['j'][-1,-1]))
+        return result
+
+################################################################################
+
+    """
+    toNetworkChanges
+    @param links one row (linkN) of the array from nextBatch
+    @returns list of DirectNetworkChange for the links that were made
+    """
+    @staticmethod
+    def toNetworkChanges(links):
+        return [ DirectNetworkChange(int(link['mode']),int(link['i']),int(link['j']),float(link['secs'])) for link in links if link['mode']>=0 ]
+
 ################################################################################
 
     """
@@ -39,29 +122,25 @@ class NLinkLimitR:
     it always returns a DirectNetworkChange with -1 as the link time, which you have to fill in later
     """
     def next(self):
-        result = []
-        backlink=-1 #used to make sure we don't backtrace - it's the previous origin link
+        return NLinkLimitR.toNetworkChanges(self.nextBatch(1)[0])
 
-        #pick a first origin - can be any of the N zones
-        self.i = random.randint(0,self.N-1) #note, they're both inclusive limits
-        for n in range(0,self.linkN):
-            #select all destinations within maxRadiusKM of i
-            list = []
-            for nj in range(0,self.N):
-                #make sure we don't back track and pick a possible within maxRadiusKM
-                if nj!=backlink and self.LijKM[self.i,nj]<=self.maxRadiusKM:
-                    list.append(nj)
-            if (len(list)>0):
-                #pick a random one
-                self.j = random.choice(list)
-                #log it
-                result.append( DirectNetworkChange(self.mode,self.i,self.j,-1) )
-                #and then i=j to move the link along the chain
-                backline=self.i # set back link to the one before the next origin so we don't backtrack
-                self.i=self.j
-            #endif
-        #end for
+################################################################################
 
-        return result
+    """
+    getState
+    @returns the state of the random number generator (and i, j), which setState can carry on from, so a
+    resumed batch picks exactly the same scenarios as one that was never stopped (for checkpoints)
+    """
+    def getState(self):
+        return { 'i': self.i, 'j': self.j, 'rng': self.rng.bit_generator.state }
+
+    """
+    setState
+    Carry on from a state returned by getState
+    """
+    def setState(self, state):
+        self.i = state['i']
+        self.j = state['j']
+        self.rng.bit_generator.state = state['rng']
 
 ################################################################################
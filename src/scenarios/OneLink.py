@@ -4,6 +4,7 @@ Scenario generator for exhaustively building single link scenarios.
 """
 
 from models.DirectNetworkChange import DirectNetworkChange
+from scenarios.RadiusNeighbourIndex import RadiusNeighbourIndex
 
 class OneLinkLimitR:
 
@@ -13,12 +14,14 @@ class OneLinkLimitR:
     @param numZones number of zones in the model, which limits the i and j numbers generated
     @param mode the mode number which goes into the DirectNetworkChange e.g. 0=road, 1=bus, 2=rail
     @param LijKM the distance matrix (crowfly vertex km) matching the mode param above, used to limit distances to maxRadiusKM
+    @param index optional RadiusNeighbourIndex for LijKM and maxRadiusKM (e.g. from RadiusNeighbourIndex.loadOrBuild), otherwise one is built
     """
-    def __init__(self,maxRadiusKM,numZones,mode,LijKM):
+    def __init__(self,maxRadiusKM,numZones,mode,LijKM,index=None):
         self.maxRadiusKM = maxRadiusKM
         self.N = numZones
         self.mode = mode
         self.LijKM = LijKM
+        self.index = index if index is not None else RadiusNeighbourIndex.build(LijKM,maxRadiusKM)
         self.i = 0 #origin
         self.j = 0 #destination
 
@@ -35,25 +38,35 @@ class OneLinkLimitR:
     """
     def next(self):
         result = []
-        finished=False
-        while not finished:
-            #this is to increment j and i to the next valid scenario
-            self.j+=1
-            if (self.j>=self.N):
-                self.j=0
-                self.i+=1
-                if self.i>=self.N:
-                    finished=True #no more scenarios - we're finished
-            #end if
-            
-            #now the check on maxRadiusKM and either break and exit or continue with j and i
-            #print("Scenario,",self.i,self.j,self.LijKM[self.i,self.j])
-            if not finished and self.LijKM[self.i,self.j]<=self.maxRadiusKM:
-                result = [ DirectNetworkChange(self.mode,self.i,self.j,-1) ]
-                finished=True #and we drop out of the while loop
-            #end if
-        #end while
+        #this used to increment j and i one cell at a time, checking each LijKM[i,j]<=maxRadiusKM, but the neighbour
+        #index jumps straight to the next j within the radius, on this row or the next one which has any
+        pair = self.index.nextPair(self.i,self.j)
+        if pair is None:
+            #no more scenarios - we're finished, which leaves i and j where the cell by cell version did
+            self.i = self.N
+            self.j = 0
+        else:
+            (self.i, self.j) = pair
+            result = [ DirectNetworkChange(self.mode,self.i,self.j,-1) ]
+        #end if
 
         return result
 
+################################################################################
+
+    """
+    getState
+    @returns the position in the sequence, which setState can carry on from (for checkpoints)
+    """
+    def getState(self):
+        return { 'i': self.i, 'j': self.j }
+
+    """
+    setState
+    Carry on from a position returned by getState
+    """
+    def setState(self, state):
+        self.i = state['i']
+        self.j = state['j']
+
 ################################################################################
@@ -0,0 +1,205 @@
+"""
+RadiusNeighbourIndex.py
+Compressed sparse row (CSR) index of all the destination zones j within a radius of each origin zone i,
+i.e. every (i,j) where LijKM[i,j]<=maxRadiusKM, which is what the scenario generators need.
+
+It's built once per distance matrix and radius with vectorised numpy, instead of the generators scanning
+the whole N x N distance matrix one cell at a time in Python, then the neighbours of any origin are just a
+slice of one array:
+    indices[indptr[i]:indptr[i+1]] = sorted j within maxRadiusKM of i
+The index can be cached on disk as an npz file next to the matrices (see loadOrBuild), as it's only a few
+MB for the radii the scenarios use.
+"""
+
+import os
+import zlib
+import logging
+import numpy as np
+
+class RadiusNeighbourIndex:
+
+    """
+    Constructor - use build or loadOrBuild rather than this
+    @param indptr int64 array (N+1) of the start of each origin's neighbours in indices
+    @param indices int32 array of the neighbour zone numbers, sorted within each origin
+    @param maxRadiusKM the radius the index was built for
+    @param fingerprint checksum of the distance matrix that the index was built from
+    """
+    def __init__(self, indptr, indices, maxRadiusKM, fingerprint=0):
+        self.indptr = indptr
+        self.indices = indices
+        self.maxRadiusKM = maxRadiusKM
+        self.fingerprint = fingerprint
+        self.N = len(indptr)-1
+        self.keys = None #i*N+j for every entry in indices, built by find the first time it's needed
+
+################################################################################
+
+    """
+    build
+    Build the index from a distance matrix, a block of rows at a time so the temporary masks stay small
+    @param LijKM N x N distance matrix (KM)
+    @param maxRadiusKM maximum link length, which includes links of exactly this length
+    @param tileRows number of rows to do at a time
+    @returns a new RadiusNeighbourIndex
+    """
+    @staticmethod
+    def build(LijKM, maxRadiusKM, tileRows=1024):
+        (M, N) = np.shape(LijKM)
+        counts = np.zeros(M,dtype=np.int64)
+        blocks = []
+        for r0 in range(0,M,tileRows):
+            r1 = min(r0+tileRows,M)
+            mask = np.asarray(LijKM[r0:r1])<=maxRadiusKM
+            counts[r0:r1] = mask.sum(axis=1)
+            blocks.append(np.nonzero(mask)[1].astype(np.int32)) #row major, so j is sorted within each row
+        #end for
+        indptr = np.zeros(M+1,dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        indices = np.concatenate(blocks) if blocks else np.zeros(0,dtype=np.int32)
+        return RadiusNeighbourIndex(indptr, indices, maxRadiusKM, RadiusNeighbourIndex.computeFingerprint(LijKM))
+
+################################################################################
+
+    """
+    computeFingerprint
+    Cheap checksum of a distance matrix from its shape and a sample of its cells, which is used to make sure
+    that a cached index belongs to the matrix it's being used with.
+    """
+    @staticmethod
+    def computeFingerprint(LijKM):
+        sample = np.ascontiguousarray(np.asarray(LijKM).ravel()[::997],dtype=np.float32)
+        return zlib.crc32(sample.tobytes(), zlib.crc32(np.asarray(np.shape(LijKM),dtype=np.int64).tobytes()))
+
+################################################################################
+
+    """
+    neighbours
+    @param i origin zone
+    @returns sorted int32 array of the zones j within maxRadiusKM of i (NOTE: this is a view into the index)
+    """
+    def neighbours(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    """
+    count
+    @param i origin zone
+    @returns the number of zones j within maxRadiusKM of i
+    """
+    def count(self, i):
+        return int(self.indptr[i+1]-self.indptr[i])
+
+    """
+    counts
+    @returns int64 array (N) of the number of neighbours of every origin
+    """
+    def counts(self):
+        return np.diff(self.indptr)
+
+################################################################################
+
+    """
+    find
+    Vectorised lookup of where a set of (i,j) pairs are in the index. The rows are sorted by i and then j, so
+    i*N+j is sorted over the whole of indices, which makes this one searchsorted for all the pairs.
+    @param rows int array of origin zones
+    @param cols int array of destination zones matching rows
+    @returns int64 array of the positions in indices of each pair (so position-indptr[i] is its place in
+    neighbours(i)), or -1 where j isn't a neighbour of i
+    """
+    def find(self, rows, cols):
+        if self.keys is None:
+            rowOf = np.repeat(np.arange(self.N,dtype=np.int64), self.counts())
+            self.keys = rowOf*self.N + self.indices
+        rows = np.asarray(rows,dtype=np.int64)
+        cols = np.asarray(cols,dtype=np.int64)
+        key = rows*self.N + cols
+        pos = np.searchsorted(self.keys, key)
+        found = (cols>=0) & (pos<len(self.keys))
+        found[found] = self.keys[pos[found]]==key[found]
+        return np.where(found, pos, -1)
+
+################################################################################
+
+    """
+    nextPair
+    The next (i,j) pair within the radius after (i,j) in row major order, which is the OneLinkLimitR sequence
+    @param i origin zone of the current pair
+    @param j destination zone of the current pair, -1 to start at the beginning of row i
+    @returns the next (i,j), or None if there aren't any more
+    """
+    def nextPair(self, i, j):
+        while i<self.N:
+            nbrs = self.neighbours(i)
+            n = np.searchsorted(nbrs, j, side='right') #first neighbour after j
+            if n<len(nbrs):
+                return i, int(nbrs[n])
+            i+=1
+            j=-1
+        #end while
+        return None
+
+################################################################################
+
+    """
+    save
+    Write the index to an npz file
+    """
+    def save(self, filename):
+        np.savez(filename, indptr=self.indptr, indices=self.indices,
+            maxRadiusKM=np.float64(self.maxRadiusKM), fingerprint=np.int64(self.fingerprint))
+
+    """
+    load
+    Read an index from an npz file written by save
+    @returns a new RadiusNeighbourIndex
+    """
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as data:
+            return RadiusNeighbourIndex(data['indptr'], data['indices'], float(data['maxRadiusKM']), int(data['fingerprint']))
+
+################################################################################
+
+    """
+    loadOrBuild
+    Load the cached index for a distance matrix and radius if there is a valid one, otherwise build it and
+    try to cache it for next time. If the cache can't be written (e.g. a read only inputs directory), then
+    the index is still returned, it's just not cached.
+    @param LijKM N x N distance matrix (KM)
+    @param maxRadiusKM maximum link length
+    @param cacheFilename npz file to cache the index in, or None not to cache it
+    @returns a RadiusNeighbourIndex
+    """
+    @staticmethod
+    def loadOrBuild(LijKM, maxRadiusKM, cacheFilename=None):
+        if cacheFilename is not None and os.path.exists(cacheFilename):
+            try:
+                index = RadiusNeighbourIndex.load(cacheFilename)
+                if index.maxRadiusKM==maxRadiusKM and index.fingerprint==RadiusNeighbourIndex.computeFingerprint(LijKM):
+                    logging.info('RadiusNeighbourIndex:: loaded '+str(cacheFilename))
+                    return index
+                logging.info('RadiusNeighbourIndex:: '+str(cacheFilename)+' is for a different matrix or radius, rebuilding')
+            except Exception as e:
+                logging.error('RadiusNeighbourIndex:: failed to load '+str(cacheFilename)+': '+str(e))
+        #end if
+        index = RadiusNeighbourIndex.build(LijKM, maxRadiusKM)
+        if cacheFilename is not None:
+            try:
+                index.save(cacheFilename)
+                logging.info('RadiusNeighbourIndex:: saved '+str(cacheFilename))
+            except OSError as e:
+                logging.info('RadiusNeighbourIndex:: not cached, unable to write '+str(cacheFilename)+': '+str(e))
+        return index
+
+    """
+    cacheFilename
+    @param matrixFilename the distance matrix file
+    @param maxRadiusKM the radius
+    @returns the name of the cache file to use for an index of this matrix and radius, which goes next to it
+    """
+    @staticmethod
+    def cacheFilename(matrixFilename, maxRadiusKM):
+        return str(matrixFilename)+'.radius_'+str(float(maxRadiusKM))+'KM.npz'
+
+################################################################################
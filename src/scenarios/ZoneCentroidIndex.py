@@ -0,0 +1,57 @@
+"""
+ZoneCentroidIndex.py
+Spatial index of the zone centroids from the ZoneCodes table, for snapping real world lat/lon points (e.g. the
+stations in a scenario graphml file) to their nearest zones.
+
+The centroids are converted to points on the unit sphere, so the nearest point in a KD-tree by straight line
+(chord) distance is the nearest zone by great circle distance, which a Euclidean distance on raw lat/lon isn't
+(a degree of longitude is only about 0.6 of a degree of latitude in the UK).
+The tree is built once, then any number of points can be looked up in one vectorised call.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+class ZoneCentroidIndex:
+
+    EarthRadiusKM = 6371.0
+
+    """
+    Constructor
+    @param zonecodes the ZoneCodes table, which needs zonei, lat and lon columns
+    """
+    def __init__(self, zonecodes:pd.DataFrame):
+        self.zonei = zonecodes['zonei'].to_numpy()
+        self.tree = cKDTree(ZoneCentroidIndex.toUnitSphere(zonecodes['lon'].to_numpy(),zonecodes['lat'].to_numpy()))
+
+################################################################################
+
+    """
+    toUnitSphere
+    @param lon array of longitudes (degrees)
+    @param lat array of latitudes (degrees)
+    @returns n x 3 array of the points on the unit sphere
+    """
+    @staticmethod
+    def toUnitSphere(lon, lat):
+        lon = np.radians(np.asarray(lon,dtype=np.float64))
+        lat = np.radians(np.asarray(lat,dtype=np.float64))
+        cosLat = np.cos(lat)
+        return np.column_stack((cosLat*np.cos(lon), cosLat*np.sin(lon), np.sin(lat)))
+
+################################################################################
+
+    """
+    nearestZones
+    Find the nearest zone centroid to each of a set of points
+    @param lon array of longitudes (degrees)
+    @param lat array of latitudes (degrees)
+    @returns (array of the zonei of the nearest zone to each point, array of the great circle distances to them in KM)
+    """
+    def nearestZones(self, lon, lat):
+        chord, idx = self.tree.query(ZoneCentroidIndex.toUnitSphere(np.atleast_1d(lon),np.atleast_1d(lat)))
+        distKM = 2.0*ZoneCentroidIndex.EarthRadiusKM*np.arcsin(np.minimum(chord/2.0,1.0))
+        return self.zonei[idx], distKM
+
+################################################################################
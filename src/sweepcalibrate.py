@@ -20,6 +20,7 @@ import pandas as pd
 #local imports
 from utils import loadQUANTMatrix, loadQUANTMatrixFAST
 from models.SingleOrigin import SingleOrigin
+from models.GravityKernel import GravityKernel
 from models.DirectNetworkChange import DirectNetworkChange
 from impacts.ImpactStatistics import ImpactStatistics
 from networks.NetworkUtils import NetworkUtils
@@ -27,71 +28,78 @@ from scenarios.FileScenario import FileScenario
 from scenarios.OneLink import OneLinkLimitR
 from scenarios.NLink import NLinkLimitR
 
-def sweep_calibrate(Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail, Cij_road, Cij_bus, Cij_rail):
+"""
+sweep_calibrate
+Sweep all the combinations of the three beta values and write the observed and predicted trip totals and CBar for
+each mode to a csv file, for plotting.
+This works from sufficient statistics rather than running the model for every combination. With no constraints,
+B[j]=1 and the observed Oi and Dj, every combination of betas has the same model:
+    TPred[k][i,j] = Oi[i]*Dj[j]*exp(-beta_k*Cij[k][i,j])/denom[i], denom[i] = sum_k S[k][i]
+so for each mode k, all that's needed at each beta is the vectors (see GravityKernel.computeRowStatistics)
+    S[k][i] = sum_j Dj[j]*exp(-beta_k*Cij[k][i,j]) and W[k][i] = sum_j Dj[j]*Cij[k][i,j]*exp(-beta_k*Cij[k][i,j])
+then
+    trips[k] = sum_i Oi[i]*S[k][i]/denom[i]
+    CBarPred[k] = sum_i Oi[i]*W[k][i]/denom[i] / trips[k]
+That's one pass over each Cij matrix per beta (3 x 18 for the default grid), instead of a full model run for all
+18^3 combinations, so much finer beta grids are possible.
+@param Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail observed trips matrices
+@param Cij_road, Cij_bus, Cij_rail cost matrices (minutes)
+@param precision np.float32 or np.float64, the precision of exp(-beta*Cij), as the model uses
+@param betaStart first beta of the grid (for all three modes)
+@param betaStop end of the beta grid (not included, like np.arange)
+@param betaStep beta grid spacing
+@param filename output csv file
+@param tileRows number of rows processed in one block
+"""
+def sweep_calibrate(Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail, Cij_road, Cij_bus, Cij_rail, precision=np.float64,
+        betaStart=0.02, betaStop=0.2, betaStep=0.01, filename='sweepcalibrate.csv', tileRows=1024):
     print("sweep calibrate\n")
 
-    #global output_folder
-    #global Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail
-    #global Cij_road, Cij_bus, Cij_rail
-
     qm3 = SingleOrigin()
+    qm3.dtype = precision
     qm3.TObs = [ Tij_Obs_road, Tij_Obs_bus, Tij_Obs_rail ]
     qm3.Cij = [ Cij_road, Cij_bus, Cij_rail ]
-    #constraints initialisation - no constraints as default - need to initialise B weights to all 1.0
-    qm3.isUsingConstraints=False
-    (M, N) = np.shape(Tij_Obs_road)
-    qm3.B = np.ones(N)
     #compute CijObs and CBarObs which don't change
-    CijObs_road = np.sum(qm3.TObs[0])
-    CijObs_bus = np.sum(qm3.TObs[1])
-    CijObs_rail = np.sum(qm3.TObs[2])
+    CijObs_road = np.sum(qm3.TObs[0],dtype=np.float64)
+    CijObs_bus = np.sum(qm3.TObs[1],dtype=np.float64)
+    CijObs_rail = np.sum(qm3.TObs[2],dtype=np.float64)
     CBarObs_road = qm3.calculateCBar(qm3.TObs[0], qm3.Cij[0])
     CBarObs_bus = qm3.calculateCBar(qm3.TObs[1], qm3.Cij[1])
     CBarObs_rail = qm3.calculateCBar(qm3.TObs[2], qm3.Cij[2])
+    OiObs, DjObs = qm3.computeObservedMarginals()
 
+    #the row statistics for every mode and beta
+    betas = np.arange(betaStart,betaStop,betaStep)
+    nb = len(betas)
+    S = [ np.empty((nb,len(OiObs))) for k in range(0,qm3.numModes) ]
+    W = [ np.empty((nb,len(OiObs))) for k in range(0,qm3.numModes) ]
+    for k in range(0,qm3.numModes):
+        for b in range(0,nb):
+            S[k][b], W[k][b] = GravityKernel.computeRowStatistics(qm3.Cij[k], DjObs, betas[b], precision, tileRows)
+            logging.info("sweep_calibrate: mode "+str(k)+" beta="+str(betas[b])+" statistics done")
+        #end for b
+    #end for k
 
-    with open('sweepcalibrate.csv','w') as file:
+    with open(filename,'w') as file:
         file.write('beta_road,beta_bus,beta_rail,CijObs_road,CijObs_bus,CijObs_rail,Cij_road,Cij_bus,Cij_rail,CBarObs_road,CBarObs_bus,CBarObs_rail,CBarPred_road,CBarPred_bus,CBarPred_rail\n')
-        for b1 in np.arange(0.02,0.2,0.01):
-            for b2 in np.arange(0.02,0.2,0.01):
-                for b3 in np.arange(0.02,0.2,0.01):
-                    print(f"{b1},{b2},{b3}\n")
-                    qm3.Beta = [b1,b2,b3]
-                    #qm3.run() #NO!!!!!! This is the normal calibration which forces CBarObs errors to minimum
-                    qm3.runWithChanges({}, None, False) #do a null run with no changes - takes obs mats and makes pred using betas
-                    #and return the betas here
-                    logging.info("beta (road)="+str(qm3.Beta[0])+" beta (bus)="+str(qm3.Beta[1])+" beta (rail)="+str(qm3.Beta[2]))
-                    #the float() casts are because yaml.safe_dump can't handle the numpy double conversion properly "invalid object"
-                    #calibration = {
-                    #    'beta_road':float(qm3.Beta[0]), 'beta_bus':float(qm3.Beta[1]), 'beta_rail':float(qm3.Beta[2]),
-                    #    'CBarObs_road':float(qm3.CBarObs[0]), 'CBarObs_bus':float(qm3.CBarObs[1]), 'CBarObs_rail':float(qm3.CBarObs[2]),
-                    #    'CBarPred_road':float(qm3.CBarPred[0]), 'CBarPred_bus':float(qm3.CBarPred[1]), 'CBarPred_rail':float(qm3.CBarPred[2])
-                    #}
-                    Cij_road = np.sum(qm3.TPred[0])
-                    Cij_bus = np.sum(qm3.TPred[1])
-                    Cij_rail = np.sum(qm3.TPred[2])
-                    #calculate mean predicted trips and mean observed trips (this is CBar)
-                    #TODO: this is a bit of a hack as it's manipulating lots of things owned inside of qm3
-                    qm3.CBarPred = [0.0 for k in range(0,qm3.numModes)]
-                    qm3.CBarObs = [0.0 for k in range(0,qm3.numModes)]
-                    delta = [0.0 for k in range(0,qm3.numModes)]
-                    for k in range(0,qm3.numModes):
-                        qm3.CBarPred[k] = qm3.calculateCBar(qm3.TPred[k], qm3.Cij[k])
-                        #qm3.CBarObs[k] = qm3.calculateCBar(qm3.TObs[k], qm3.Cij[k])
-                        #print("Mode "+str(k)+" CBar Pred="+str(self.CBarPred[k])+" CBar Obs="+str(self.CBarObs[k]))
-                        delta[k] = np.fabs(qm3.CBarPred[k] - qm3.CBarObs[k])
-                    #end for k
-                    print(f"{b1},{b2},{b3},{qm3.CBarPred[0]},{qm3.CBarPred[1]},{qm3.CBarPred[2]}\n")
+        for i1 in range(0,nb):
+            for i2 in range(0,nb):
+                #all the rail betas at once, so rowFactor, trips and CBarPred have a row for each rail beta
+                rowFactor = OiObs/(S[0][i1]+S[1][i2]+S[2])
+                trips = [ rowFactor.dot(S[0][i1]), rowFactor.dot(S[1][i2]), (rowFactor*S[2]).sum(axis=1) ]
+                CBarPred = [ rowFactor.dot(W[0][i1])/trips[0], rowFactor.dot(W[1][i2])/trips[1], (rowFactor*W[2]).sum(axis=1)/trips[2] ]
+                for i3 in range(0,nb):
+                    (b1, b2, b3) = (betas[i1], betas[i2], betas[i3])
+                    print(f"{b1},{b2},{b3},{CBarPred[0][i3]},{CBarPred[1][i3]},{CBarPred[2][i3]}\n")
                     file.write( f"{b1},{b2},{b3},"
                           +f"{CijObs_road},{CijObs_bus},{CijObs_rail},"
-                          +f"{Cij_road},{Cij_bus},{Cij_rail},"
+                          +f"{trips[0][i3]},{trips[1][i3]},{trips[2][i3]},"
                           +f"{CBarObs_road},{CBarObs_bus},{CBarObs_rail},"
-                          +f"{qm3.CBarPred[0]},{qm3.CBarPred[1]},{qm3.CBarPred[2]}\n"
+                          +f"{CBarPred[0][i3]},{CBarPred[1][i3]},{CBarPred[2][i3]}\n"
                     )
-                    file.flush()
                 #end for b3
+                file.flush()
             #end for b2
         #end for b1
     #end open
 #end def
-
@@ -0,0 +1,37 @@
+"""
+synthetic.py
+Small synthetic QUANT style model data for unit tests that don't need the full model-runs matrices.
+Zones are scattered randomly over a 100km square. The cost matrices are straight line times plus a
+fixed access time for each mode, so they satisfy the triangle inequality just like the real
+shortest path matrices do.
+"""
+
+import numpy as np
+
+"""
+makeSyntheticData
+@param N number of zones
+@param seed random seed, so the data is repeatable
+@param dtype precision of the returned matrices (the data is always float32 representable, like the .bin files)
+@returns TObs[3], Cij[3] (minutes), Lij[3] (KM) lists of N x N matrices for road, bus and rail
+"""
+def makeSyntheticData(N=100, seed=1, dtype=np.float64):
+    rng = np.random.default_rng(seed)
+    xy = rng.random((N,2))*100.0
+    dist = np.sqrt(((xy[:,None,:]-xy[None,:,:])**2).sum(axis=2))
+    speedKPH = [50.0, 25.0, 80.0]
+    accessMins = [5.0, 15.0, 20.0]
+    betas = [0.12, 0.07, 0.06]
+    population = rng.gamma(2.0,500.0,N)
+    jobs = rng.gamma(2.0,500.0,N)
+    TObs = []
+    Cij = []
+    Lij = []
+    for k in range(0,3):
+        cij = (dist/speedKPH[k]*60.0+accessMins[k]).astype(np.float32)
+        tij = (np.outer(population,jobs)*np.exp(-betas[k]*cij)*rng.random((N,N))/1.0e4).astype(np.float32)
+        lij = (dist*(1.1+0.1*k)).astype(np.float32)
+        TObs.append(tij.astype(dtype))
+        Cij.append(cij.astype(dtype))
+        Lij.append(lij.astype(dtype))
+    return TObs, Cij, Lij
@@ -0,0 +1,116 @@
+"""
+unit test for RUN batch checkpoints and the scenario generator states
+python -m unittest discover
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+
+from checkpoint import RunCheckpoint
+from scenarios.OneLink import OneLinkLimitR
+from scenarios.NLink import NLinkLimitR
+from unittests.synthetic import makeSyntheticData
+
+class Test_CheckpointMethods(unittest.TestCase):
+
+    def setUp(self):
+        TObs, Cij, Lij = makeSyntheticData(60)
+        self.Lij = Lij
+    ###
+
+    def scenarioList(self, generator, n):
+        return [ [ (nc.mode, nc.originZonei, nc.destinationZonei) for nc in generator.next() ] for i in range(0,n) ]
+    ###
+
+    def test_generatorState(self):
+        print("test scenario generator getState and setState")
+        for makeGenerator in [ lambda: OneLinkLimitR(20.0,60,0,self.Lij[0]), lambda: NLinkLimitR(3,20.0,60,1,self.Lij[1]) ]:
+            #run 5 scenarios, save the state, then check another generator carries on with the same 5 as the first one
+            g1 = makeGenerator()
+            self.scenarioList(g1, 5)
+            state = g1.getState()
+            expected = self.scenarioList(g1, 5)
+            g2 = makeGenerator()
+            g2.setState(state)
+            self.assertEqual(self.scenarioList(g2, 5), expected)
+    ###
+
+    def test_runCheckpoint(self):
+        print("test RunCheckpoint save, load and stop")
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir,'run_checkpoint.yaml')
+            settings = { 'mode': 1, 'radiusKM': 5.0, 'numLinks': 2 }
+            generator = NLinkLimitR(2,20.0,60,1,self.Lij[1])
+            checkpoint = RunCheckpoint(filename,settings,every=3)
+            self.assertIsNone(checkpoint.load())
+            checkpoint.begin()
+            with open(os.path.join(dir,'impacts.csv'),'w') as f:
+                for i in range(0,4):
+                    generator.next()
+                    f.write('row'+str(i)+'\n')
+                    f.flush()
+                    self.assertTrue(checkpoint.scenarioFinished(f,i+1,generator.getState()))
+                    if i==2:
+                        offset = f.tell()
+                        state = generator.getState()
+                #only every 3 scenarios
+                resume = checkpoint.load()
+                self.assertEqual(resume['nextIteration'], 3)
+                self.assertEqual(resume['offset'], offset)
+                #SIGTERM stops after the current scenario and always checkpoints
+                checkpoint.stopRequested = True
+                f.write('row4\n')
+                f.flush()
+                self.assertFalse(checkpoint.scenarioFinished(f,5,generator.getState()))
+                self.assertEqual(checkpoint.load()['nextIteration'], 5)
+            #the state round trips through the yaml file
+            g2 = NLinkLimitR(2,20.0,60,1,self.Lij[1])
+            g2.setState(state)
+            expected = self.scenarioList(g2,3)
+            g2.setState(resume['generatorState'])
+            self.assertEqual(self.scenarioList(g2,3), expected)
+            #different settings mean a different batch
+            self.assertIsNone(RunCheckpoint(filename,{ 'mode': 2, 'radiusKM': 5.0, 'numLinks': 2 }).load())
+            #the wall clock budget
+            checkpoint2 = RunCheckpoint(filename,settings,maxWallClockSecs=1.0e-6)
+            self.assertTrue(checkpoint2.shouldStop())
+            checkpoint.finish()
+            self.assertFalse(os.path.exists(filename))
+    ###
+
+    def test_restoreFiles(self):
+        print("test RunCheckpoint cuts the other files back with the impacts file")
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir,'run_checkpoint.yaml')
+            histogramFilename = os.path.join(dir,'trip_lengths.csv')
+            with open(histogramFilename,'w') as hf:
+                hf.write('header\n')
+            checkpoint = RunCheckpoint(filename,{},every=3)
+            with open(os.path.join(dir,'impacts.csv'),'w') as f:
+                #the job is killed after 5 scenarios, which is after the checkpoint at 3
+                for i in range(0,5):
+                    f.write('row'+str(i)+'\n')
+                    f.flush()
+                    with open(histogramFilename,'a') as hf:
+                        hf.write('hist'+str(i)+'\n')
+                    checkpoint.scenarioFinished(f,i+1,{},[histogramFilename])
+            resume = checkpoint.load()
+            self.assertEqual(resume['nextIteration'], 3)
+            RunCheckpoint.restoreFiles(resume)
+            with open(histogramFilename,'r') as hf:
+                self.assertEqual(hf.read(), 'header\nhist0\nhist1\nhist2\n')
+            #resuming again from the same checkpoint gives the same file
+            RunCheckpoint.restoreFiles(resume)
+            self.assertEqual(os.path.getsize(histogramFilename), resume['fileOffsets'][histogramFilename])
+            #and a checkpoint without any other files leaves them alone
+            with open(os.path.join(dir,'impacts.csv'),'a') as f:
+                RunCheckpoint(filename,{},every=1).scenarioFinished(f,1,{})
+            RunCheckpoint.restoreFiles(checkpoint.load())
+            self.assertEqual(os.path.getsize(histogramFilename), resume['fileOffsets'][histogramFilename])
+    ###
+
+
+if __name__ == '__main__':
+    unittest.main()
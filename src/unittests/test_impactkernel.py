@@ -0,0 +1,232 @@
+"""
+unit test for the fused impacts kernel against numpy, using synthetic data
+python -m unittest discover
+"""
+
+import unittest
+import copy
+import gzip
+import importlib.util
+import tempfile
+import pathlib
+import numpy as np
+import pandas as pd
+
+from models.SingleOrigin import SingleOrigin
+from models.DirectNetworkChange import DirectNetworkChange
+from models.ScenarioOverlay import ScenarioOverlay
+from impacts.ImpactKernel import ImpactKernel
+from impacts.ImpactStatistics import ImpactStatistics
+from impacts.ImpactAccumulator import ImpactAccumulator
+from unittests.synthetic import makeSyntheticData
+
+class Test_ImpactKernelMethods(unittest.TestCase):
+
+    def test_computeModeStatistics(self):
+        print("test fused impacts kernel against numpy")
+        N = 90
+        for dtype in [np.float64, np.float32]:
+            TObs, Cij, Lij = makeSyntheticData(N, dtype=dtype)
+            C2 = np.copy(Cij[0])
+            C2[3:7,10:40] *= 0.5 #some quicker trips
+            C2[50,60] *= 2.0 #and a slower one, which doesn't count
+            T2 = TObs[0]*dtype(1.1)
+            stats = ImpactKernel.computeModeStatistics(TObs[0], T2, Cij[0], C2, Lij[0], True, True)
+            diff = Cij[0].astype(np.float64)-C2
+            expected = [
+                np.sum(TObs[0],dtype=np.float64), np.sum(T2,dtype=np.float64),
+                np.sum(TObs[0].astype(np.float64)*Lij[0]), np.sum(T2.astype(np.float64)*Lij[0]),
+                np.count_nonzero(diff>0), np.sum(diff[diff>0])
+            ]
+            self.assertEqual(stats[4], 4*30)
+            for value, check in zip(stats, expected):
+                self.assertAlmostEqual(value, check, delta=1.0e-12*check)
+            #parts switched off
+            stats = ImpactKernel.computeModeStatistics(TObs[0], TObs[0], TObs[0], TObs[0], Lij[0], False, False)
+            self.assertEqual(stats[1], 0.0)
+            self.assertEqual(stats[4], 0)
+            nMinus, savedSecs = ImpactKernel.computeCostChanges(Cij[0], C2)
+            self.assertEqual(nMinus, expected[4])
+            self.assertAlmostEqual(savedSecs, expected[5], delta=1.0e-12*expected[5])
+    ###
+
+    def test_compute(self):
+        print("test ImpactStatistics.compute against numpy")
+        N = 80
+        TObs, Cij, Lij = makeSyntheticData(N)
+        qm3_base = SingleOrigin()
+        qm3_base.TObs = TObs
+        qm3_base.Cij = Cij
+        qm3_base.B = np.ones(N)
+        qm3_base.Beta = [0.13, 0.073, 0.065]
+        qm3_base.fastComputePredicted()
+        networkChanges = [ DirectNetworkChange(0,5,60,60.0), DirectNetworkChange(2,7,8,30.0) ]
+        for incremental in [False, True]:
+            overlay = ScenarioOverlay(qm3_base.Cij)
+            qm3 = copy.copy(qm3_base)
+            ledger = qm3.runWithChanges({}, copy.deepcopy(networkChanges), False, incremental, overlay)
+            self.assertIs(ledger, qm3.changeLedger)
+            for withOverlay in [False, True]:
+                impacts = ImpactStatistics()
+                impacts.verifyLedger = True #nMinus and savedSecs come from the ledger, checked against the whole Cij
+                impacts.compute(qm3_base, qm3, Lij, networkChanges, overlay if withOverlay else None)
+                for k in range(0,qm3.numModes):
+                    T2 = np.asarray(qm3.TPred[k])
+                    self.assertAlmostEqual(impacts.Ck1[k], np.sum(qm3_base.TPred[k]), delta=1.0e-12*impacts.Ck1[k])
+                    self.assertAlmostEqual(impacts.Ck2[k], np.sum(T2), delta=1.0e-12*impacts.Ck2[k])
+                    self.assertAlmostEqual(impacts.Lk1[k], np.sum(qm3_base.TPred[k]*Lij[k]), delta=1.0e-12*impacts.Lk1[k])
+                    self.assertAlmostEqual(impacts.Lk2[k], np.sum(T2*Lij[k]), delta=1.0e-12*impacts.Lk2[k])
+                    self.assertAlmostEqual(impacts.deltaLk[k], impacts.Lk2[k]-impacts.Lk1[k], delta=1.0e-6*impacts.Lk1[k])
+                    diff = qm3_base.Cij[k]-qm3.Cij[k]
+                    self.assertEqual(impacts.nMinus_k[k], np.count_nonzero(diff>0))
+                    self.assertAlmostEqual(float(impacts.savedSecs_k[k]), np.sum(diff[diff>0]), delta=1.0e-9)
+            #a ledger which doesn't match the Cij fails the check
+            ledger.record(1, np.array([[1,2]]), [100.0], [1.0])
+            impacts = ImpactStatistics()
+            impacts.verifyLedger = True
+            with self.assertRaises(RuntimeError):
+                impacts.compute(qm3_base, qm3, Lij, networkChanges, overlay)
+            overlay.reset()
+        #end for
+    ###
+
+    def test_baselineTotals(self):
+        print("test the baseline totals are only worked out once")
+        N = 80
+        TObs, Cij, Lij = makeSyntheticData(N)
+        qm3_base = SingleOrigin()
+        qm3_base.TObs = TObs
+        qm3_base.Cij = Cij
+        qm3_base.B = np.ones(N)
+        qm3_base.Beta = [0.13, 0.073, 0.065]
+        qm3_base.fastComputePredicted()
+        overlay = ScenarioOverlay(qm3_base.Cij)
+        totals = None
+        for networkChanges in [ [DirectNetworkChange(0,5,60,60.0)], [DirectNetworkChange(2,7,8,30.0)] ]:
+            overlay.reset()
+            qm3 = copy.copy(qm3_base)
+            qm3.runWithChanges({}, networkChanges, False, True, overlay)
+            impacts = ImpactStatistics()
+            impacts.compute(qm3_base, qm3, Lij, networkChanges, overlay)
+            impacts.computeZones(qm3_base, qm3, Lij, networkChanges)
+            if totals is None:
+                totals = ImpactStatistics.getBaselineTotals(qm3_base, Lij)
+            self.assertIs(ImpactStatistics.getBaselineTotals(qm3_base, Lij), totals) #the same for every scenario
+            for k in range(0,qm3.numModes):
+                T2 = qm3.TPred[k].materialise()
+                self.assertAlmostEqual(impacts.Ck1[k], np.sum(qm3_base.TPred[k]), delta=1.0e-12*impacts.Ck1[k])
+                self.assertAlmostEqual(impacts.Ck2[k], np.sum(T2), delta=1.0e-12*impacts.Ck2[k])
+                self.assertAlmostEqual(impacts.Lk1[k], np.sum(qm3_base.TPred[k]*Lij[k]), delta=1.0e-12*impacts.Lk1[k])
+                self.assertAlmostEqual(impacts.Lk2[k], np.sum(T2*Lij[k]), delta=1.0e-12*impacts.Lk2[k])
+                self.assertTrue(np.allclose(impacts.Cik1[k], np.sum(qm3_base.TPred[k],axis=1), rtol=1.0e-12, atol=0.0))
+                self.assertTrue(np.allclose(impacts.Cjk1[k], np.sum(qm3_base.TPred[k],axis=0), rtol=1.0e-12, atol=0.0))
+                self.assertTrue(np.allclose(impacts.Cik2[k], np.sum(T2,axis=1), rtol=1.0e-12, atol=0.0))
+                self.assertTrue(np.allclose(impacts.Cjk2[k], np.sum(T2,axis=0), rtol=1.0e-12, atol=0.0))
+        #a new baseline TPred means new totals
+        qm3_base.Beta = [0.13, 0.08, 0.065]
+        qm3_base.fastComputePredicted()
+        newTotals = ImpactStatistics.getBaselineTotals(qm3_base, Lij)
+        self.assertIsNot(newTotals, totals)
+        for k in range(0,qm3_base.numModes):
+            self.assertAlmostEqual(newTotals.Ck[k], np.sum(qm3_base.TPred[k]), delta=1.0e-12*newTotals.Ck[k])
+    ###
+
+    def test_statisticsOnly(self):
+        print("test statistics only scenario runs against the TPred matrices")
+        N = 70
+        TObs, Cij, Lij = makeSyntheticData(N)
+        qm3_base = SingleOrigin()
+        qm3_base.TObs = TObs
+        qm3_base.Cij = Cij
+        qm3_base.B = np.ones(N)
+        qm3_base.Beta = [0.13, 0.073, 0.065]
+        qm3_base.tileRows = 16
+        qm3_base.fastComputePredicted()
+        binsKM = [0.0, 10.0, 25.0, 50.0]
+        baselineTotals = ImpactAccumulator.fromMatrices(qm3_base.TPred, Lij, binsKM, 9)
+        networkChanges = [ DirectNetworkChange(0,5,60,60.0), DirectNetworkChange(1,20,21,30.0) ]
+        for incremental in [False, True]:
+            results = []
+            for statisticsOnly in [False, True]:
+                overlay = ScenarioOverlay(qm3_base.Cij)
+                qm3 = copy.copy(qm3_base)
+                scenarioTotals = baselineTotals.copy() if statisticsOnly else None
+                qm3.runWithChanges({}, copy.deepcopy(networkChanges), False, incremental, overlay, scenarioTotals)
+                impacts = ImpactStatistics()
+                if statisticsOnly:
+                    self.assertEqual(qm3.TPred, []) #nothing kept
+                    impacts.computeFromAccumulators(baselineTotals, scenarioTotals, qm3_base, qm3, Lij, networkChanges, overlay)
+                else:
+                    impacts.compute(qm3_base, qm3, Lij, networkChanges, overlay)
+                    impacts.computeZones(qm3_base, qm3, Lij, networkChanges)
+                    TPred = [ np.asarray(T) for T in qm3.TPred ]
+                results.append(impacts)
+            (check, impacts) = results
+            for name in ['Ck1','Ck2','Lk1','Lk2']:
+                self.assertTrue(np.allclose(getattr(impacts,name), getattr(check,name), rtol=1.0e-12, atol=0.0))
+            for name in ['CkDiff','deltaLk']:
+                self.assertTrue(np.allclose(getattr(impacts,name), getattr(check,name), rtol=1.0e-6, atol=1.0e-6))
+            for name in ['Cik2','Cjk2','CikDiff','CjkDiff']:
+                self.assertTrue(np.allclose(getattr(impacts,name), getattr(check,name), rtol=1.0e-9, atol=1.0e-9))
+            self.assertEqual(impacts.nMinus_k, check.nMinus_k)
+            for k in range(0,qm3_base.numModes):
+                #the histogram has everything from the last edge up in the last bin
+                expected, edges = np.histogram(Lij[k], bins=binsKM+[np.inf], weights=TPred[k])
+                self.assertTrue(np.allclose(impacts.LkHist2[k], expected, rtol=1.0e-9, atol=1.0e-9))
+                self.assertAlmostEqual(np.sum(impacts.LkHist2[k]), impacts.Ck2[k], delta=1.0e-9*impacts.Ck2[k])
+            self.assertEqual(len(impacts.histogramCsvRows(0).splitlines()), 3)
+    ###
+    def makeZoneImpacts(self, N):
+        impacts = ImpactStatistics()
+        rng = np.random.default_rng(7)
+        for name in ['Cik1','Cik2','CikDiff','Cjk1','Cjk2','CjkDiff']:
+            setattr(impacts, name, rng.random((3,N))*1000.0)
+        #zone codes out of order, as they come from the xml
+        df_zonecodes = pd.DataFrame({ 'zonei': np.arange(N)[::-1], 'areakey': [ 'E0200'+str(N-1-i) for i in range(0,N) ] })
+        return impacts, df_zonecodes
+
+    def test_writeStatisticsFile(self):
+        print("test the zone statistics file against the original row by row writer")
+        N = 50
+        impacts, df_zonecodes = self.makeZoneImpacts(N)
+        #the original writer, which the csv must match exactly
+        expected = 'zonei,zonecode,' \
+            +'Cik1_road,Cik1_bus,Cik1_rail,Cik2_road,Cik2_bus,Cik2_rail,CikDiff_road,CikDiff_bus,CikDiff_rail,' \
+            +'Cjk1_road,Cjk1_bus,Cjk1_rail,Cjk2_road,Cjk2_bus,Cjk2_rail,CjkDiff_road,CjkDiff_bus,CjkDiff_rail\n'
+        for i in range(0,N):
+            zonecode = df_zonecodes[df_zonecodes['zonei'] == i]['areakey'].values[0]
+            expected += str(i)+','+zonecode+','
+            for C in [impacts.Cik1, impacts.Cik2, impacts.CikDiff, impacts.Cjk1, impacts.Cjk2, impacts.CjkDiff]:
+                expected += f'{C[0,i]},{C[1,i]},{C[2,i]},'
+            expected = expected[:-1]+'\n'
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = pathlib.Path(tmp).joinpath('impacts_zones.csv')
+            impacts.writeStatisticsFile(filename, df_zonecodes)
+            self.assertEqual(filename.read_text(), expected)
+            filename = pathlib.Path(tmp).joinpath('impacts_zones.csv.gz')
+            impacts.writeStatisticsFile(filename, ImpactStatistics.zoneAreaKeys(df_zonecodes, N))
+            with gzip.open(filename, 'rt') as f:
+                self.assertEqual(f.read(), expected)
+            with self.assertRaises(ValueError):
+                impacts.writeStatisticsFile(pathlib.Path(tmp).joinpath('impacts_zones.txt'), df_zonecodes)
+        with self.assertRaises(ValueError):
+            ImpactStatistics.zoneAreaKeys(df_zonecodes[1:], N) #a zone with no areakey
+    ###
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow is needed for parquet and feather")
+    def test_writeStatisticsFileColumnar(self):
+        print("test the parquet and feather zone statistics files")
+        N = 50
+        impacts, df_zonecodes = self.makeZoneImpacts(N)
+        expected = impacts.zoneStatisticsFrame(df_zonecodes)
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, read in [('impacts_zones.parquet', pd.read_parquet), ('impacts_zones.feather', pd.read_feather)]:
+                filename = pathlib.Path(tmp).joinpath(name)
+                impacts.writeStatisticsFile(filename, df_zonecodes)
+                df = read(filename)
+                self.assertEqual(list(df.columns), ImpactStatistics.zoneStatisticsColumns())
+                pd.testing.assert_frame_equal(df, expected)
+    ###
+
+if __name__ == '__main__':
+    unittest.main()
@@ -73,7 +73,10 @@ class Test_ImpactStatisticsMethods(unittest.TestCase):
         #numpy
         #self.assertListEqual(Lk,[249384316.8240262, 20818796.246591613, 54944873.84144509],"Lk check failure NUMPY")
         #JAX
-        self.assertListEqual(Lk,[2.4938435e+08, 20818800.0, 54944868.0],"Lk check failure JAX")
+        #self.assertListEqual(Lk,[2.4938435e+08, 20818800.0, 54944868.0],"Lk check failure JAX")
+        #fused kernel - float64 sums like numpy, but added up in a different order
+        for k, expected in enumerate([249384316.8240262, 20818796.246591613, 54944873.84144509]):
+            self.assertAlmostEqual(Lk[k], expected, delta=1.0e-9*expected, msg="Lk check failure")
     ###
         
     def test_computeScenarioLinkStatistics(self):
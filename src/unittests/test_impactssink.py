@@ -0,0 +1,120 @@
+"""
+unit test for the buffered impacts sinks and resuming them from a checkpoint
+python -m unittest discover
+"""
+
+import unittest
+import os
+import io
+import tempfile
+import pathlib
+import importlib.util
+import numpy as np
+import pandas as pd
+
+from models.DirectNetworkChange import DirectNetworkChange
+from impacts.ImpactStatistics import ImpactStatistics
+from impacts.ImpactsSink import ImpactsSink, BinaryImpactsSink
+from checkpoint import RunCheckpoint
+
+class Test_ImpactsSinkMethods(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.scenarios = []
+        for i in range(0,23):
+            impacts = ImpactStatistics()
+            for name in ['Ck1','Ck2','CkDiff','Lk1','Lk2','deltaLk','scenarioLinkKM_k','scenarioLinkSavedSecs_k','LBar_k','savedSecs_k']:
+                setattr(impacts, name, list(rng.random(3)*1.0e6))
+            impacts.scenarioLinkDepth_k = [ 0, 2, 0 ]
+            impacts.nMinus_k = [ int(n) for n in rng.integers(0,1000,3) ]
+            networkChanges = [ DirectNetworkChange(1,int(rng.integers(0,100)),int(rng.integers(0,100)),float(rng.random()*600.0)) for n in range(0,2) ]
+            self.scenarios.append((i, impacts, networkChanges))
+    ###
+
+    """
+    runBatch
+    Add scenarios start..end-1 to the sink, with a checkpoint every 4
+    @returns the checkpoint offset after the last scenario which was a multiple of 4
+    """
+    def runBatch(self, sink, checkpoint, start, end):
+        for (i, impacts, networkChanges) in self.scenarios[start:end]:
+            sink.add(i, impacts, networkChanges)
+            checkpoint.scenarioFinished(sink, i+1, {})
+        return checkpoint.load()['offset']
+
+    """
+    checkResume
+    Run the batch, "crash" part way through, then resume it from the checkpoint, which must give the same file as
+    running it straight through
+    @returns the filename of the resumed batch
+    """
+    def checkResume(self, tmp, format, read):
+        filename = pathlib.Path(tmp).joinpath('impacts.'+format)
+        with ImpactsSink.open(filename, 2, 3) as sink:
+            self.runBatch(sink, RunCheckpoint(os.path.join(tmp,'checkpoint.yaml'),{},4), 0, len(self.scenarios))
+        expected = read(filename)
+        self.assertEqual(len(expected), len(self.scenarios))
+        #the job is killed after 15 scenarios, with a batch of 3 written since the checkpoint at 12
+        sink = ImpactsSink.open(filename, 2, 3)
+        offset = self.runBatch(sink, RunCheckpoint(os.path.join(tmp,'checkpoint.yaml'),{},4), 0, 15)
+        self.assertEqual(sink.count, 0)
+        self.assertNotEqual(sink.tell(), offset)
+        #resume from the checkpoint at 12
+        with ImpactsSink.open(filename, 2, 3, offset) as sink:
+            self.runBatch(sink, RunCheckpoint(os.path.join(tmp,'checkpoint.yaml'),{},4), 12, len(self.scenarios))
+        pd.testing.assert_frame_equal(read(filename), expected)
+        return filename
+
+    def test_csv(self):
+        print("test the csv impacts sink")
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = self.checkResume(tmp, 'csv', pd.read_csv)
+            #same header, and the same values as the original row by row writer
+            text = ImpactStatistics.csvHeader(2)
+            for (i, impacts, networkChanges) in self.scenarios:
+                text += impacts.csvRow(i, networkChanges)
+            self.assertEqual(filename.read_text().splitlines()[0], text.splitlines()[0])
+            pd.testing.assert_frame_equal(pd.read_csv(filename), pd.read_csv(io.StringIO(text)), check_dtype=False)
+            #nothing is written until a batch is full
+            with ImpactsSink.open(filename, 2, 10) as sink:
+                size = os.path.getsize(filename)
+                for (i, impacts, networkChanges) in self.scenarios[0:9]:
+                    sink.add(i, impacts, networkChanges)
+                self.assertEqual(os.path.getsize(filename), size)
+                #a scenario with more links adds columns to its row, like ImpactStatistics.csvRow
+                (i, impacts, networkChanges) = self.scenarios[9]
+                sink.add(i, impacts, networkChanges+networkChanges[0:1])
+            lines = filename.read_text().splitlines()
+            self.assertEqual(len(lines), 11)
+            self.assertEqual(lines[10], impacts.csvRow(i, networkChanges+networkChanges[0:1]).strip())
+    ###
+
+    def test_binary(self):
+        print("test the binary impacts sink")
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = self.checkResume(tmp, 'bin', lambda filename: pd.DataFrame(np.array(BinaryImpactsSink.read(filename))))
+            records = BinaryImpactsSink.read(filename)
+            (i, impacts, networkChanges) = self.scenarios[20]
+            self.assertEqual(records[20]['idx'], 20)
+            self.assertEqual(records[20]['nMinusBus'], impacts.nMinus_k[1])
+            self.assertEqual(records[20]['Ck2Rail'], impacts.Ck2[2])
+            self.assertEqual(records[20]['net_secs_1'], networkChanges[1].absoluteTimeSecs)
+            #the records have a fixed number of links
+            with ImpactsSink.open(filename, 2, 10) as sink:
+                with self.assertRaises(ValueError):
+                    sink.add(i, impacts, networkChanges+networkChanges)
+            #the base class only buffers, it can't write
+            with self.assertRaises(TypeError):
+                ImpactsSink(filename, 2, 10)
+    ###
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow is needed for parquet")
+    def test_parquet(self):
+        print("test the parquet impacts sink")
+        with tempfile.TemporaryDirectory() as tmp:
+            self.checkResume(tmp, 'parquet', pd.read_parquet)
+    ###
+
+if __name__ == '__main__':
+    unittest.main()
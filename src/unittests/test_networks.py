@@ -0,0 +1,129 @@
+"""
+unit test for the modified all pairs shortest paths code using synthetic cost matrices
+python -m unittest discover
+"""
+
+import unittest
+import numpy as np
+
+from networks.ModifiedZonesAPSP import ModifiedZonesAPSP
+from networks.NetworkChangeLedger import NetworkChangeLedger
+from impacts.ImpactKernel import ImpactKernel
+from unittests.synthetic import makeSyntheticData
+
+class Test_ModifiedZonesAPSPMethods(unittest.TestCase):
+
+    def setUp(self):
+        TObs, Cij, Lij = makeSyntheticData(120)
+        self.Cij = Cij
+        #links as (mode, origin, destination, minutes)
+        self.links = [ (0,3,40,1.0), (1,10,11,0.5), (2,100,7,2.0), (1,5,6,1000.0) ]
+    ###
+
+    def test_computeModAPSPCells(self):
+        print("test computeModAPSPCells")
+        for (k, O, D, mins) in self.links:
+            dis1 = np.copy(self.Cij[k])
+            dis2 = np.copy(self.Cij[k])
+            count1, saved1 = ModifiedZonesAPSP.computeModAPSP(dis1, O, D, mins)
+            count2, saved2, cells = ModifiedZonesAPSP.computeModAPSPCells(dis2, O, D, mins)
+            self.assertEqual(count1, count2)
+            self.assertAlmostEqual(saved1, saved2)
+            self.assertTrue(np.array_equal(dis1, dis2))
+            #the cells list must be exactly the cells which changed
+            changed = np.argwhere(dis2!=self.Cij[k])
+            self.assertEqual(len(cells), count2)
+            self.assertTrue(np.array_equal(cells, changed))
+    ###
+
+    def test_computeModAPSPPruned(self):
+        print("test computeModAPSPPruned")
+        #apply all the links in turn to the same matrices, both ways around like runWithChanges does
+        dis1 = [np.copy(C) for C in self.Cij]
+        dis2 = [np.copy(C) for C in self.Cij]
+        for (k, O, D, mins) in self.links:
+            for (a, b) in [(O, D), (D, O)]:
+                count1, saved1, cells1 = ModifiedZonesAPSP.computeModAPSPCells(dis1[k], a, b, mins)
+                count2, saved2, cells2 = ModifiedZonesAPSP.computeModAPSPPruned(dis2[k], a, b, mins)
+                self.assertEqual(count1, count2)
+                self.assertAlmostEqual(saved1, saved2, delta=1.0e-9*max(1.0,saved1))
+                self.assertTrue(np.array_equal(cells1, cells2))
+                self.assertTrue(np.array_equal(dis1[k], dis2[k]))
+        #and with the link written into dis first, as runWithChanges does, against the original full walk
+        dis1 = [np.copy(C) for C in self.Cij]
+        dis2 = [np.copy(C) for C in self.Cij]
+        for (k, O, D, mins) in self.links+[ (0,60,70,3.0) ]:
+            for dis in [dis1[k], dis2[k]]:
+                dis[O,D] = mins
+                dis[D,O] = mins
+            for (a, b) in [(O, D), (D, O)]:
+                count1, saved1 = ModifiedZonesAPSP.computeModAPSP(dis1[k], a, b, mins)
+                count2, saved2, cells2 = ModifiedZonesAPSP.computeModAPSPPruned(dis2[k], a, b, mins)
+                self.assertEqual(count1, count2)
+                self.assertAlmostEqual(saved1, saved2, delta=1.0e-9*max(1.0,saved1))
+                self.assertTrue(np.array_equal(dis1[k], dis2[k]))
+    ###
+
+    def test_computeModAPSPSymmetric(self):
+        print("test computeModAPSPSymmetric")
+        #against the original full walk both ways around, with and without the link written into dis first (as
+        #runWithChanges does)
+        for isWritten in [False, True]:
+            dis1 = [np.copy(C) for C in self.Cij]
+            dis2 = [np.copy(C) for C in self.Cij]
+            for (k, O, D, mins) in self.links+[ (0,60,70,3.0) ]:
+                if isWritten:
+                    for dis in [dis1[k], dis2[k]]:
+                        dis[O,D] = mins
+                        dis[D,O] = mins
+                count1, saved1, cells1 = ModifiedZonesAPSP.computeModAPSPCells(dis1[k], O, D, mins)
+                count2, saved2, cells2 = ModifiedZonesAPSP.computeModAPSPCells(dis1[k], D, O, mins)
+                before = np.copy(dis2[k])
+                count, saved, cells, oldCosts = ModifiedZonesAPSP.computeModAPSPSymmetric(dis2[k], O, D, mins)
+                self.assertTrue(np.array_equal(dis1[k], dis2[k]))
+                self.assertAlmostEqual(saved, saved1+saved2, delta=1.0e-9*max(1.0,saved))
+                #cells are the distinct cells changed by either direction, in row major order
+                changed = np.unique(np.concatenate((cells1, cells2)), axis=0)
+                self.assertEqual(count, len(changed))
+                self.assertTrue(np.array_equal(cells, changed))
+                self.assertTrue(np.array_equal(cells, np.argwhere(dis2[k]!=before)))
+                self.assertTrue(np.array_equal(oldCosts, before[cells[:,0],cells[:,1]]))
+    ###
+
+    def test_networkChangeLedger(self):
+        print("test NetworkChangeLedger against comparing the whole Cij")
+        dis = [np.copy(C) for C in self.Cij]
+        disCheck = [np.copy(C) for C in self.Cij] #with the original full walk, like the baseline runWithChanges
+        (M, N) = np.shape(dis[0])
+        ledger = NetworkChangeLedger(len(dis), N)
+        #the same link twice, and a link which is slower than the existing path, so cells are written more than once
+        for (k, O, D, mins) in self.links+[ (0,3,40,0.5), (0,40,41,0.25), (0,60,70,3.0) ]:
+            link = np.array([[O,D],[D,O]],dtype=np.int64)
+            oldCosts = np.array(dis[k][link[:,0],link[:,1]])
+            dis[k][O,D] = mins
+            dis[k][D,O] = mins
+            ledger.record(k, link, oldCosts, dis[k][link[:,0],link[:,1]])
+            count, saved, cells, oldCosts = ModifiedZonesAPSP.computeModAPSPSymmetric(dis[k], O, D, mins)
+            ledger.record(k, cells, oldCosts, dis[k][cells[:,0],cells[:,1]])
+            ledger.recordAPSP(k, count, saved)
+            disCheck[k][O,D] = mins
+            disCheck[k][D,O] = mins
+            ModifiedZonesAPSP.computeModAPSP(disCheck[k], O, D, mins)
+            ModifiedZonesAPSP.computeModAPSP(disCheck[k], D, O, mins)
+        #end for
+        nMinus, savedSecs = ledger.computeNetworkStatistics()
+        for k in range(0,len(dis)):
+            nMinusCheck, savedSecsCheck = ImpactKernel.computeCostChanges(self.Cij[k], dis[k])
+            self.assertEqual(nMinus[k], nMinusCheck)
+            self.assertAlmostEqual(savedSecs[k], savedSecsCheck, delta=1.0e-9*max(1.0,savedSecsCheck))
+            rows, cols = ledger.changedCells(k)
+            self.assertTrue(np.array_equal(np.stack((rows,cols),axis=1), np.argwhere(dis[k]!=self.Cij[k])))
+            #and the statistics are the ones the original full walk gives
+            self.assertTrue(np.array_equal(dis[k], disCheck[k]))
+            nMinusCheck, savedSecsCheck = ImpactKernel.computeCostChanges(self.Cij[k], disCheck[k])
+            self.assertEqual(nMinus[k], nMinusCheck)
+            self.assertAlmostEqual(savedSecs[k], savedSecsCheck, delta=1.0e-9*max(1.0,savedSecsCheck))
+    ###
+
+if __name__ == '__main__':
+    unittest.main()
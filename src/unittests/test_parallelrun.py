@@ -0,0 +1,77 @@
+"""
+unit test for the parallel scenario runner using synthetic data
+python -m unittest discover
+"""
+
+import unittest
+import copy
+import tempfile
+import pathlib
+import numpy as np
+
+from models.SingleOrigin import SingleOrigin
+from models.DirectNetworkChange import DirectNetworkChange
+from models.ScenarioOverlay import ScenarioOverlay
+from impacts.ImpactStatistics import ImpactStatistics
+from impacts.ImpactAccumulator import ImpactAccumulator
+from impacts.ImpactsSink import ImpactsSink
+from parallelrun import runScenariosParallel
+from unittests.synthetic import makeSyntheticData
+
+class Test_ParallelRunMethods(unittest.TestCase):
+
+    def test_runScenariosParallel(self):
+        print("test parallel scenario runner against the serial loop")
+        N = 80
+        TObs, Cij, Lij = makeSyntheticData(N)
+        qm3_base = SingleOrigin()
+        qm3_base.TObs = TObs
+        qm3_base.Cij = Cij
+        qm3_base.B = np.ones(N)
+        qm3_base.Beta = [0.13, 0.073, 0.065]
+        qm3_base.fastComputePredicted()
+        rng = np.random.default_rng(2)
+        tasks = []
+        for i in range(0,12):
+            k = i%3
+            o, d = rng.choice(N,2,replace=False)
+            tasks.append((i, [ DirectNetworkChange(k,int(o),int(d),Cij[k][o,d]*30.0) ]))
+        with tempfile.TemporaryDirectory() as tmp:
+            for statisticsOnly in [False, True]:
+                #serial, same as the RUN loop in pyquant3
+                serialFile = pathlib.Path(tmp).joinpath('impacts_serial.csv')
+                overlay = ScenarioOverlay(qm3_base.Cij)
+                baselineTotals = ImpactAccumulator.fromMatrices(qm3_base.TPred,Lij)
+                with ImpactsSink.open(serialFile,1,5) as sink:
+                    for (i, networkChanges) in tasks:
+                        overlay.reset()
+                        qm3 = copy.copy(qm3_base)
+                        impacts = ImpactStatistics()
+                        if statisticsOnly:
+                            #statistics only gives the same rows to rounding, and the workers give exactly the same rows
+                            scenarioTotals = baselineTotals.copy()
+                            qm3.runWithChanges({},networkChanges,False,True,overlay,scenarioTotals)
+                            impacts.computeFromAccumulators(baselineTotals,scenarioTotals,qm3_base,qm3,Lij,networkChanges,overlay)
+                        else:
+                            qm3.runWithChanges({},networkChanges,False,True,overlay)
+                            impacts.compute(qm3_base,qm3,Lij,networkChanges,overlay)
+                        sink.add(i,impacts,networkChanges)
+                serial = serialFile.read_text()
+                #parallel
+                parallelFile = pathlib.Path(tmp).joinpath('impacts_parallel.csv')
+                with ImpactsSink.open(parallelFile,1,5) as sink:
+                    count = runScenariosParallel(qm3_base,Lij,iter(tasks),2,True,sink,chunkSize=2,statisticsOnly=statisticsOnly)
+                self.assertEqual(count, len(tasks))
+                self.assertEqual(parallelFile.read_text(), serial)
+            #end for
+            #stopping the batch part way through still writes complete rows in order, with nothing missing
+            with ImpactsSink.open(parallelFile,1,5) as sink:
+                count = runScenariosParallel(qm3_base,Lij,iter(tasks),2,True,sink,chunkSize=1,scenarioFinished=lambda idx: idx<2,statisticsOnly=True)
+            self.assertGreaterEqual(count, 3)
+            self.assertLess(count, len(tasks))
+            self.assertEqual(parallelFile.read_text(), ''.join(serial.splitlines(True)[0:count+1]))
+    ###
+
+
+if __name__ == '__main__':
+    unittest.main()
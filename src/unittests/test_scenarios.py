@@ -0,0 +1,153 @@
+"""
+unit test for the scenario generators and the radius neighbour index using synthetic data
+python -m unittest discover
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+from scenarios.RadiusNeighbourIndex import RadiusNeighbourIndex
+from scenarios.OneLink import OneLinkLimitR
+from scenarios.NLink import NLinkLimitR
+from scenarios.FileScenario import FileScenario
+from unittests.synthetic import makeSyntheticData
+
+class Test_ScenarioMethods(unittest.TestCase):
+
+    def setUp(self):
+        TObs, Cij, Lij = makeSyntheticData(90)
+        self.Lij = Lij
+    ###
+
+    def test_radiusNeighbourIndex(self):
+        print("test radius neighbour index")
+        for radiusKM in [0.0, 5.0, 20.0]:
+            index = RadiusNeighbourIndex.build(self.Lij[0], radiusKM, tileRows=7)
+            for i in range(0,90):
+                self.assertTrue(np.array_equal(index.neighbours(i), np.nonzero(self.Lij[0][i]<=radiusKM)[0]))
+            self.assertEqual(index.counts().sum(), np.count_nonzero(self.Lij[0]<=radiusKM))
+    ###
+
+    def test_oneLinkSequence(self):
+        print("test OneLinkLimitR sequence against the cell by cell scan")
+        radiusKM = 10.0
+        expected = [ (i,j) for i in range(0,90) for j in range(0,90) if self.Lij[1][i,j]<=radiusKM ]
+        generator = OneLinkLimitR(radiusKM,90,1,self.Lij[1])
+        generator.i = 0
+        generator.j = -1
+        result = []
+        while True:
+            networkChanges = generator.next()
+            if networkChanges==[]:
+                break
+            result.append((networkChanges[0].originZonei, networkChanges[0].destinationZonei))
+        self.assertEqual(result, expected)
+        self.assertEqual((generator.i, generator.j), (90, 0))
+    ###
+
+    def test_radiusNeighbourIndexCache(self):
+        print("test radius neighbour index cache")
+        with tempfile.TemporaryDirectory() as dir:
+            cacheFilename = RadiusNeighbourIndex.cacheFilename(os.path.join(dir,'dis_crowfly_vertex_roads_KM.bin'), 5)
+            index1 = RadiusNeighbourIndex.loadOrBuild(self.Lij[0], 5.0, cacheFilename)
+            self.assertTrue(os.path.exists(cacheFilename))
+            index2 = RadiusNeighbourIndex.loadOrBuild(self.Lij[0], 5.0, cacheFilename)
+            self.assertTrue(np.array_equal(index1.indptr, index2.indptr))
+            self.assertTrue(np.array_equal(index1.indices, index2.indices))
+            #a different matrix in the same file name mustn't use the cached index
+            index3 = RadiusNeighbourIndex.loadOrBuild(self.Lij[2], 5.0, cacheFilename)
+            self.assertTrue(np.array_equal(index3.indices, RadiusNeighbourIndex.build(self.Lij[2], 5.0).indices))
+    ###
+
+    def test_nLinkBatch(self):
+        print("test NLinkLimitR batches")
+        radiusKM = 10.0
+        generator = NLinkLimitR(4,radiusKM,90,2,self.Lij[2],seed=1234)
+        links = generator.nextBatch(500,speedKPH=100.0)
+        self.assertEqual(links.shape, (500,4))
+        #the same seed gives the same scenarios
+        self.assertTrue(np.array_equal(links, NLinkLimitR(4,radiusKM,90,2,self.Lij[2],seed=1234).nextBatch(500,speedKPH=100.0)))
+        for scenario in links:
+            valid = scenario[scenario['mode']>=0]
+            self.assertTrue(np.all(valid['mode']==2))
+            self.assertTrue(np.all(self.Lij[2][valid['i'],valid['j']]<=radiusKM))
+            self.assertTrue(np.allclose(valid['secs'], self.Lij[2][valid['i'],valid['j']]/100.0*3600.0))
+            #links are chained and never go straight back
+            self.assertTrue(np.array_equal(valid['i'][1:], valid['j'][:-1]))
+            self.assertTrue(np.all(valid['j'][1:]!=valid['i'][:-1]))
+            #and once a walk gets stuck, it stays stuck
+            self.assertTrue(np.all(scenario['mode'][len(valid):]==-1))
+        #next matches nextBatch(1)
+        g1 = NLinkLimitR(4,radiusKM,90,2,self.Lij[2],seed=99)
+        g2 = NLinkLimitR(4,radiusKM,90,2,self.Lij[2],seed=99)
+        for n in range(0,20):
+            expected = [ (int(l['i']),int(l['j'])) for l in g2.nextBatch(1)[0] if l['mode']>=0 ]
+            self.assertEqual([ (nc.originZonei,nc.destinationZonei) for nc in g1.next() ], expected)
+        #spawned streams are different from each other
+        children = generator.spawn(3)
+        batches = [ child.nextBatch(50) for child in children ]
+        self.assertFalse(np.array_equal(batches[0], batches[1]))
+        self.assertFalse(np.array_equal(batches[1], batches[2]))
+        self.assertTrue(children[0].index is generator.index)
+    ###
+
+    def test_fileScenarioNearestZones(self):
+        print("test FileScenario zone snapping against great circle distances")
+        rng = np.random.default_rng(7)
+        zonecodes = pd.DataFrame({ 'zonei': np.arange(0,500), 'lon': rng.uniform(-5.0,1.5,500), 'lat': rng.uniform(50.0,58.0,500) })
+        lons = rng.uniform(-5.0,1.5,200)
+        lats = rng.uniform(50.0,58.0,200)
+        #haversine to every zone
+        lon1, lat1, lon2, lat2 = [ np.radians(a) for a in [ lons[:,None], lats[:,None], zonecodes['lon'].to_numpy()[None,:], zonecodes['lat'].to_numpy()[None,:] ] ]
+        h = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+        expected = np.argmin(h,axis=1)
+        scenario = FileScenario('scenario.graphml',2,zonecodes)
+        self.assertTrue(np.array_equal(scenario.findNearestZones(lons,lats), expected))
+        self.assertEqual(scenario.findNearestZone(lons[3],lats[3]), expected[3])
+        #and from a graphml file
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir,'scenario.graphml')
+            with open(filename,'w') as f:
+                f.write('<graphml><graph>')
+                f.write('<node id="A" lon="'+str(lons[0])+'" lat="'+str(lats[0])+'"/><node id="B" lon="'+str(lons[1])+'" lat="'+str(lats[1])+'"/>')
+                f.write('<edge source="A" target="B"><data key="weight">250</data></edge></graph></graphml>')
+            networkChanges = FileScenario(filename,2,zonecodes).next()
+            self.assertEqual([ (nc.mode,nc.originZonei,nc.destinationZonei,nc.absoluteTimeSecs) for nc in networkChanges ], [ (2,expected[0],expected[1],250.0) ])
+    ###
+
+    def test_fileScenarioBatch(self):
+        print("test FileScenario directories, manifests and the graphml cache")
+        zonecodes = pd.DataFrame({ 'zonei': [0,1,2], 'lon': [0.0,1.0,2.0], 'lat': [51.0,51.0,51.0] })
+        def writeGraphML(filename, seconds):
+            with open(filename,'w') as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?><graphml xmlns="http://graphml.graphdrawing.org/xmlns"><graph edgedefault="undirected">')
+                f.write('<node id="A" lon="0.01" lat="51.0"/><node id="B" lon="1.9" lat="51.01"/>')
+                f.write('<edge source="A" target="B"><data key="weight">'+str(seconds)+'</data></edge></graph></graphml>')
+        with tempfile.TemporaryDirectory() as dir:
+            os.mkdir(os.path.join(dir,'schemes'))
+            writeGraphML(os.path.join(dir,'schemes','b.graphml'), 200)
+            writeGraphML(os.path.join(dir,'schemes','a.graphml'), 100)
+            with open(os.path.join(dir,'manifest.txt'),'w') as f:
+                f.write('# portfolio\nschemes/b.graphml\n\nschemes/a.graphml\n')
+            scenario = FileScenario(os.path.join(dir,'schemes'),1,zonecodes)
+            self.assertEqual([ os.path.basename(f) for f in scenario.filenames ], ['a.graphml','b.graphml'])
+            secs = [ [ (nc.mode,nc.originZonei,nc.destinationZonei,nc.absoluteTimeSecs) for nc in scenario.next() ] for n in range(0,3) ]
+            self.assertEqual(secs, [ [(1,0,2,100.0)], [(1,0,2,200.0)], [(1,0,2,100.0)] ])
+            self.assertEqual(FileScenario.findScenarioFiles(os.path.join(dir,'manifest.txt')),
+                [ os.path.join(dir,'schemes/b.graphml'), os.path.join(dir,'schemes/a.graphml') ])
+            #cached, and returns copies which can be changed
+            filename = os.path.join(dir,'schemes','a.graphml')
+            scenario.loadFromGraphML(filename)[0].absoluteTimeSecs = -1
+            self.assertEqual(scenario.loadFromGraphML(filename)[0].absoluteTimeSecs, 100.0)
+            #a changed file is loaded again
+            writeGraphML(filename, 300)
+            os.utime(filename, ns=(0,12345))
+            self.assertEqual(scenario.loadFromGraphML(filename)[0].absoluteTimeSecs, 300.0)
+    ###
+
+
+if __name__ == '__main__':
+    unittest.main()
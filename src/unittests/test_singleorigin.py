@@ -0,0 +1,378 @@
+"""
+unit test for the SingleOrigin gravity model using synthetic data
+python -m unittest discover
+"""
+
+import unittest
+import copy
+import numpy as np
+
+from models.SingleOrigin import SingleOrigin
+from models.GravityKernel import GravityKernel
+from models.CalibrationSolver import CalibrationSolver
+from models.DirectNetworkChange import DirectNetworkChange
+from models.RowOverlayMatrix import RowOverlayMatrix
+from models.ScenarioOverlay import ScenarioOverlay
+from impacts.ImpactStatistics import ImpactStatistics
+from unittests.synthetic import makeSyntheticData
+
+class Test_SingleOriginMethods(unittest.TestCase):
+
+    def makeModel(self, N, dtype):
+        TObs, Cij, Lij = makeSyntheticData(N, dtype=dtype)
+        qm3 = SingleOrigin()
+        qm3.dtype = dtype
+        qm3.TObs = TObs
+        qm3.Cij = Cij
+        qm3.isUsingConstraints = False
+        qm3.B = np.ones(N)
+        qm3.Beta = [0.13, 0.073, 0.065]
+        return qm3, Lij
+    ###
+
+    def test_float32Precision(self):
+        print("test float32 precision against float64")
+        N = 150
+        qm3_64, Lij = self.makeModel(N, np.float64)
+        qm3_32, _ = self.makeModel(N, np.float32)
+        qm3_64.fastComputePredicted()
+        qm3_32.fastComputePredicted()
+        for k in range(0,qm3_64.numModes):
+            self.assertEqual(qm3_32.TPred[k].dtype, np.float32)
+            #see docs/precision.md for these bounds
+            CBar64 = qm3_64.calculateCBar(qm3_64.TPred[k], qm3_64.Cij[k])
+            CBar32 = qm3_32.calculateCBar(qm3_32.TPred[k], qm3_32.Cij[k])
+            self.assertLess(abs(CBar32-CBar64)/CBar64, 1.0e-5)
+            Ck64 = np.sum(qm3_64.TPred[k])
+            Ck32 = np.sum(qm3_32.TPred[k], dtype=np.float64)
+            self.assertLess(abs(Ck32-Ck64)/Ck64, 3.0e-6)
+            Lk64 = np.sum(qm3_64.TPred[k]*Lij[k])
+            Lk32 = np.sum(qm3_32.TPred[k]*Lij[k].astype(np.float32), dtype=np.float64)
+            self.assertLess(abs(Lk32-Lk64)/Lk64, 3.0e-6)
+    ###
+
+    def test_gravityKernel(self):
+        print("test gravity kernel against the per origin loop")
+        N = 60
+        qm3, Lij = self.makeModel(N, np.float64)
+        OiObs = sum([qm3.TObs[k].sum(axis=1) for k in range(0,qm3.numModes)])
+        DjObs = sum([qm3.TObs[k].sum(axis=0) for k in range(0,qm3.numModes)])
+        #reference version, which is the original per origin loop
+        expBetaCij = [np.exp(-qm3.Beta[k]*qm3.Cij[k]) for k in range(0,qm3.numModes)]
+        TRef = [np.zeros((N,N)) for k in range(0,qm3.numModes)]
+        for k in range(0,qm3.numModes):
+            for i in range(0,N):
+                denom = 0.0
+                for kk in range(0,qm3.numModes):
+                    denom += np.sum(DjObs*expBetaCij[kk][i,:])
+                TRef[k][i,:] = OiObs[i]*(qm3.B*DjObs*expBetaCij[k][i]/denom)
+        #check it with tiles that don't divide N as well as the whole matrix
+        for tileRows in [None, 7, 256]:
+            qm3.tileRows = tileRows
+            qm3.fastComputePredicted()
+            for k in range(0,qm3.numModes):
+                self.assertTrue(np.allclose(qm3.TPred[k], TRef[k], rtol=1.0e-12, atol=0.0))
+    ###
+
+    def test_matrixFreeCalibration(self):
+        print("test matrix free calibration statistics")
+        N = 60
+        qm3, Lij = self.makeModel(N, np.float64)
+        OiObs, DjObs = qm3.computeObservedMarginals()
+        B = np.linspace(0.5,1.5,N)
+        expBetaCij = [np.exp(-qm3.Beta[k]*qm3.Cij[k]) for k in range(0,qm3.numModes)]
+        TPred, denomRef = GravityKernel.run(expBetaCij, OiObs, DjObs, B)
+        for tileRows in [None, 7]:
+            denom, trips, costs, colSums = GravityKernel.computeStatistics(expBetaCij, qm3.Cij, OiObs, DjObs, B, tileRows)
+            self.assertTrue(np.allclose(denom, denomRef, rtol=1.0e-12, atol=0.0))
+            self.assertTrue(np.allclose(colSums, sum(TPred).sum(axis=0), rtol=1.0e-12, atol=0.0))
+            for k in range(0,qm3.numModes):
+                self.assertAlmostEqual(trips[k]/np.sum(TPred[k]), 1.0, places=12)
+                self.assertAlmostEqual(costs[k]/trips[k], qm3.calculateCBar(TPred[k], qm3.Cij[k]), places=10)
+        #and the calibration converges with TPred built from the final betas
+        qm3.run()
+        for k in range(0,qm3.numModes):
+            self.assertAlmostEqual(qm3.CBarPred[k], qm3.calculateCBar(qm3.TPred[k], qm3.Cij[k]), places=10)
+            self.assertLessEqual(abs(qm3.CBarPred[k]-qm3.CBarObs[k])/qm3.CBarObs[k], 0.001)
+    ###
+
+    def test_calibrationSolvers(self):
+        print("test calibration solvers and the CBar jacobian")
+        N = 60
+        qm3, Lij = self.makeModel(N, np.float64)
+        OiObs, DjObs = qm3.computeObservedMarginals()
+        B = np.linspace(0.5,1.5,N)
+        def CBarPred(Beta):
+            expBetaCij = [np.exp(-Beta[k]*qm3.Cij[k]) for k in range(0,qm3.numModes)]
+            stats = GravityKernel.computeStatistics(expBetaCij, qm3.Cij, OiObs, DjObs, B, 7, True)
+            return stats[2]/stats[1], stats[4]
+        #jacobian against central differences
+        Beta = np.array(qm3.Beta)
+        CBar, J = CBarPred(Beta)
+        h = 1.0e-6
+        for m in range(0,qm3.numModes):
+            dBeta = np.zeros(qm3.numModes)
+            dBeta[m] = h
+            Jm = (CBarPred(Beta+dBeta)[0]-CBarPred(Beta-dBeta)[0])/(2*h)
+            self.assertTrue(np.allclose(J[:,m], Jm, rtol=1.0e-5, atol=1.0e-8*np.abs(J).max()))
+        #every solver gets to the same betas, within the tolerance
+        results = {}
+        for method in CalibrationSolver.Methods:
+            qm3.calibrationSolver = CalibrationSolver(method, 1.0e-6, 200)
+            qm3.run()
+            self.assertTrue(qm3.calibrationConverged)
+            self.assertEqual(len(qm3.calibrationSolver.trace), qm3.calibrationSolver.iteration+1)
+            results[method] = (np.array(qm3.Beta), qm3.calibrationSolver.iteration)
+        for method in CalibrationSolver.Methods:
+            self.assertTrue(np.allclose(results[method][0], results['multiplicative'][0], rtol=1.0e-4))
+        self.assertLess(results['newton'][1], results['multiplicative'][1])
+        #and the iteration cap
+        qm3.calibrationSolver = CalibrationSolver('multiplicative', 1.0e-6, 2)
+        qm3.run()
+        self.assertFalse(qm3.calibrationConverged)
+        self.assertEqual(qm3.calibrationSolver.iteration, 2)
+    ###
+
+    def test_warmStartCalibration(self):
+        print("test calibration warm start")
+        N = 60
+        qm3, Lij = self.makeModel(N, np.float64)
+        qm3.run()
+        coldIterations = qm3.calibrationSolver.iteration
+        Beta = list(qm3.Beta)
+        #a small change to the bus costs, then start from the last betas
+        qm3.Cij[1] = qm3.Cij[1]*1.02
+        qm3.expBetaCijCache.invalidate()
+        qm3.run(initialBeta=Beta, initialB=qm3.B)
+        self.assertTrue(qm3.calibrationConverged)
+        self.assertLess(qm3.calibrationSolver.iteration, coldIterations)
+        self.assertEqual(qm3.calibrationSolver.trace[0]['Beta'], Beta)
+        for k in range(0,qm3.numModes):
+            self.assertLessEqual(abs(qm3.CBarPred[k]-qm3.CBarObs[k])/qm3.CBarObs[k], 0.001)
+    ###
+
+    def test_constraints(self):
+        print("test vectorised green belt constraints")
+        N = 60
+        qm3, Lij = self.makeModel(N, np.float64)
+        qm3.isUsingConstraints = True
+        qm3.constraints = np.zeros(N)
+        qm3.constraints[::4] = 1.0
+        qm3.run()
+        self.assertTrue(qm3.calibrationConverged)
+        self.assertTrue(qm3.constraintsConverged)
+        OiObs, DjObs = qm3.computeObservedMarginals()
+        DjPred = sum([ qm3.TPred[k].sum(axis=0) for k in range(0,qm3.numModes) ])
+        isConstrained = qm3.constraints>=1.0
+        self.assertTrue(np.all(DjPred[isConstrained]-DjObs[isConstrained] < 0.5))
+        self.assertTrue(np.any(qm3.B[isConstrained] < 1.0)) #some of them must have been binding
+        self.assertTrue(np.all(qm3.B[~isConstrained] == 1.0))
+
+        #runWithChanges against the original zone by zone balancing loop, with more jobs in the constrained zones
+        OiDjHash = { j: [-1, 2.0*DjObs[j]] for j in range(0,N,8) }
+        qm3_new = copy.copy(qm3)
+        qm3_new.runWithChanges(OiDjHash, None, False)
+        self.assertTrue(qm3_new.constraintsConverged)
+        self.assertIsNot(qm3_new.B, qm3.B) #the baseline B weights mustn't change
+        B = np.copy(qm3.B)
+        expBetaCij = [ qm3.computeExpBetaCij(k) for k in range(0,qm3.numModes) ]
+        TPredCons, denom = GravityKernel.run(expBetaCij, OiObs, DjObs, B)
+        Z = sum([ T.sum(axis=0) for T in TPredCons ])
+        Dj = np.copy(DjObs)
+        for j in OiDjHash: Dj[j] = OiDjHash[j][1]
+        constraintsMet = False
+        while not constraintsMet:
+            constraintsMet = True
+            TPred, denom = GravityKernel.run(expBetaCij, OiObs, Dj, B)
+            for j in range(0,N):
+                DjPredj = TPred[0][:,j].sum()+TPred[1][:,j].sum()+TPred[2][:,j].sum()
+                if isConstrained[j] and DjPredj-Z[j] >= 0.5:
+                    B[j] = B[j]*Z[j]/DjPredj
+                    constraintsMet = False
+        self.assertTrue(np.allclose(qm3_new.B, B, rtol=1.0e-12, atol=0.0))
+        for k in range(0,qm3.numModes):
+            self.assertTrue(np.allclose(qm3_new.TPred[k], TPred[k], rtol=1.0e-12, atol=0.0))
+    ###
+
+    def test_releaseObserved(self):
+        print("test runWithChanges from the cached marginals without TObs")
+        N = 60
+        networkChanges = [ DirectNetworkChange(1,3,40,120.0) ]
+        for isUsingConstraints in [False, True]:
+            qm3_base, Lij = self.makeModel(N, np.float64)
+            qm3_base.isUsingConstraints = isUsingConstraints
+            qm3_base.constraints = np.zeros(N)
+            qm3_base.constraints[::3] = 1.0
+            qm3_base.run()
+            #DjCons from the last calibration pass is the same as summing the columns of TPred
+            DjCons = np.copy(qm3_base.DjCons)
+            self.assertTrue(np.allclose(DjCons, sum([ T.sum(axis=0) for T in qm3_base.TPred ]), rtol=1.0e-12, atol=0.0))
+            qm3_base.DjCons = None
+            self.assertTrue(np.allclose(qm3_base.computeBaselineDj(), DjCons, rtol=1.0e-12, atol=0.0))
+            OiDjHash = { 40: [-1, 3.0*qm3_base.DjObs[40]] }
+            results = []
+            for release in [False, True]:
+                base = qm3_base.deepcopy()
+                if release:
+                    base.releaseObserved()
+                    self.assertEqual(base.TObs, [])
+                qm3 = copy.copy(base)
+                qm3.Cij = [ np.copy(base.Cij[k]) for k in range(0,base.numModes) ]
+                qm3.runWithChanges(OiDjHash, copy.deepcopy(networkChanges), False)
+                results.append(qm3)
+            for k in range(0,qm3_base.numModes):
+                self.assertTrue(np.array_equal(results[0].TPred[k], results[1].TPred[k]))
+            self.assertTrue(np.array_equal(results[0].B, results[1].B))
+    ###
+
+    def test_expBetaCijCache(self):
+        print("test exp(-beta*Cij) cache")
+        N = 80
+        qm3_base, Lij = self.makeModel(N, np.float64)
+        qm3_base.fastComputePredicted()
+        baseline = [np.copy(e) for e in qm3_base.expBetaCijCache.expBetaCij]
+        saveCij = [np.copy(qm3_base.Cij[k]) for k in range(0,qm3_base.numModes)]
+        for mode in range(0,qm3_base.numModes):
+            #same pattern as the RUN loop in pyquant3
+            qm3 = copy.copy(qm3_base)
+            qm3.Cij = [np.copy(saveCij[k]) for k in range(0,qm3.numModes)]
+            qm3.runWithChanges({}, [DirectNetworkChange(mode,3,40,60.0), DirectNetworkChange(mode,40,41,30.0)], False)
+            #check against a model built from scratch on the changed Cij
+            qm3_check = SingleOrigin()
+            qm3_check.TObs = qm3.TObs
+            qm3_check.Cij = qm3.Cij
+            qm3_check.B = np.ones(N)
+            qm3_check.Beta = qm3.Beta
+            qm3_check.fastComputePredicted()
+            for k in range(0,qm3.numModes):
+                self.assertTrue(np.allclose(qm3.TPred[k], qm3_check.TPred[k], rtol=1.0e-12, atol=0.0))
+                #and the shared cache must be back to the baseline
+                self.assertTrue(np.array_equal(qm3_base.expBetaCijCache.expBetaCij[k], baseline[k]))
+        #changing one beta only rebuilds that mode
+        qm3_base.Beta = [qm3_base.Beta[0], qm3_base.Beta[1]*1.1, qm3_base.Beta[2]]
+        expBetaCij = qm3_base.expBetaCijCache.get(qm3_base)
+        self.assertIs(expBetaCij[0], qm3_base.expBetaCijCache.expBetaCij[0])
+        self.assertTrue(np.array_equal(expBetaCij[0], baseline[0]))
+        self.assertTrue(np.allclose(expBetaCij[1], np.exp(-qm3_base.Beta[1]*qm3_base.Cij[1]), rtol=1.0e-12))
+    ###
+
+    def test_incrementalRunWithChanges(self):
+        print("test incremental runWithChanges against a full run")
+        N = 100
+        qm3_base, Lij = self.makeModel(N, np.float64)
+        qm3_base.fastComputePredicted()
+        saveCij = [np.copy(qm3_base.Cij[k]) for k in range(0,qm3_base.numModes)]
+        #links which are only slightly quicker than the existing paths, so only some origin rows change
+        secs1 = saveCij[0][10,11]*60.0-30.0
+        secs2 = saveCij[0][11,50]*60.0-60.0
+        networkChanges = [ DirectNetworkChange(0,10,11,secs1), DirectNetworkChange(0,11,50,secs2) ]
+        results = []
+        for incremental in [False, True]:
+            qm3 = copy.copy(qm3_base)
+            qm3.Cij = [np.copy(saveCij[k]) for k in range(0,qm3.numModes)]
+            qm3.runWithChanges({}, networkChanges, False, incremental)
+            results.append(qm3)
+        (qm3_full, qm3_inc) = results
+        for k in range(0,qm3_base.numModes):
+            T = qm3_inc.TPred[k]
+            self.assertIsInstance(T, RowOverlayMatrix)
+            self.assertIs(T.base, qm3_base.TPred[k]) #rows that didn't change are shared, not copied
+            self.assertLess(len(T.rows), N)
+            self.assertTrue(np.allclose(T.materialise(), qm3_full.TPred[k], rtol=1.0e-12, atol=0.0))
+            self.assertAlmostEqual(np.sum(qm3_base.TPred[k])+T.deltaSum(), np.sum(qm3_full.TPred[k]), delta=1.0e-9*np.sum(qm3_full.TPred[k]))
+    ###
+
+    def test_incrementalStaleBaseline(self):
+        print("test incremental runWithChanges falls back to a full run when Beta or B have changed")
+        N = 100
+        qm3_base, Lij = self.makeModel(N, np.float64)
+        qm3_base.fastComputePredicted()
+        saveCij = [np.copy(qm3_base.Cij[k]) for k in range(0,qm3_base.numModes)]
+        networkChanges = [ DirectNetworkChange(0,10,11,saveCij[0][10,11]*60.0-30.0) ]
+        self.assertTrue(qm3_base.canRunIncremental({}))
+        for (Beta, B) in [ ([0.13, 0.08, 0.065], qm3_base.B), (qm3_base.Beta, np.linspace(0.5,1.5,N)) ]:
+            #new parameters set on the model, but the baseline TPred hasn't been rebuilt with them
+            qm3_stale = copy.copy(qm3_base)
+            qm3_stale.Beta = Beta
+            qm3_stale.B = B
+            self.assertFalse(qm3_stale.canRunIncremental({}))
+            results = []
+            for incremental in [False, True]:
+                qm3 = copy.copy(qm3_stale)
+                qm3.Cij = [np.copy(saveCij[k]) for k in range(0,qm3.numModes)]
+                qm3.runWithChanges({}, networkChanges, False, incremental)
+                results.append(qm3)
+            (qm3_full, qm3_inc) = results
+            for k in range(0,qm3_base.numModes):
+                self.assertNotIsInstance(qm3_inc.TPred[k], RowOverlayMatrix)
+                self.assertTrue(np.array_equal(qm3_inc.TPred[k], qm3_full.TPred[k]))
+        #and a full scenario run can't be the baseline of an incremental one
+        self.assertFalse(qm3_full.canRunIncremental({}))
+        #rebuilding the baseline with the new betas makes it current again
+        qm3_stale = copy.copy(qm3_base)
+        qm3_stale.Beta = [0.13, 0.08, 0.065]
+        qm3_stale.fastComputePredicted()
+        self.assertTrue(qm3_stale.canRunIncremental({}))
+        self.assertTrue(qm3_base.deepcopy().canRunIncremental({}))
+    ###
+
+    def test_scenarioOverlay(self):
+        print("test scenario overlay against copying Cij")
+        N = 100
+        qm3_base, Lij = self.makeModel(N, np.float64)
+        qm3_base.fastComputePredicted()
+        baseCij = [np.copy(qm3_base.Cij[k]) for k in range(0,qm3_base.numModes)]
+        overlay = ScenarioOverlay(qm3_base.Cij)
+        scenarios = [ [DirectNetworkChange(0,10,11,30.0), DirectNetworkChange(0,11,50,60.0)], [DirectNetworkChange(2,3,40,600.0)], [] ]
+        for networkChanges in scenarios:
+            #same pattern as the RUN loop in pyquant3
+            overlay.reset()
+            qm3 = copy.copy(qm3_base)
+            qm3.runWithChanges({}, networkChanges, False, True, overlay)
+            #check against the old way of copying all the Cij matrices
+            qm3_check = copy.copy(qm3_base)
+            qm3_check.Cij = [np.copy(baseCij[k]) for k in range(0,qm3_base.numModes)]
+            qm3_check.runWithChanges({}, networkChanges, False, True)
+            impacts = ImpactStatistics()
+            impacts.compute(qm3_base, qm3, Lij, networkChanges, overlay)
+            impacts_check = ImpactStatistics()
+            impacts_check.compute(qm3_base, qm3_check, Lij, networkChanges)
+            for k in range(0,qm3_base.numModes):
+                self.assertTrue(np.array_equal(qm3.Cij[k], qm3_check.Cij[k]))
+                self.assertTrue(np.array_equal(qm3_base.Cij[k], baseCij[k])) #the baseline is never written to
+                self.assertTrue(np.array_equal(qm3.TPred[k].materialise(), qm3_check.TPred[k].materialise()))
+                self.assertEqual(impacts.nMinus_k[k], impacts_check.nMinus_k[k])
+                self.assertAlmostEqual(float(impacts.savedSecs_k[k]), float(impacts_check.savedSecs_k[k]), delta=1.0e-6*max(1.0,float(impacts_check.savedSecs_k[k])))
+        #a reset puts the scratch matrices back to the baseline
+        overlay.reset()
+        for k in range(0,qm3_base.numModes):
+            self.assertTrue(np.array_equal(overlay.Cij[k], baseCij[k]))
+    ###
+
+    def test_readOnlyCij(self):
+        print("test runWithChanges without an overlay on read only Cij")
+        N = 80
+        qm3_base, Lij = self.makeModel(N, np.float32)
+        baseCij = [np.copy(qm3_base.Cij[k]) for k in range(0,qm3_base.numModes)]
+        for C in qm3_base.Cij:
+            C.setflags(write=False) #like the memmaps from loadQUANTMatrixMapped
+        qm3_base.fastComputePredicted()
+        networkChanges = [ DirectNetworkChange(1,10,11,30.0) ]
+        qm3 = copy.copy(qm3_base)
+        qm3.runWithChanges({}, networkChanges, False)
+        #check against writable matrices
+        qm3_check = copy.copy(qm3_base)
+        qm3_check.Cij = [np.copy(baseCij[k]) for k in range(0,qm3_base.numModes)]
+        qm3_check.runWithChanges({}, networkChanges, False)
+        for k in range(0,qm3_base.numModes):
+            self.assertTrue(np.array_equal(qm3.Cij[k], qm3_check.Cij[k]))
+            self.assertTrue(np.array_equal(qm3.TPred[k], qm3_check.TPred[k]))
+            self.assertTrue(np.array_equal(qm3_base.Cij[k], baseCij[k]))
+        #only the mode with changes is copied
+        self.assertIsNot(qm3.Cij[1], qm3_base.Cij[1])
+        self.assertIs(qm3.Cij[0], qm3_base.Cij[0])
+    ###
+
+
+if __name__ == '__main__':
+    unittest.main()
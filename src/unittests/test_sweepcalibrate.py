@@ -0,0 +1,45 @@
+"""
+unit test for the SWEEPCALIBRATE sufficient statistics using synthetic data
+python -m unittest discover
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+from models.SingleOrigin import SingleOrigin
+from sweepcalibrate import sweep_calibrate
+from unittests.synthetic import makeSyntheticData
+
+class Test_SweepCalibrateMethods(unittest.TestCase):
+
+    def test_sweepCalibrate(self):
+        print("test sweep calibrate against full model runs")
+        N = 80
+        TObs, Cij, Lij = makeSyntheticData(N)
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir,'sweepcalibrate.csv')
+            sweep_calibrate(TObs[0], TObs[1], TObs[2], Cij[0], Cij[1], Cij[2], np.float64, 0.05, 0.14, 0.04, filename, tileRows=16)
+            df = pd.read_csv(filename)
+        self.assertEqual(len(df.index), 27)
+        #the same as the old sweep, which ran the model for every set of betas
+        qm3 = SingleOrigin()
+        qm3.TObs = TObs
+        qm3.Cij = Cij
+        qm3.isUsingConstraints = False
+        qm3.B = np.ones(N)
+        for idx in [0, 5, 13, 26]:
+            row = df.iloc[idx]
+            qm3.Beta = [ row['beta_road'], row['beta_bus'], row['beta_rail'] ]
+            qm3.runWithChanges({}, None, False)
+            for k, name in enumerate(['road','bus','rail']):
+                self.assertAlmostEqual(row['Cij_'+name]/np.sum(qm3.TPred[k]), 1.0, places=10)
+                self.assertAlmostEqual(row['CBarPred_'+name]/qm3.calculateCBar(qm3.TPred[k], Cij[k]), 1.0, places=10)
+                self.assertAlmostEqual(row['CBarObs_'+name], qm3.calculateCBar(TObs[k], Cij[k]))
+    ###
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+unit test for the QUANT matrix loaders
+python -m unittest discover
+These use a small synthetic matrix written to a temporary file, so they don't need the model-runs data.
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+
+from utils import loadQUANTMatrix, loadQUANTMatrixFAST, loadQUANTMatrixMapped, loadGreenBeltConstraints, loadConstraintsB
+
+class Test_UtilsMethods(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.data = rng.random((7,5)).astype('<f4') #deliberately not square
+        fd, self.filename = tempfile.mkstemp(suffix='.bin')
+        with os.fdopen(fd,'wb') as f:
+            np.array([7,5],dtype='<i4').tofile(f)
+            self.data.tofile(f)
+    ###
+
+    def tearDown(self):
+        os.remove(self.filename)
+    ###
+
+    def test_loadQUANTMatrixMapped(self):
+        print("test loadQUANTMatrixMapped")
+        matrix = loadQUANTMatrixMapped(self.filename)
+        self.assertEqual(matrix.shape,(7,5))
+        self.assertEqual(matrix.dtype,np.float32)
+        self.assertFalse(matrix.flags.writeable) #zero copy map must be read only
+        self.assertTrue(np.array_equal(matrix,self.data))
+        #opt-in copies
+        copy32 = loadQUANTMatrixMapped(self.filename, materialise=True)
+        self.assertTrue(copy32.flags.writeable)
+        self.assertEqual(copy32.dtype,np.float32)
+        copy64 = loadQUANTMatrixMapped(self.filename, dtype=np.float64)
+        self.assertEqual(copy64.dtype,np.float64)
+        self.assertTrue(np.array_equal(copy64,self.data.astype(np.float64)))
+    ###
+
+    def test_wrappers(self):
+        print("test loadQUANTMatrix wrappers")
+        for loader in [loadQUANTMatrix, loadQUANTMatrixFAST]:
+            matrix = loader(self.filename)
+            self.assertEqual(matrix.dtype,np.float64)
+            self.assertTrue(matrix.flags.writeable)
+            self.assertTrue(np.array_equal(matrix,self.data.astype(np.float64)))
+    ###
+
+    def test_truncatedFile(self):
+        print("test loadQUANTMatrixMapped truncated file")
+        with open(self.filename,'r+b') as f:
+            f.truncate(8+4*7*5-4)
+        with self.assertRaises(ValueError):
+            loadQUANTMatrixMapped(self.filename)
+    ###
+
+    def test_constraintsTables(self):
+        print("test loading the constraints tables")
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir,'GreenBeltConstraints.xml')
+            with open(filename,'w') as f:
+                f.write('<?xml version="1.0" standalone="yes"?>\n<DocumentElement>\n')
+                for zonei, gj in [(3,1),(0,0),(5,1)]:
+                    f.write('<GreenBelt><zonei>'+str(zonei)+'</zonei><Gj>'+str(gj)+'</Gj></GreenBelt>\n')
+                f.write('</DocumentElement>\n')
+            constraints = loadGreenBeltConstraints(filename,7)
+            self.assertTrue(np.array_equal(constraints,[0,0,0,1,0,1,0]))
+            filename = os.path.join(dir,'Constraints_B.csv')
+            with open(filename,'w') as f:
+                f.write('B\n0.5\n1.0\n0.25\n')
+            B = loadConstraintsB(filename,4)
+            self.assertTrue(np.array_equal(B,[0.5,1.0,0.25,1.0]))
+            with self.assertRaises(ValueError):
+                loadConstraintsB(filename,2)
+    ###
+
+if __name__ == '__main__':
+    unittest.main()
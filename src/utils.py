@@ -3,9 +3,11 @@ utils.py
 """
 
 import numpy as np
+import pandas as pd
 import struct
 import sys
 import io
+import os
 import time
 
 ###############################################################################
@@ -13,37 +15,50 @@ import time
 """
 Load a QUANT format matrix into python.
 A QUANT matrix stores the row count (m), column count (n) and then m x n IEEE754 floats (4 byte) of data
+This is now a wrapper around loadQUANTMatrixMapped which returns a float64 copy of the data, as the
+original row by row struct.unpack version was far too slow for 8436 x 8436 matrices.
 """
 def loadQUANTMatrix(filename):
-    start_time = time.process_time()
-    with open(filename,'rb') as f:
-        (m,) = struct.unpack('i', f.read(4))
-        (n,) = struct.unpack('i', f.read(4))
-        print("loadQUANTMatrix::m=",m,"n=",n)
-        matrix = np.arange(m*n,dtype=np.float64).reshape(m, n) #and hopefully m===n, but I'm not relying on it
-        for i in range(0,m):
-            data = struct.unpack('{0}f'.format(n), f.read(4*n)) #read a row back from the stream - data=list of floats
-            for j in range(0,n):
-                matrix[i,j] = data[j]
-        end_time = time.process_time()
-        print("loadQUANTMatrix:: ",str(end_time-start_time),"secs")
-        return matrix
-    
+    return loadQUANTMatrixMapped(filename, dtype=np.float64)
+
+"""
+loadQUANTMatrixFAST
+Same as loadQUANTMatrix, which returns a float64 in-memory copy of the matrix. Kept so that
+existing callers don't need changing. Use loadQUANTMatrixMapped directly if you don't need float64.
+"""
 def loadQUANTMatrixFAST(filename):
+    return loadQUANTMatrixMapped(filename, dtype=np.float64)
+
+"""
+loadQUANTMatrixMapped
+Zero copy loader for a QUANT format matrix. The file is an 8 byte header (m and n as little endian
+int32) followed by m x n little endian float32 values, so it can be mapped straight into memory as a
+read only numpy array without reading it or converting anything. Pages only get read from disk when
+they are touched and the OS can share them between processes.
+@param filename the QUANT .bin matrix file
+@param dtype if set to anything other than float32, then the data is converted into a new in-memory
+array of this type e.g. np.float64 (this is the opt-in upcast)
+@param materialise if True, then return a private writable in-memory copy rather than the read only map
+@returns m x n numpy array, which is a read only np.memmap unless dtype or materialise are set
+"""
+def loadQUANTMatrixMapped(filename, dtype=None, materialise=False):
     start_time = time.process_time()
-    with open(filename,'rb') as f:
-        (m,) = struct.unpack('i', f.read(4))
-        (n,) = struct.unpack('i', f.read(4))
-        print("loadQUANTMatrixFAST::m=",m,"n=",n)
-        matrix = np.arange(m*n,dtype=np.float64).reshape(m, n) #and hopefully m===n, but I'm not relying on it
-        for i in range(0,m):
-            data = struct.unpack('{0}f'.format(n), f.read(4*n)) #read a row back from the stream - data=list of floats
-            #for j in range(0,n):
-            #    matrix[i,j] = data[j]
-            matrix[i,:] = data
-        end_time = time.process_time()
-        print("loadQUANTMatrixFAST:: ",str(end_time-start_time),"secs")
-        return matrix
+    (m, n) = np.fromfile(filename, dtype='<i4', count=2)
+    m = int(m)
+    n = int(n)
+    print("loadQUANTMatrixMapped::m=",m,"n=",n)
+    expectedBytes = 8+4*m*n
+    actualBytes = os.path.getsize(filename)
+    if actualBytes!=expectedBytes:
+        raise ValueError("loadQUANTMatrixMapped: "+str(filename)+" is "+str(actualBytes)+" bytes, expected "+str(expectedBytes)+" for a "+str(m)+"x"+str(n)+" matrix")
+    matrix = np.memmap(filename, dtype='<f4', mode='r', offset=8, shape=(m, n)) #and hopefully m===n, but I'm not relying on it
+    if dtype is not None and np.dtype(dtype)!=matrix.dtype:
+        matrix = np.array(matrix, dtype=dtype) #upcast, which is a copy
+    elif materialise:
+        matrix = np.array(matrix) #private writable copy, still float32
+    end_time = time.process_time()
+    print("loadQUANTMatrixMapped:: ",str(end_time-start_time),"secs")
+    return matrix
 
 
 #def loadQUANTMatrixURL(url):
@@ -62,3 +77,118 @@ def loadQUANTMatrixFAST(filename):
 
 
 ###############################################################################
+
+"""
+getPrecision
+Floating point precision policy for the model matrices. This comes from "model: precision" in
+appsettings.yaml, but can be overridden by the "Precision" environment variable (--precision).
+float32 keeps TObs, Cij, TPred and exp(-beta*Cij) in single precision, which halves the memory and
+lets the matrices be mapped straight from the float32 .bin files. Sums are still done in float64.
+See docs/precision.md for the error bounds against the float64 path.
+@param configuration the appsettings.yaml dictionary
+@returns np.float32 or np.float64
+"""
+def getPrecision(configuration):
+    precision = 'float64'
+    if configuration and 'model' in configuration and configuration['model']:
+        precision = str(configuration['model'].get('precision','float64'))
+    precision = os.getenv('Precision',precision).lower()
+    if precision in ('float32','single','f4'):
+        return np.float32
+    elif precision in ('float64','double','f8'):
+        return np.float64
+    raise ValueError("getPrecision: unknown precision '"+precision+"', must be float32 or float64")
+
+"""
+getCalibrationSolver
+Calibration solver settings, from the "calibration" section of appsettings.yaml (solver, tolerance and
+maxIterations), which can be overridden by the CalibrationSolver, CalibrationTolerance and
+CalibrationMaxIterations environment variables (--solver for the first one).
+@param configuration the appsettings.yaml dictionary
+@returns a CalibrationSolver
+"""
+def getCalibrationSolver(configuration):
+    from models.CalibrationSolver import CalibrationSolver
+    settings = {}
+    if configuration and 'calibration' in configuration and configuration['calibration']:
+        settings = configuration['calibration']
+    method = os.getenv('CalibrationSolver',str(settings.get('solver','multiplicative'))).lower()
+    tolerance = float(os.getenv('CalibrationTolerance',settings.get('tolerance',0.001)))
+    maxIterations = int(os.getenv('CalibrationMaxIterations',settings.get('maxIterations',1000)))
+    return CalibrationSolver(method,tolerance,maxIterations)
+
+###############################################################################
+
+"""
+getConstraints
+Green belt constraints settings, from the "constraints" section of appsettings.yaml (enabled and maxIterations),
+which can be overridden by the UseConstraints and ConstraintsMaxIterations environment variables (--constraints
+for the first one).
+@param configuration the appsettings.yaml dictionary
+@returns (isUsingConstraints, maxIterations)
+"""
+def getConstraints(configuration):
+    settings = {}
+    if configuration and 'constraints' in configuration and configuration['constraints']:
+        settings = configuration['constraints']
+    isUsingConstraints = os.getenv('UseConstraints',str(int(bool(settings.get('enabled',False)))))
+    isUsingConstraints = isUsingConstraints.lower() in ('1','true','yes')
+    maxIterations = int(os.getenv('ConstraintsMaxIterations',settings.get('maxIterations',100)))
+    return isUsingConstraints, maxIterations
+
+###############################################################################
+
+"""
+loadZoneVector
+Load one column of a table with a row per zone into a vector in zonei order. The table can be xml (pd.read_xml)
+or csv. If there is a zonei column, then the rows go into those zones, otherwise the rows are in zonei order.
+@param filename xml or csv file
+@param N number of zones
+@param columns names of the value column to look for in order (any case), otherwise it's the last numeric column
+that isn't zonei
+@param default value for any zones missing from the table
+@returns float64 vector (N)
+"""
+def loadZoneVector(filename, N, columns, default=0.0):
+    if str(filename).lower().endswith('.xml'):
+        df = pd.read_xml(filename)
+    else:
+        df = pd.read_csv(filename)
+    names = { str(c).lower(): c for c in df.columns }
+    column = next((names[c.lower()] for c in columns if c.lower() in names), None)
+    if column is None:
+        numeric = [ c for c in df.select_dtypes(include='number').columns if str(c).lower()!='zonei' ]
+        if not numeric:
+            raise ValueError("loadZoneVector: no value column in "+str(filename))
+        column = numeric[-1]
+    values = df[column].to_numpy(dtype=np.float64)
+    if 'zonei' in names:
+        zonei = df[names['zonei']].to_numpy(dtype=np.int64)
+    else:
+        zonei = np.arange(len(values))
+    if np.any(zonei<0) or np.any(zonei>=N):
+        raise ValueError("loadZoneVector: "+str(filename)+" has zones outside 0.."+str(N-1))
+    vector = np.full(N, default, dtype=np.float64)
+    vector[zonei] = values
+    return vector
+
+"""
+loadGreenBeltConstraints
+The GreenBeltConstraints table as the SingleOrigin constraints vector, where Gj=1 means a high enough percentage
+of the zone's land is green belt that it can't be built on.
+@param filename GreenBeltConstraints xml file
+@param N number of zones
+@returns float64 vector (N) of 1 (constrained) or 0
+"""
+def loadGreenBeltConstraints(filename, N):
+    return loadZoneVector(filename, N, ['Gj','GreenBelt','constraint','constraints'], 0.0)
+
+"""
+loadConstraintsB
+The Constraints_B table of B weights from a previous constrained calibration.
+@param filename Constraints_B csv file
+@param N number of zones
+@returns float64 vector (N) of B weights, 1.0 for any zones that aren't in the table
+"""
+def loadConstraintsB(filename, N):
+    return loadZoneVector(filename, N, ['B','Bj','ConstraintsB'], 1.0)